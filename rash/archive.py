@@ -0,0 +1,303 @@
+"""
+Time-partitioned archive of RASH DB.
+
+Old commands can be moved from the main DB to archive DBs by ``rash
+archive``.  Each archive DB (a *partition*) holds the commands
+started in one period (a year or a month) and it is named after the
+period, e.g., ``2012.sqlite`` or ``2012-05.sqlite``::
+
+  data/
+  |--* db.sqlite            # recent commands
+  `--* archive/
+     |--* 2012.sqlite
+     `--* 2013.sqlite
+
+An archive DB is an ordinary RASH DB, so the same search query can be
+run on it.  ``rash search`` searches archive DBs only when needed:
+partitions outside of the range given by ``--time-after`` and
+``--time-before`` are not opened at all.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import datetime
+
+from .utils.iterutils import chunks
+from .utils.pathutils import mkdirp
+
+PERIODS = {'year': 4, 'month': 7}
+"""
+Map period to the length of its name, i.e., the prefix of a time
+stored in DB (``YYYY-MM-DD HH:MM:SS``).
+"""
+
+
+def period_name(ts, period='year'):
+    """
+    Return the name of the `period` including time `ts`.
+
+    >>> period_name('2012-05-01 10:00:00')
+    '2012'
+    >>> period_name('2012-05-01 10:00:00', 'month')
+    '2012-05'
+
+    """
+    return str(ts)[:PERIODS[period]]
+
+
+def period_bounds(name):
+    """
+    Return a pair of datetimes ``(start, stop)`` of the period `name`.
+
+    >>> [str(t) for t in period_bounds('2012')]
+    ['2012-01-01 00:00:00', '2013-01-01 00:00:00']
+    >>> period_bounds('2012-12')[1]
+    datetime.datetime(2013, 1, 1, 0, 0)
+
+    """
+    if len(name) == PERIODS['year']:
+        year = int(name)
+        return (datetime.datetime(year, 1, 1),
+                datetime.datetime(year + 1, 1, 1))
+    (year, month) = map(int, name.split('-'))
+    (next_year, next_month) = divmod(year * 12 + month, 12)
+    return (datetime.datetime(year, month, 1),
+            datetime.datetime(next_year, next_month + 1, 1))
+
+
+class Partition(object):
+
+    """
+    Archive DB holding commands started in one period.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        (self.start, self.stop) = period_bounds(self.name)
+
+    def __repr__(self):
+        return '<{0}: {1}>'.format(self.__class__.__name__, self.name)
+
+    def overlaps(self, time_after=None, time_before=None):
+        """
+        Return true if this partition may have commands in the range.
+
+        Bounds which are not a datetime (e.g., a string that could not
+        be parsed) are ignored, i.e., they are handled conservatively.
+
+        """
+        if isinstance(time_after, datetime.datetime) and \
+           self.stop <= time_after:
+            return False
+        if isinstance(time_before, datetime.datetime) and \
+           time_before < self.start:
+            return False
+        return True
+
+    def open(self):
+        from .database import DataBase
+        return DataBase(self.path, readonly=True)
+
+
+def list_partitions(archive_path):
+    """
+    Return partitions in `archive_path`, newest first.
+    """
+    if not os.path.isdir(archive_path):
+        return []
+    partitions = []
+    for filename in os.listdir(archive_path):
+        (name, ext) = os.path.splitext(filename)
+        if ext == '.sqlite' and len(name) in PERIODS.values():
+            try:
+                partitions.append(
+                    Partition(os.path.join(archive_path, filename)))
+            except ValueError:
+                continue
+    return sorted(partitions, key=lambda p: p.start, reverse=True)
+
+
+def select_partitions(partitions, time_after=None, time_before=None):
+    """
+    Return partitions which may have commands in the given range.
+    """
+    return [p for p in partitions if p.overlaps(time_after, time_before)]
+
+
+def archive(db, archive_path, ids, period='year', batch_size=500,
+            lock=None):
+    """
+    Move commands of `ids` from `db` to archive DBs in `archive_path`.
+
+    Commands (and sessions they belong to) are copied to the archive
+    DBs and then deleted from `db` batch by batch.  As copying is
+    committed before deletion and duplicates are skipped when
+    importing, it is safe to run this again after an interruption.
+    Return a dict which maps partition name to the number of
+    commands moved to it.  `lock` is passed to
+    :func:`rash.forget.forget`.
+
+    """
+    from .database import DataBase
+    from .forget import forget
+    archives = {}
+    moved = {}
+    for batch in chunks(ids, batch_size):
+        crecs = list(db.get_full_command_records(batch))
+        sessions = dict(
+            (srec.session_history_id, srec)
+            for srec in db.get_session_records(
+                set(c.session_history_id for c in crecs
+                    if c.session_history_id is not None)))
+        groups = {}
+        for crec in crecs:
+            name = period_name(crec.start or crec.stop, period)
+            groups.setdefault(name, []).append(crec)
+        for (name, group) in sorted(groups.items()):
+            if name not in archives:
+                mkdirp(archive_path)
+                archives[name] = DataBase(
+                    os.path.join(archive_path, name + '.sqlite'))
+            copy_commands(archives[name], group, sessions)
+            moved[name] = moved.get(name, 0) + len(group)
+        forget(db, [c.command_history_id for c in crecs], gc=False,
+               lock=lock)
+    return moved
+
+
+def archive_commands(db, archive_path, older_than, period='year',
+                     batch_size=500, lock=None):
+    """
+    Archive commands older than `older_than` days and collect garbage.
+
+    Return the result of :func:`archive`.
+
+    """
+    from .forget import forget
+    now = time.time()
+    ids = db.select_expired_command_ids(max_age=older_than, now=now)
+    moved = archive(db, archive_path, ids, period, batch_size, lock)
+    db.delete_empty_sessions(now - older_than * 24 * 60 * 60)
+    forget(db, [], batch_size=batch_size, lock=lock)  # collect garbage
+    return moved
+
+
+def copy_commands(adb, crecs, sessions):
+    """
+    Import `crecs` and their `sessions` into `adb` in one transaction.
+    """
+    with adb.connection(commit=True):
+        for sh_id in set(c.session_history_id for c in crecs):
+            srec = sessions.get(sh_id)
+            if srec is None:
+                continue
+            dct = dict(session_id=srec.session_id, start=srec.start,
+                       environ=srec.environ)
+            adb.import_init_dict(dct)
+            adb.import_exit_dict(dict(session_id=srec.session_id,
+                                      stop=srec.stop))
+        dcts = []
+        for crec in crecs:
+            dct = dict(crec.__dict__)
+            del dct['command_history_id']
+            del dct['session_history_id']
+            srec = sessions.get(crec.session_history_id)
+            dct['session_id'] = srec and srec.session_id
+            dcts.append(dct)
+        adb.import_dicts(dcts)
+
+
+def search_partitions(db, partitions, jobs=None, **kwds):
+    """
+    Search `db` and archive `partitions` by the same query.
+
+    Partitions outside of the time range of the query are skipped.
+    When no partition is left, this is the same as
+    ``db.search_command_record(**kwds)``.  Otherwise, DBs are searched
+    by :func:`rash.federated.federated_search` with `jobs` processes.
+
+    :type partitions: [Partition]
+
+    """
+    selected = select_partitions(partitions, kwds.get('time_after'),
+                                 kwds.get('time_before'))
+    if not selected:
+        return db.search_command_record(**kwds)
+    from .federated import federated_search
+    return federated_search([db.dbpath] + [p.path for p in selected],
+                            jobs, **kwds)
+
+
+def archive_run(older_than, period, dry_run, batch_size):
+    """
+    Move old commands to archive DBs.
+
+    Commands older than ``--older-than`` days are moved from the main
+    DB to per-period archive DBs (one DB per year by default) under
+    the ``archive`` directory next to the main DB.  Example::
+
+      rash archive --older-than 365
+
+    ``rash search`` searches the archive DBs as well, but only the
+    ones which can have matching commands when ``--time-after`` or
+    ``--time-before`` is given.  Other commands such as ``rash
+    suggest`` and ``rash show`` use only the main DB.
+
+    If the daemon is running, it moves commands between indexing.
+
+    """
+    from .config import ConfigStore
+    from .database import DataBase
+    from .server import call_daemon_or_lock
+    cfstore = ConfigStore()
+    if dry_run:
+        db = DataBase(cfstore.db_path, readonly=True)
+        ids = db.select_expired_command_ids(max_age=older_than)
+        print('{0} commands will be archived.'.format(len(ids)))
+        return
+    params = dict(archive_path=cfstore.archive_path, older_than=older_than,
+                  period=period, batch_size=batch_size)
+    moved = call_daemon_or_lock(
+        cfstore, 'archive',
+        lambda: archive_commands(DataBase(cfstore.db_path), **params),
+        **params)
+    for (name, count) in sorted(moved.items()):
+        print('Archived {0} commands to {1}.'.format(count, name))
+
+
+def archive_add_arguments(parser):
+    parser.add_argument(
+        '--older-than', type=float, default=365, metavar='DAYS',
+        help='archive commands older than DAYS days.')
+    parser.add_argument(
+        '--period', default='year', choices=sorted(PERIODS),
+        help='period of commands stored in one archive DB.')
+    parser.add_argument(
+        '--dry-run', action='store_true', default=False,
+        help='only print the number of commands to archive.')
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='number of commands moved in one transaction.')
+
+
+commands = [
+    ('archive', archive_add_arguments, archive_run),
+]
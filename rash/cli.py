@@ -71,7 +71,15 @@ def main(args=None):
     from . import search
     from . import show
     from . import index
+    from . import maintain
+    from . import forget
+    from . import archive
+    from . import merge
     from . import isearch
+    from . import suggest
+    from . import predict
+    from . import nav
+    from . import import_history
     # from . import MODULE
     parser = get_parser(
         init.commands
@@ -80,7 +88,15 @@ def main(args=None):
         + search.commands
         + show.commands
         + index.commands
+        + maintain.commands
+        + forget.commands
+        + archive.commands
+        + merge.commands
         + isearch.commands
+        + suggest.commands
+        + predict.commands
+        + nav.commands
+        + import_history.commands
         # + MODULE.commands
         + misc_commands
     )
@@ -114,7 +130,8 @@ def locate_run(output, target, no_newline):
 def locate_add_arguments(parser):
     parser.add_argument(
         'target',
-        choices=['base', 'config', 'db', 'daemon_pid', 'daemon_log'],
+        choices=['base', 'config', 'db', 'daemon_pid', 'daemon_log',
+                 'daemon_socket'],
         help='Name of file to show the path (e.g., config).')
     parser.add_argument(
         '--no-newline', '-n', action='store_true',
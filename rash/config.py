@@ -38,6 +38,7 @@ import os
 
 from .utils.confutils import get_config_directory
 from .utils.pathutils import mkdirp
+from .utils.py3compat import execfile
 
 
 class ConfigStore(object):
@@ -51,8 +52,11 @@ class ConfigStore(object):
       `--* rash/                 # base_path
          |--* daemon.pid         # PID of daemon process
          |--* daemon.log         # Log file for daemon
+         |--* daemon.sock        # Socket to query daemon
          `--* data/              # data_path
             |--* db.sqlite       # db_path ("indexed" record)
+            |--* index.lock      # index_lock_path
+            |--* archive/        # archive_path (e.g., 2012.sqlite)
             `--* record/         # record_path ("raw" record)
                |--* command/     # command log
                `--* init/        # initialization log
@@ -88,6 +92,17 @@ class ConfigStore(object):
         Shell history is stored in the DB at this path.
         """
 
+        self.index_lock_path = os.path.join(self.data_path, 'index.lock')
+        """
+        Lock held by the process importing records into the DB.
+        """
+
+        self.archive_path = os.path.join(self.data_path, 'archive')
+        """
+        Old commands are moved to DBs in this directory by
+        ``rash archive``.  See :mod:`rash.archive`.
+        """
+
         self.daemon_pid_path = os.path.join(self.base_path, 'daemon.pid')
         """
         A file to store daemon PID (``~/.config/rash/daemon.pid``).
@@ -98,6 +113,11 @@ class ConfigStore(object):
         Daemon log file (``~/.config/rash/daemon.log``).
         """
 
+        self.daemon_socket_path = os.path.join(self.base_path, 'daemon.sock')
+        """
+        Unix domain socket served by daemon (``~/.config/rash/daemon.sock``).
+        """
+
         self.daemon_log_level = 'INFO'  # FIXME: make this configurable
         """
         Daemon log level.
@@ -155,6 +175,8 @@ class Configuration(object):
     |isearch.query|             Default isearch query.
     |isearch.query_template|    Transform default query.
     |isearch.base_query|        Default isearch base query.
+    |maintenance.interval|      Interval of DB maintenance by daemon.
+    |retention.max_age|         Forget commands older than this.
     =========================== ===========================================
 
     .. |record.environ| replace::
@@ -169,6 +191,10 @@ class Configuration(object):
        :attr:`config.isearch.query_template <ISearchConfig.query_template>`
     .. |isearch.base_query| replace::
        :attr:`config.isearch.base_query <ISearchConfig.base_query>`
+    .. |maintenance.interval| replace::
+       :attr:`config.maintenance.interval <MaintenanceConfig.interval>`
+    .. |retention.max_age| replace::
+       :attr:`config.retention.max_age <RetentionConfig.max_age>`
 
     """
 
@@ -176,6 +202,8 @@ class Configuration(object):
         self.record = RecordConfig()
         self.search = SearchConfig()
         self.isearch = ISearchConfig()
+        self.maintenance = MaintenanceConfig()
+        self.retention = RetentionConfig()
 
 
 class RecordConfig(object):
@@ -322,3 +350,85 @@ class ISearchConfig(object):
         """
         Set default value (list of str) for ``--base-query`` option.
         """
+
+
+class MaintenanceConfig(object):
+
+    """
+    Configure DB maintenance run by the daemon when it is idle.
+
+    See ``rash maintain --help`` for the tasks.  The budgets here are
+    for the daemon; ``rash maintain`` runs tasks without limit unless
+    options are given.
+
+    """
+
+    def __init__(self):
+
+        self.interval = 3600
+        """
+        Run maintenance at most once in this many seconds.
+
+        Set it to 0 or None to disable maintenance by the daemon.
+
+        """
+
+        self.idle = 60
+        """
+        Run maintenance only when nothing is indexed in this many seconds.
+        """
+
+        self.tasks = ['analyze', 'optimize', 'vacuum', 'checkpoint']
+        """
+        Tasks to run.  Integrity check (``'check'``) is not run by default.
+        """
+
+        self.time_budget = 10.0
+        """
+        Do not start the next task after this many seconds.
+        """
+
+        self.analysis_limit = 1000
+        """
+        Approximate number of rows to scan per index by ``ANALYZE``.
+        """
+
+        self.vacuum_pages = 1000
+        """
+        Maximum number of free pages to reclaim at once.
+
+        A DB created before RASH used incremental vacuum needs a full
+        ``VACUUM``, which is not done by the daemon.  Run ``rash
+        maintain vacuum`` once for such DB.
+
+        """
+
+
+class RetentionConfig(object):
+
+    """
+    Configure how long commands are kept in the DB.
+
+    By default, commands are kept forever.  The policy is applied by
+    the daemon together with DB maintenance (see
+    :class:`MaintenanceConfig`) and by ``rash forget --retention``.
+
+    Example:
+
+    >>> config = Configuration()
+    >>> config.retention.max_age = 365 * 2
+    >>> config.retention.max_count = 500000
+
+    """
+
+    def __init__(self):
+
+        self.max_age = None
+        """
+        Forget commands older than this number of days.
+        """
+
+        self.max_count = None
+        """
+        Forget commands except for the newest this number of commands.
+        """
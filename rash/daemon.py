@@ -18,7 +18,8 @@ import os
 
 
 def daemon_run(no_error, restart, record_path, keep_json, check_duplicate,
-               use_polling, log_level):
+               use_polling, poll_interval, max_poll_interval, log_level,
+               status, status_format):
     """
     Run RASH index daemon.
 
@@ -46,67 +47,110 @@ def daemon_run(no_error, restart, record_path, keep_json, check_duplicate,
       # Refresh RASH DB every 10 minutes
       */10 * * * * rash index
 
+    To see how the running daemon is doing (records indexed, commit
+    latency, lag from record to commit and number of records waiting
+    for indexing), use `--status`.  It prints metrics in JSON or in
+    Prometheus text format (`--status-format prometheus`).
+
+    When the daemon is idle, it runs DB maintenance (see ``rash
+    maintain --help``) within the budget configured by
+    ``config.maintenance`` in the configuration file.  It also
+    forgets commands expired by ``config.retention`` (see ``rash
+    forget --help``).
+
     """
-    # Probably it makes sense to use this daemon to provide search
-    # API, so that this daemon is going to be the only process that
-    # is connected to the DB?
+    # The daemon also serves query API (see ./server.py).  Probably it
+    # makes sense to move search API there, so that this daemon is
+    # going to be the only process that is connected to the DB?
     from .config import ConfigStore
     from .indexer import Indexer
     from .log import setup_daemon_log_file, LogForTheFuture
     from .watchrecord import watch_record, install_sigterm_handler
+    from .server import start_server
+    from .maintain import IdleMaintainer
+    from .utils.lockfile import FileLock
 
-    install_sigterm_handler()
     cfstore = ConfigStore()
+    if status:
+        print_daemon_status(cfstore, status_format)
+        return
+
+    install_sigterm_handler()
     if log_level:
         cfstore.daemon_log_level = log_level
     flogger = LogForTheFuture()
 
-    # SOMEDAY: make PID checking/writing atomic if possible
-    flogger.debug('Checking old PID file %r.', cfstore.daemon_pid_path)
-    if os.path.exists(cfstore.daemon_pid_path):
-        flogger.debug('Old PID file exists.  Reading from it.')
-        with open(cfstore.daemon_pid_path, 'rt') as f:
-            pid = int(f.read().strip())
-        flogger.debug('Checking if old process with PID=%d is alive', pid)
-        try:
-            os.kill(pid, 0)     # check if `pid` is alive
-        except OSError:
-            flogger.info(
-                'Process with PID=%d is already dead.  '
-                'So just go on and use this daemon.', pid)
-        else:
-            if restart:
-                flogger.info('Stopping old daemon with PID=%d.', pid)
-                stop_running_daemon(cfstore, pid)
-            elif not no_error:
-                raise RuntimeError(
-                    'There is already a running daemon (PID={0})!'.format(pid))
+    # The PID file is locked by the running daemon, so that checking
+    # and writing it is atomic.
+    daemon_lock = FileLock(cfstore.daemon_pid_path)
+    flogger.debug('Locking PID file %r.', cfstore.daemon_pid_path)
+    if not daemon_lock.acquire(blocking=False):
+        pid = int(daemon_lock.read().strip() or 0)
+        if restart:
             flogger.info('Stopping old daemon with PID=%d.', pid)
-    else:
-        flogger.debug('Daemon PID file %r does not exists.  '
-                      'So just go on and use this daemon.',
-                      cfstore.daemon_pid_path)
-
-    with open(cfstore.daemon_pid_path, 'w') as f:
-        f.write(str(os.getpid()))
-
+            stop_running_daemon(cfstore, pid, daemon_lock)
+        elif no_error:
+            flogger.info('There is already a running daemon (PID=%d).  '
+                         'Exiting.', pid)
+            return
+        else:
+            raise RuntimeError(
+                'There is already a running daemon (PID={0})!'.format(pid))
+    daemon_lock.write(str(os.getpid()))
+
+    # The daemon is the leader of the processes writing to the DB.
+    # `rash index` hands records to the daemon while it holds the
+    # index lock (see :meth:`DaemonAPI.api_index`) and `catch_up`
+    # leaves them to the daemon.
+    index_lock = FileLock(cfstore.index_lock_path)
     try:
         setup_daemon_log_file(cfstore)
         flogger.dump()
+        index_lock.acquire()
         indexer = Indexer(cfstore, check_duplicate, keep_json, record_path)
-        indexer.index_all()
-        watch_record(indexer, use_polling)
+        config = cfstore.get_config()
+        maintainer = IdleMaintainer(indexer, config.maintenance,
+                                    config.retention)
+        server = start_server(cfstore, indexer, maintainer)
+        try:
+            maintainer.start()
+            indexer.index_all()
+            watch_record(indexer, use_polling,
+                         interval=poll_interval,
+                         max_interval=max_poll_interval)
+        finally:
+            maintainer.stop()
+            server.stop()
     finally:
-        os.remove(cfstore.daemon_pid_path)
+        index_lock.release()
+        daemon_lock.release(remove=True)
+
+
+def print_daemon_status(cfstore, format):
+    import json
+    import socket
+    from .server import call_daemon
+    try:
+        status = call_daemon(cfstore, 'status', format=format)
+    except socket.error:
+        raise RuntimeError('RASH daemon is not running.')
+    if format == 'json':
+        print(json.dumps(status, indent=2, sort_keys=True))
+    else:
+        print(status.rstrip('\n'))
 
 
-def stop_running_daemon(cfstore, pid):
+def stop_running_daemon(cfstore, pid, daemon_lock):
+    """
+    Stop daemon process `pid` and acquire `daemon_lock` instead.
+    """
     import time
     import signal
-    os.kill(pid, signal.SIGTERM)
+    if pid:
+        os.kill(pid, signal.SIGTERM)
     for _ in range(30):
         time.sleep(0.1)
-        if not os.path.exists(cfstore.daemon_pid_path):
+        if daemon_lock.acquire(blocking=False):
             break
     else:
         raise RuntimeError(
@@ -168,8 +212,29 @@ def daemon_add_arguments(parser):
         help="""
         Use polling instead of system specific notification.
         This is useful, for example, when your $HOME is on NFS where
-        inotify does not work.
+        inotify does not work.  Only the record directories are
+        polled and files are not stat'ed, so it scales to many
+        JSON files.
+        """)
+    parser.add_argument(
+        '--poll-interval', default=1.0, type=float,
+        help="""
+        polling interval in seconds when new records are coming.
         """)
+    parser.add_argument(
+        '--max-poll-interval', default=30.0, type=float,
+        help="""
+        polling interval is doubled when no new record is found,
+        up to this value.
+        """)
+    parser.add_argument(
+        '--status', default=False, action='store_true',
+        help="""
+        print metrics of the running daemon and exit.
+        """)
+    parser.add_argument(
+        '--status-format', default='json', choices=['json', 'prometheus'],
+        help='output format of --status.')
     parser.add_argument(
         '--log-level',
         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
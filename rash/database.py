@@ -16,19 +16,658 @@
 
 import os
 import re
+import sys
+import json
+import hashlib
 import sqlite3
 from contextlib import closing, contextmanager
 import datetime
+import time
 import warnings
 import itertools
+import threading
 
-from .utils.py3compat import zip_longest
+from .utils.py3compat import zip_longest, unichr
 from .utils.iterutils import nonempty, include_before, include_after, \
-    include_context
+    include_context, chunks
 from .utils.sqlconstructor import SQLConstructor
 from .model import CommandRecord, SessionRecord, VersionRecord, EnvironRecord
 
-schema_version = '0.1'
+schema_version = '0.9'
+
+migrations = [
+    ('0.2', [
+        """
+        CREATE TABLE IF NOT EXISTS command_usage (
+          command_id INTEGER PRIMARY KEY,
+          use_count INTEGER NOT NULL DEFAULT 0,
+          last_used TIMESTAMP,
+          FOREIGN KEY(command_id) REFERENCES command_list(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS command_directory_usage (
+          command_id INTEGER NOT NULL,
+          directory_id INTEGER NOT NULL,
+          use_count INTEGER NOT NULL DEFAULT 0,
+          last_used TIMESTAMP,
+          PRIMARY KEY(command_id, directory_id),
+          FOREIGN KEY(command_id) REFERENCES command_list(id),
+          FOREIGN KEY(directory_id) REFERENCES directory_list(id)
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO command_usage
+            (command_id, use_count, last_used)
+        SELECT command_id, COUNT(*), MAX(COALESCE(start_time, stop_time))
+        FROM command_history
+        WHERE command_id IS NOT NULL
+        GROUP BY command_id
+        """,
+        """
+        INSERT OR REPLACE INTO command_directory_usage
+            (command_id, directory_id, use_count, last_used)
+        SELECT command_id, directory_id, COUNT(*),
+               MAX(COALESCE(start_time, stop_time))
+        FROM command_history
+        WHERE command_id IS NOT NULL AND directory_id IS NOT NULL
+        GROUP BY command_id, directory_id
+        """,
+    ]),
+    ('0.3', [
+        """
+        CREATE INDEX IF NOT EXISTS command_history_session_start
+        ON command_history(session_id, start_time)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS command_transition (
+          prev_command_id INTEGER NOT NULL,
+          next_command_id INTEGER NOT NULL,
+          use_count INTEGER NOT NULL DEFAULT 0,
+          last_used TIMESTAMP,
+          PRIMARY KEY(prev_command_id, next_command_id),
+          FOREIGN KEY(prev_command_id) REFERENCES command_list(id),
+          FOREIGN KEY(next_command_id) REFERENCES command_list(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS command_directory_transition (
+          prev_command_id INTEGER NOT NULL,
+          next_command_id INTEGER NOT NULL,
+          directory_id INTEGER NOT NULL,
+          use_count INTEGER NOT NULL DEFAULT 0,
+          last_used TIMESTAMP,
+          PRIMARY KEY(prev_command_id, next_command_id, directory_id),
+          FOREIGN KEY(prev_command_id) REFERENCES command_list(id),
+          FOREIGN KEY(next_command_id) REFERENCES command_list(id),
+          FOREIGN KEY(directory_id) REFERENCES directory_list(id)
+        )
+        """,
+        """
+        CREATE TEMPORARY TABLE transition_backfill AS
+        SELECT P.command_id AS prev_command_id,
+               N.command_id AS next_command_id,
+               N.directory_id AS directory_id,
+               N.start_time AS start_time
+        FROM command_history AS N
+        JOIN command_history AS P ON P.id = (
+            SELECT id FROM command_history
+            WHERE session_id = N.session_id AND command_id IS NOT NULL AND
+                  (start_time < N.start_time OR
+                   (start_time = N.start_time AND id < N.id))
+            ORDER BY start_time DESC, id DESC
+            LIMIT 1)
+        WHERE N.session_id IS NOT NULL AND N.command_id IS NOT NULL AND
+              N.start_time IS NOT NULL
+        """,
+        """
+        INSERT OR REPLACE INTO command_transition
+            (prev_command_id, next_command_id, use_count, last_used)
+        SELECT prev_command_id, next_command_id, COUNT(*), MAX(start_time)
+        FROM transition_backfill
+        GROUP BY prev_command_id, next_command_id
+        """,
+        """
+        INSERT OR REPLACE INTO command_directory_transition
+            (prev_command_id, next_command_id, directory_id,
+             use_count, last_used)
+        SELECT prev_command_id, next_command_id, directory_id,
+               COUNT(*), MAX(start_time)
+        FROM transition_backfill
+        WHERE directory_id IS NOT NULL
+        GROUP BY prev_command_id, next_command_id, directory_id
+        """,
+        "DROP TABLE transition_backfill",
+    ]),
+    ('0.4', [
+        """
+        CREATE INDEX IF NOT EXISTS command_history_directory
+        ON command_history(directory_id, id)
+        """,
+    ]),
+    ('0.5', [
+        lambda db: add_column(db, 'command_history', 'fingerprint', 'TEXT'),
+        """
+        UPDATE command_history SET fingerprint = FINGERPRINT(
+          (SELECT command FROM command_list WHERE id = command_id),
+          (SELECT directory FROM directory_list WHERE id = directory_id),
+          (SELECT terminal FROM terminal_list WHERE id = terminal_id),
+          start_time, stop_time, exit_code)
+        """,
+        # Only the first one of the duplicates has fingerprint:
+        """
+        UPDATE command_history SET fingerprint = NULL
+        WHERE id NOT IN (
+          SELECT MIN(id) FROM command_history GROUP BY fingerprint)
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS command_history_fingerprint
+        ON command_history(fingerprint)
+        """,
+    ]),
+    ('0.6', [
+        """
+        CREATE TABLE IF NOT EXISTS indexed_file (
+          path TEXT PRIMARY KEY,
+          size INTEGER,
+          mtime REAL
+        )
+        """,
+    ]),
+    ('0.7', [
+        """
+        CREATE TABLE IF NOT EXISTS environment_set (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          digest TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS environment_set_map (
+          es_id INTEGER NOT NULL,
+          ev_id INTEGER NOT NULL,
+          PRIMARY KEY(es_id, ev_id),
+          FOREIGN KEY(es_id) REFERENCES environment_set(id),
+          FOREIGN KEY(ev_id) REFERENCES environment_variable(id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS environment_variable_name_value
+        ON environment_variable(variable_name, variable_value)
+        """,
+        lambda db: add_column(db, 'command_history', 'environment_set_id',
+                              'INTEGER REFERENCES environment_set(id)'),
+        lambda db: intern_command_environment_map(db),
+    ]),
+    ('0.8', [
+        """
+        CREATE INDEX IF NOT EXISTS session_environment_map_sh_id
+        ON session_environment_map(sh_id)
+        """,
+        lambda db: rebase_all_sessions(db),
+    ]),
+    ('0.9', [
+        lambda db: add_column(db, 'command_history', 'pipestatus', 'TEXT'),
+        lambda db: pack_pipe_status_map(db),
+    ]),
+]
+"""
+List of ``(schema_version, [sql, ...])`` to upgrade old DB.
+Instead of SQL, a function which takes a connection can be used.
+"""
+
+
+def add_column(db, table, column, decl):
+    """
+    Add `column` to `table` unless it already exists.
+    """
+    columns = [row[1] for row in db.execute(
+        'PRAGMA table_info({0})'.format(table))]
+    if column not in columns:
+        db.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+            table, column, decl))
+
+
+def environ_digest(environ):
+    """
+    Return a hash of `environ` (a dict) which does not depend on order.
+
+    >>> (environ_digest({'A': '1', 'B': '2'}) ==
+    ...  environ_digest({'B': '2', 'A': '1'}))
+    True
+
+    """
+    data = json.dumps(sorted(environ.items()))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def intern_environ(db, environ):
+    """
+    Return ID of the ``environment_set`` row for `environ`.
+
+    A set of environment variables is stored only once and shared by
+    all commands run with it.  Return None if `environ` is empty.
+
+    """
+    environ = dict((k, v) for (k, v) in (environ or {}).items()
+                   if k is not None and v is not None)
+    if not environ:
+        return None
+    digest = environ_digest(environ)
+    for (es_id,) in db.execute(
+            'SELECT id FROM environment_set WHERE digest = ?', [digest]):
+        return es_id
+    es_id = db.execute('INSERT INTO environment_set (digest) VALUES (?)',
+                       [digest]).lastrowid
+    for (name, value) in environ.items():
+        ev_id = None
+        for (ev_id,) in db.execute(
+                'SELECT id FROM environment_variable '
+                'WHERE variable_name = ? AND variable_value = ? LIMIT 1',
+                [name, value]):
+            pass
+        if ev_id is None:
+            ev_id = db.execute(
+                'INSERT INTO environment_variable '
+                '(variable_name, variable_value) VALUES (?, ?)',
+                [name, value]).lastrowid
+        db.execute('INSERT OR IGNORE INTO environment_set_map (es_id, ev_id) '
+                   'VALUES (?, ?)', [es_id, ev_id])
+    return es_id
+
+
+def environ_delta(environ, baseline):
+    """
+    Return variables in `environ` whose values differ from `baseline`.
+
+    >>> environ_delta({'PATH': '/bin', 'PWD': '/tmp'}, {'PATH': '/bin'})
+    {'PWD': '/tmp'}
+
+    """
+    return dict((k, v) for (k, v) in (environ or {}).items()
+                if baseline.get(k) != v)
+
+
+def select_environment_set(db, es_id):
+    return dict(db.execute(
+        """
+        SELECT EV.variable_name, EV.variable_value
+        FROM environment_set_map
+        JOIN environment_variable AS EV ON ev_id = EV.id
+        WHERE es_id = ?
+        """, [es_id]))
+
+
+def select_session_environ(db, sh_id):
+    return dict(db.execute(
+        """
+        SELECT EV.variable_name, EV.variable_value
+        FROM session_environment_map
+        JOIN environment_variable AS EV ON ev_id = EV.id
+        WHERE sh_id = ?
+        """, [sh_id]))
+
+
+def rebase_session_commands(db, sh_id, old, new):
+    """
+    Re-encode environ of commands in session `sh_id` against `new`.
+
+    Environ of a command is stored as a delta against the environ of
+    its session (the "baseline").  When the baseline changes from
+    `old` to `new`, the deltas are recomputed so that the environ
+    seen by :meth:`DataBase.get_full_command_record` does not change.
+
+    Environment sets no command refers to after the rebase are
+    deleted in the same transaction.
+
+    """
+    rebased = {}
+    updates = []
+    for (ch_id, es_id) in list(db.execute(
+            'SELECT id, environment_set_id FROM command_history '
+            'WHERE session_id = ?', [sh_id])):
+        if es_id not in rebased:
+            environ = dict(old)
+            if es_id is not None:
+                environ.update(select_environment_set(db, es_id))
+            rebased[es_id] = intern_environ(db, environ_delta(environ, new))
+        if rebased[es_id] != es_id:
+            updates.append((rebased[es_id], ch_id))
+    db.executemany(
+        'UPDATE command_history SET environment_set_id = ? WHERE id = ?',
+        updates)
+    replaced = [es_id for (es_id, new_id) in rebased.items()
+                if es_id is not None and new_id != es_id]
+    for ids in chunks(replaced, 500):
+        DataBase._delete_unused(
+            db, 'environment_set',
+            """
+            SELECT id FROM environment_set WHERE id IN ({0})
+            EXCEPT SELECT environment_set_id FROM command_history
+            """.format(', '.join('?' * len(ids))), ids)
+
+
+def rebase_all_sessions(db):
+    """
+    Drop command variables which are the same as the session's.
+    """
+    for (sh_id,) in list(db.execute(
+            'SELECT DISTINCT sh_id FROM session_environment_map')):
+        rebase_session_commands(
+            db, sh_id, {}, select_session_environ(db, sh_id))
+
+
+def intern_command_environment_map(db):
+    """
+    Move ``command_environment_map`` rows to environment sets.
+    """
+    rows = db.execute(
+        """
+        SELECT ch_id, EV.variable_name, EV.variable_value
+        FROM command_environment_map
+        JOIN environment_variable AS EV ON ev_id = EV.id
+        ORDER BY ch_id
+        """).fetchall()
+    updates = []
+    for (ch_id, group) in itertools.groupby(rows, lambda row: row[0]):
+        environ = dict((name, value) for (_, name, value) in group)
+        updates.append((intern_environ(db, environ), ch_id))
+    db.executemany(
+        'UPDATE command_history SET environment_set_id = ? WHERE id = ?',
+        updates)
+    db.execute('DELETE FROM command_environment_map')
+
+
+def pack_pipestatus(pipestatus):
+    """
+    Pack a list of exit codes into a string stored in DB.
+
+    Unknown exit codes (None) are stored as ``-`` so that a list of
+    a single None is not packed to an empty string.
+
+    >>> pack_pipestatus([0, 1, None])
+    '0,1,-'
+    >>> pack_pipestatus([None])
+    '-'
+    >>> pack_pipestatus([]) is None
+    True
+    >>> unpack_pipestatus(pack_pipestatus([0, 1, None]))
+    [0, 1, None]
+    >>> unpack_pipestatus(pack_pipestatus([None]))
+    [None]
+    >>> unpack_pipestatus(None)
+    []
+
+    """
+    if not pipestatus:
+        return None
+    return ','.join('-' if code is None else str(code) for code in pipestatus)
+
+
+def unpack_pipestatus(packed):
+    """
+    Unpack a string made by :func:`pack_pipestatus`.
+
+    Empty fields written by older versions are read as None.
+
+    >>> unpack_pipestatus('0,,1')
+    [0, None, 1]
+
+    """
+    if not packed:
+        return []
+    return [None if code in ('', '-') else int(code)
+            for code in packed.split(',')]
+
+
+def pack_pipe_status_map(db):
+    """
+    Move ``pipe_status_map`` rows to ``command_history.pipestatus``.
+    """
+    rows = db.execute("""
+    SELECT ch_id, program_position, exit_code FROM pipe_status_map
+    ORDER BY ch_id
+    """)
+    updates = []
+    for (ch_id, group) in itertools.groupby(rows, lambda r: r[0]):
+        group = list(group)
+        pipestatus = [None] * (max(r[1] for r in group) + 1)
+        for (_, i, code) in group:
+            pipestatus[i] = code
+        updates.append((pack_pipestatus(pipestatus), ch_id))
+    db.executemany(
+        'UPDATE command_history SET pipestatus = ? WHERE id = ?', updates)
+    db.execute('DELETE FROM pipe_status_map')
+
+
+USAGE_TABLES = [
+    'command_usage', 'command_directory_usage',
+    'command_transition', 'command_directory_transition',
+]
+"""
+Tables of use counts derived from ``command_history``.
+"""
+
+GARBAGE_QUERIES = [
+    ('command_list', """
+    SELECT id FROM command_list
+    EXCEPT SELECT command_id FROM command_history
+    """),
+    ('directory_list', """
+    SELECT id FROM directory_list
+    EXCEPT SELECT directory_id FROM command_history
+    """),
+    ('terminal_list', """
+    SELECT id FROM terminal_list
+    EXCEPT SELECT terminal_id FROM command_history
+    """),
+    ('environment_set', """
+    SELECT id FROM environment_set
+    EXCEPT SELECT environment_set_id FROM command_history
+    """),
+    ('environment_variable', """
+    SELECT id FROM environment_variable
+    EXCEPT SELECT ev_id FROM environment_set_map
+    EXCEPT SELECT ev_id FROM session_environment_map
+    EXCEPT SELECT ev_id FROM command_environment_map
+    """),
+]
+"""
+``(table, sql)`` where `sql` selects IDs of rows in `table` not
+referred from anywhere.  `environment_set` must come before
+`environment_variable`, as deleting a set makes its variables free.
+"""
+
+GARBAGE_REFERENCES = {
+    'command_list': [
+        ('command_usage', 'command_id'),
+        ('command_directory_usage', 'command_id'),
+        ('command_transition', 'prev_command_id'),
+        ('command_transition', 'next_command_id'),
+        ('command_directory_transition', 'prev_command_id'),
+        ('command_directory_transition', 'next_command_id'),
+    ],
+    'directory_list': [
+        ('command_directory_usage', 'directory_id'),
+        ('command_directory_transition', 'directory_id'),
+    ],
+    'environment_set': [
+        ('environment_set_map', 'es_id'),
+    ],
+    'session_history': [
+        ('session_environment_map', 'sh_id'),
+    ],
+}
+"""
+Derived rows to be deleted together with the garbage.
+"""
+
+
+TRANSITION_SQL = """
+SELECT P.command_id AS prev_command_id,
+       N.command_id AS next_command_id,
+       N.directory_id AS directory_id,
+       N.start_time AS last_used
+FROM command_history AS N
+JOIN command_history AS P ON P.id = (
+    SELECT id FROM command_history
+    WHERE session_id = N.session_id AND command_id IS NOT NULL AND
+          (start_time < N.start_time OR
+           (start_time = N.start_time AND id < N.id))
+    ORDER BY start_time DESC, id DESC
+    LIMIT 1)
+WHERE N.session_id IN (SELECT id FROM temp.{0}) AND
+      N.command_id IS NOT NULL AND N.start_time IS NOT NULL
+"""
+"""
+Command transitions in the sessions listed in a temporary table.
+This is the same as the one used to migrate DB to schema version 0.3.
+"""
+
+
+def max_id(db, table):
+    ((value,),) = db.execute('SELECT MAX(id) FROM main.{0}'.format(table))
+    return value or 0
+
+
+def select_transitions(db, name, sessions):
+    """
+    Store transitions in `sessions` in a temporary table `name`.
+    """
+    db.execute('DROP TABLE IF EXISTS temp.{0}'.format(name))
+    db.execute('CREATE TEMP TABLE {0} AS {1}'.format(
+        name, TRANSITION_SQL.format(sessions)))
+
+
+def add_usage_counts(db, table, keys, delta):
+    """
+    Add ``n`` and ``last_used`` in temporary table `delta` to `table`.
+
+    `table` is one of :data:`USAGE_TABLES` identified by `keys`.
+    Rows whose count becomes zero are deleted.
+
+    """
+    columns = ', '.join(keys)
+    match = ' AND '.join('D.{0} = {1}.{0}'.format(k, table) for k in keys)
+    not_null = ' AND '.join('{0} IS NOT NULL'.format(k) for k in keys)
+    # Sum up the delta into a table indexed by `keys` first, so that
+    # the correlated subqueries below are lookups rather than scans.
+    db.execute('DROP TABLE IF EXISTS temp.usage_counts')
+    db.execute(
+        """
+        CREATE TEMP TABLE usage_counts (
+          {0}, n INTEGER, last_used TIMESTAMP, PRIMARY KEY ({1}))
+        """.format(', '.join(k + ' INTEGER' for k in keys), columns))
+    db.execute(
+        """
+        INSERT INTO temp.usage_counts
+        SELECT {0}, SUM(n), MAX(last_used) FROM temp.{1}
+        WHERE {2} GROUP BY {0}
+        """.format(columns, delta, not_null))
+    db.execute(
+        """
+        INSERT OR IGNORE INTO main.{0} ({1}, use_count)
+        SELECT {1}, 0 FROM temp.usage_counts
+        """.format(table, columns))
+    last_used = ('(SELECT D.last_used FROM temp.usage_counts AS D '
+                 'WHERE {0})'.format(match))
+    db.execute(
+        """
+        UPDATE main.{0} SET
+          use_count = use_count +
+            (SELECT D.n FROM temp.usage_counts AS D WHERE {1}),
+          last_used = COALESCE(MAX(last_used, {2}), last_used, {2})
+        WHERE EXISTS (SELECT 1 FROM temp.usage_counts AS D WHERE {1})
+        """.format(table, match, last_used))
+    db.execute('DELETE FROM main.{0} WHERE use_count <= 0'.format(table))
+    db.execute('DROP TABLE temp.usage_counts')
+
+
+def count_new_commands(db, last_ch_id, sessions, before):
+    """
+    Update :data:`USAGE_TABLES` for commands inserted after `last_ch_id`.
+
+    `sessions` is a temporary table of the IDs of the sessions getting
+    the new commands and `before` is the temporary table made by
+    :func:`select_transitions` before inserting them.  Transitions in
+    the sessions are counted again and the differences are applied,
+    as the new commands may be inserted between old ones.  Temporary
+    table `before` is dropped.
+
+    """
+    db.execute('DROP TABLE IF EXISTS temp.usage_delta')
+    db.execute(
+        """
+        CREATE TEMP TABLE usage_delta AS
+        SELECT command_id, directory_id, COUNT(*) AS n,
+               MAX(COALESCE(start_time, stop_time)) AS last_used
+        FROM main.command_history WHERE id > ?
+        GROUP BY command_id, directory_id
+        """, [last_ch_id])
+    add_usage_counts(db, 'command_usage', ['command_id'], 'usage_delta')
+    add_usage_counts(db, 'command_directory_usage',
+                     ['command_id', 'directory_id'], 'usage_delta')
+
+    select_transitions(db, 'transition_after', sessions)
+    db.execute('DROP TABLE IF EXISTS temp.transition_delta')
+    db.execute(
+        """
+        CREATE TEMP TABLE transition_delta AS
+        SELECT prev_command_id, next_command_id, directory_id,
+               1 AS n, last_used
+        FROM temp.transition_after
+        UNION ALL
+        SELECT prev_command_id, next_command_id, directory_id,
+               -1 AS n, NULL AS last_used
+        FROM temp.{0}
+        """.format(before))
+    add_usage_counts(db, 'command_transition',
+                     ['prev_command_id', 'next_command_id'],
+                     'transition_delta')
+    add_usage_counts(db, 'command_directory_transition',
+                     ['prev_command_id', 'next_command_id', 'directory_id'],
+                     'transition_delta')
+    for table in ['usage_delta', 'transition_after', 'transition_delta',
+                  before]:
+        db.execute('DROP TABLE temp.{0}'.format(table))
+
+
+IMPORT_DICTIONARY_TABLES = [
+    ('command_list', 'command'),
+    ('directory_list', 'directory'),
+    ('terminal_list', 'terminal'),
+    ('session_history', 'session_long_id'),
+]
+"""
+``(table, column)`` of rows referred by commands imported by
+:meth:`DataBase.import_dicts`.
+"""
+
+
+def version_tuple(version):
+    """
+    Convert version string to a tuple of int.
+
+    >>> version_tuple('0.2')
+    (0, 2)
+    >>> version_tuple('0.10') > version_tuple('0.9')
+    True
+
+    """
+    return tuple(map(int, version.split('.')))
+
+
+def schema_user_version(version):
+    """
+    Encode schema `version` as an integer for ``PRAGMA user_version``.
+
+    >>> schema_user_version('0.9')
+    9
+    >>> schema_user_version('1.2')
+    1002
+
+    """
+    (major, minor) = version_tuple(version)[:2]
+    return major * 1000 + minor
 
 
 def convert_ts(ts):
@@ -49,6 +688,19 @@ def convert_ts(ts):
     return ts
 
 
+def ts_string(ts):
+    """
+    Convert `ts` returned by :func:`convert_ts` to the string stored in DB.
+
+    >>> ts_string(convert_ts(0))
+    '1970-01-01 00:00:00'
+
+    """
+    if isinstance(ts, datetime.datetime):
+        return ts.isoformat(' ')
+    return ts
+
+
 def normalize_directory(path):
     """
     Append "/" to `path` if needed.
@@ -61,6 +713,80 @@ def normalize_directory(path):
         return path + os.path.sep
 
 
+def prefix_upper_bound(prefix):
+    """
+    Return the smallest string greater than all strings with `prefix`.
+
+    Return None if there is no such string, i.e., all characters of
+    `prefix` are the last code point.
+
+    >>> prefix_upper_bound('git st')
+    'git su'
+    >>> prefix_upper_bound('a' + unichr(sys.maxunicode)) == 'b'
+    True
+    >>> prefix_upper_bound(unichr(sys.maxunicode)) is None
+    True
+
+    """
+    prefix = prefix.rstrip(unichr(sys.maxunicode))
+    if not prefix:
+        return None
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class ParamSlot(object):
+
+    """
+    Placeholder for a search parameter used while compiling SQL.
+
+    See :meth:`DataBase._compile_sql_search_command_record`.
+
+    """
+
+    __slots__ = ['path']
+
+    def __init__(self, *path):
+        self.path = path
+
+    def resolve(self, kwds):
+        value = kwds
+        for key in self.path:
+            value = value[key]
+        return value
+
+    def __repr__(self):
+        return '<{0}: {1}>'.format(self.__class__.__name__,
+                                   '.'.join(map(str, self.path)))
+
+
+def command_fingerprint(command, cwd, terminal, start, stop, exit_code,
+                        origin=None):
+    """
+    Return a hash of the values identifying a command record.
+
+    Arguments must be the values as stored in DB.  For example, `cwd`
+    must be normalized by :func:`normalize_directory`.  `origin` is
+    where the record is imported from (see
+    :func:`rash.import_history.iter_history`).  It is given only for
+    records without timestamps which cannot be told apart otherwise.
+
+    >>> command_fingerprint('ls', '/', None, None, None, 0)
+    '4123e14ac5ea544176d825ea4f7f58932eb4ae12'
+    >>> (command_fingerprint('ls', None, None, None, None, None, 'a:1') ==
+    ...  command_fingerprint('ls', None, None, None, None, None, 'a:2'))
+    False
+
+    """
+    values = [command, cwd, terminal,
+              None if start is None else str(start),
+              None if stop is None else str(stop),
+              exit_code]
+    if origin is not None:
+        values.append(origin)
+    data = json.dumps(values)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
 def sql_regexp_func(expr, item):
     return re.match(expr, item) is not None
 
@@ -108,21 +834,46 @@ class DataBase(object):
     schemapath = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
 
-    def __init__(self, dbpath):
+    cached_statements = 256
+    """
+    Size of per-connection prepared statement cache of :mod:`sqlite3`.
+
+    It must be larger than the number of distinct SQL statements
+    (query shapes) used repeatedly in one session (e.g., isearch).
+
+    """
+
+    def __init__(self, dbpath, readonly=False):
+        """
+        Open DB at `dbpath`.  It is created if it does not exist.
+
+        If `readonly` is true, :meth:`update_version_records` is not
+        called unless the DB needs migration.  The schema version is
+        checked by ``PRAGMA user_version`` instead, which does not
+        need a write transaction.  Note that this does not prevent
+        writing to the DB.
+
+        """
         self.dbpath = dbpath
         if not os.path.exists(dbpath):
             self._init_db()
-        self.update_version_records()
+        if not (readonly and self.is_schema_up_to_date()):
+            self.update_version_records()
 
     def _get_db(self):
         """Returns a new connection to the database."""
-        return closing(sqlite3.connect(self.dbpath))
+        return closing(sqlite3.connect(
+            self.dbpath, cached_statements=self.cached_statements))
 
     def _init_db(self):
         """Creates the database tables."""
         with self._get_db() as db:
+            # This must be set before creating tables.  See also
+            # `rash.maintain.task_vacuum`.
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
             with open(self.schemapath) as f:
                 db.cursor().executescript(f.read())
+            self._set_user_version(db)
             db.commit()
 
     @contextmanager
@@ -152,14 +903,42 @@ class DataBase(object):
                     db.create_function("PROGRAM_NAME", 1,
                                        sql_program_name_func)
                     db.create_function("PATHDIST", 2, sql_pathdist_func)
+                    db.create_function("FINGERPRINT", 6,
+                                       command_fingerprint)
                     yield self._db
                     if self._need_commit:
                         db.commit()
             finally:
                 self._db = None
                 self._need_commit = False
-    _db = None
-    _need_commit = False
+
+    @property
+    def _local(self):
+        # Connection kept by `connection` is per thread, so that a
+        # DataBase instance can be shared by threads (e.g., by
+        # `rash.server.QueryServer`).  This is created lazily as
+        # subclasses may not call `__init__`.
+        local = self.__dict__.get('_thread_local')
+        if local is None:
+            local = self.__dict__.setdefault('_thread_local',
+                                             threading.local())
+        return local
+
+    @property
+    def _db(self):
+        return getattr(self._local, 'db', None)
+
+    @_db.setter
+    def _db(self, db):
+        self._local.db = db
+
+    @property
+    def _need_commit(self):
+        return getattr(self._local, 'need_commit', False)
+
+    @_need_commit.setter
+    def _need_commit(self, value):
+        self._local.need_commit = value
 
     def close_connection(self):
         """
@@ -222,14 +1001,52 @@ class DataBase(object):
         """
         from .__init__ import __version__ as version
         with self.connection(commit=True) as connection:
-            for vrec in self.get_version_records():
+            records = list(self.get_version_records())
+            for vrec in records:
                 if (vrec.rash_version == version and
                     vrec.schema_version == schema_version):
-                    return  # no need to insert the new one!
-            connection.execute(
-                'INSERT INTO rash_info (rash_version, schema_version) '
-                'VALUES (?, ?)',
-                [version, schema_version])
+                    break  # no need to insert the new one!
+            else:
+                if records:
+                    self._migrate(connection, records[0].schema_version)
+                connection.execute(
+                    'INSERT INTO rash_info (rash_version, schema_version) '
+                    'VALUES (?, ?)',
+                    [version, schema_version])
+            if not self.is_schema_up_to_date():
+                self._set_user_version(connection)
+
+    def is_schema_up_to_date(self):
+        """
+        Return true if the DB does not need migration.
+
+        This only reads ``PRAGMA user_version`` which is set by
+        :meth:`update_version_records`.
+
+        """
+        with self.connection() as connection:
+            ((user_version,),) = connection.execute('PRAGMA user_version')
+        return user_version >= schema_user_version(schema_version)
+
+    @staticmethod
+    def _set_user_version(db):
+        db.execute('PRAGMA user_version = {0:d}'.format(
+            schema_user_version(schema_version)))
+
+    @staticmethod
+    def _migrate(db, old_version):
+        """
+        Apply :data:`migrations` newer than `old_version`.
+        """
+        old = version_tuple(old_version)
+        for (version, statements) in migrations:
+            if version_tuple(version) <= old:
+                continue
+            for sql in statements:
+                if callable(sql):
+                    sql(db)
+                else:
+                    db.execute(sql)
 
     def import_json(self, json_path, **kwds):
         import json
@@ -243,34 +1060,327 @@ class DataBase(object):
         self.import_dict(dct, **kwds)
 
     def import_dict(self, dct, check_duplicate=True):
+        """
+        Import a command record given as a dictionary.
+
+        Duplicates are detected by a lookup of the unique index on
+        ``command_history.fingerprint`` (see
+        :func:`command_fingerprint`).  Key ``origin`` of `dct`, if
+        any, is used only for the fingerprint.  When `check_duplicate`
+        is false and the record is a duplicate, it is imported without
+        fingerprint.  Return the ID of the new ``command_history`` row
+        or None if the record is skipped.
+
+        """
         crec = CommandRecord(**dct)
-        if check_duplicate and nonempty(self.select_by_command_record(crec)):
-            return
+        fingerprint = command_fingerprint(
+            crec.command, normalize_directory(crec.cwd), crec.terminal,
+            convert_ts(crec.start), convert_ts(crec.stop), crec.exit_code,
+            dct.get('origin'))
         with self.connection(commit=True) as connection:
             db = connection.cursor()
-            ch_id = self._insert_command_history(db, crec)
-            self._isnert_command_environment(db, ch_id, crec.environ)
-            self._insert_pipe_status(db, ch_id, crec.pipestatus)
+            if self._has_fingerprint(db, fingerprint):
+                if check_duplicate:
+                    return
+                fingerprint = None
+            return self._insert_command_history(db, crec, fingerprint)
+
+    def import_dicts(self, dcts, check_duplicate=True, batch_size=10000):
+        """
+        Import command records in `dcts` in batches.
+
+        `dcts` can be a (lazy) iterator.  Each batch of `batch_size`
+        records is imported and committed at once by
+        :meth:`_import_batch`.  The result is the same as calling
+        :meth:`import_dict` for each record.  Return a pair
+        ``(imported, skipped)`` of the number of records.
+
+        """
+        imported = skipped = 0
+        for batch in chunks(dcts, batch_size):
+            with self.connection(commit=True) as connection:
+                (i, s) = self._import_batch(connection.cursor(), batch,
+                                            check_duplicate)
+            imported += i
+            skipped += s
+        return (imported, skipped)
+
+    def _import_batch(self, db, dcts, check_duplicate):
+        """
+        Import command records in `dcts` by set-based SQL.
+
+        Records are staged in temporary table ``import_batch`` by
+        ``executemany``.  Then duplicates are found by joining on
+        fingerprints, rows of :data:`IMPORT_DICTIONARY_TABLES` are
+        inserted and ``command_history`` rows are inserted by one
+        ``INSERT ... SELECT``.  Only environ is interned row by row,
+        since it is stored as a delta against the session's environ.
+        Usage and transition tables are updated by
+        :func:`count_new_commands`.
+
+        """
+        rows = []
+        environs = {}
+        get_ts = lambda key: ts_string(convert_ts(dct.get(key)))
+        for (seq, dct) in enumerate(dcts):
+            command = dct.get('command')
+            session_id = dct.get('session_id')
+            cwd = normalize_directory(dct.get('cwd'))
+            terminal = dct.get('terminal')
+            start = get_ts('start')
+            stop = get_ts('stop')
+            exit_code = dct.get('exit_code')
+            fingerprint = command_fingerprint(
+                command, cwd, terminal, start, stop, exit_code,
+                dct.get('origin'))
+            rows.append((seq, command, session_id, cwd, terminal,
+                         start, stop, exit_code, fingerprint,
+                         pack_pipestatus(dct.get('pipestatus'))))
+            if dct.get('environ'):
+                environs[seq] = (session_id, dct['environ'])
+        db.execute('DROP TABLE IF EXISTS temp.import_batch')
+        db.execute(
+            """
+            CREATE TEMP TABLE import_batch (
+              seq INTEGER PRIMARY KEY,
+              command TEXT,
+              session_long_id TEXT,
+              directory TEXT,
+              terminal TEXT,
+              start_time TIMESTAMP,
+              stop_time TIMESTAMP,
+              exit_code INTEGER,
+              fingerprint TEXT,
+              pipestatus TEXT,
+              environment_set_id INTEGER
+            )
+            """)
+        db.executemany(
+            'INSERT INTO temp.import_batch VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)', rows)
+        db.execute('CREATE INDEX temp.import_batch_fingerprint '
+                   'ON import_batch(fingerprint)')
+
+        # A record is a duplicate if it is already in DB or it comes
+        # after the same record in the batch.
+        duplicate = """
+        EXISTS (SELECT 1 FROM main.command_history AS H
+                WHERE H.fingerprint = import_batch.fingerprint) OR
+        seq > (SELECT MIN(seq) FROM temp.import_batch AS B
+               WHERE B.fingerprint = import_batch.fingerprint)
+        """
+        if check_duplicate:
+            skipped = db.execute(
+                'DELETE FROM temp.import_batch WHERE ' + duplicate).rowcount
+        else:
+            db.execute('UPDATE temp.import_batch SET fingerprint = NULL '
+                       'WHERE ' + duplicate)
+            skipped = 0
+
+        for (table, column) in IMPORT_DICTIONARY_TABLES:
+            db.execute(
+                """
+                INSERT OR IGNORE INTO main.{0} ({1})
+                SELECT {1} FROM temp.import_batch
+                WHERE {1} IS NOT NULL ORDER BY seq
+                """.format(table, column))
+        if environs:
+            self._intern_batch_environ(db, environs)
+
+        last_ch_id = max_id(db, 'command_history')
+        db.execute('DROP TABLE IF EXISTS temp.import_sessions')
+        db.execute(
+            """
+            CREATE TEMP TABLE import_sessions AS
+            SELECT DISTINCT S.id FROM temp.import_batch AS B
+            JOIN main.session_history AS S
+              ON S.session_long_id = B.session_long_id
+            """)
+        select_transitions(db, 'import_transition_before', 'import_sessions')
+        imported = db.execute(
+            """
+            INSERT INTO main.command_history
+              (command_id, session_id, directory_id, terminal_id,
+               start_time, stop_time, exit_code, fingerprint,
+               environment_set_id, pipestatus)
+            SELECT C.id, S.id, D.id, T.id,
+                   B.start_time, B.stop_time, B.exit_code, B.fingerprint,
+                   B.environment_set_id, B.pipestatus
+            FROM temp.import_batch AS B
+            LEFT JOIN main.command_list AS C ON C.command = B.command
+            LEFT JOIN main.session_history AS S
+              ON S.session_long_id = B.session_long_id
+            LEFT JOIN main.directory_list AS D ON D.directory = B.directory
+            LEFT JOIN main.terminal_list AS T ON T.terminal = B.terminal
+            ORDER BY B.seq
+            """).rowcount
+        count_new_commands(db, last_ch_id, 'import_sessions',
+                           'import_transition_before')
+        db.execute('DROP TABLE temp.import_sessions')
+        db.execute('DROP TABLE temp.import_batch')
+        return (imported, skipped)
+
+    @staticmethod
+    def _intern_batch_environ(db, environs):
+        """
+        Set ``environment_set_id`` of records in ``temp.import_batch``.
+
+        :type environs: dict
+        :arg  environs: map ``seq`` to ``(session_long_id, environ)``
+
+        """
+        staged = set(seq for (seq,) in db.execute(
+            'SELECT seq FROM temp.import_batch'))
+        sh_ids = dict(db.execute(
+            """
+            SELECT session_long_id, id FROM main.session_history
+            WHERE session_long_id IN
+              (SELECT session_long_id FROM temp.import_batch)
+            """))
+        baselines = {}
+        updates = []
+        for seq in sorted(staged.intersection(environs)):
+            (long_id, environ) = environs[seq]
+            sh_id = sh_ids.get(long_id)
+            if sh_id is not None:
+                if sh_id not in baselines:
+                    baselines[sh_id] = select_session_environ(db, sh_id)
+                environ = environ_delta(environ, baselines[sh_id])
+            updates.append((intern_environ(db, environ), seq))
+        db.executemany(
+            'UPDATE temp.import_batch SET environment_set_id = ? '
+            'WHERE seq = ?', updates)
 
-    def _insert_command_history(self, db, crec):
+    @staticmethod
+    def _has_fingerprint(db, fingerprint):
+        return nonempty(db.execute(
+            'SELECT 1 FROM command_history WHERE fingerprint = ?',
+            [fingerprint]))
+
+    def _insert_command_history(self, db, crec, fingerprint=None):
         command_id = self._get_maybe_new_command_id(db, crec.command)
         session_id = self._get_maybe_new_session_id(db, crec.session_id)
         directory_id = self._get_maybe_new_directory_id(db, crec.cwd)
         terminal_id = self._get_maybe_new_terminal_id(db, crec.terminal)
+        environ = crec.environ
+        if environ and session_id is not None:
+            # Store only the variables differ from the session's
+            # baseline.  See also: `rebase_session_commands`.
+            environ = environ_delta(
+                environ, select_session_environ(db, session_id))
+        environment_set_id = intern_environ(db, environ)
+        start = convert_ts(crec.start)
+        stop = convert_ts(crec.stop)
         db.execute(
             '''
             INSERT INTO command_history
                 (command_id, session_id, directory_id, terminal_id,
-                 start_time, stop_time, exit_code)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+                 start_time, stop_time, exit_code, fingerprint,
+                 environment_set_id, pipestatus)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''',
             [command_id, session_id, directory_id, terminal_id,
-             convert_ts(crec.start), convert_ts(crec.stop), crec.exit_code])
-        return db.lastrowid
+             start, stop, crec.exit_code, fingerprint, environment_set_id,
+             pack_pipestatus(crec.pipestatus)])
+        ch_id = db.lastrowid
+        self._update_command_usage(db, command_id, directory_id,
+                                   start or stop)
+        self._update_command_transition(
+            db, ch_id, session_id, command_id, directory_id, start)
+        return ch_id
+
+    def _update_command_usage(self, db, command_id, directory_id, time,
+                              delta=1):
+        if command_id is None:
+            return
+        update = lambda table, where, params: self._upsert_usage(
+            db, table, where, params, time, delta)
+        update('command_usage', ['command_id'], [command_id])
+        if directory_id is not None:
+            update('command_directory_usage',
+                   ['command_id', 'directory_id'],
+                   [command_id, directory_id])
+
+    def _update_command_transition(self, db, ch_id, session_id,
+                                   command_id, directory_id, start,
+                                   delta=1):
+        """
+        Count transition from the previous command in the session.
 
-    def _isnert_command_environment(self, db, ch_id, environ):
-        self._insert_environ(db, 'command_environment_map', 'ch_id', ch_id,
-                             environ)
+        As records may be imported out of order, transition from the
+        previous command to the next command (if already imported) is
+        replaced by the transitions via the newly inserted command.
+
+        When a command is deleted (`delta` is -1), this is done in the
+        other way around: the transitions via the deleted command are
+        replaced by the transition from the previous command to the
+        next command.
+
+        Commands are ordered by ``(start_time, id)`` as in
+        :data:`TRANSITION_SQL`, so that commands started at the same
+        time are counted in the same way.
+
+        """
+        if session_id is None or command_id is None or start is None:
+            return
+        prev = next_ = next_dir = next_start = None
+        for (prev,) in db.execute(
+            """
+            SELECT command_id FROM command_history
+            WHERE session_id = ? AND command_id IS NOT NULL AND
+                  (start_time < ? OR (start_time = ? AND id < ?))
+            ORDER BY start_time DESC, id DESC
+            LIMIT 1
+            """,
+            [session_id, start, start, ch_id]):
+            pass
+        for (next_, next_dir, next_start) in db.execute(
+            """
+            SELECT command_id, directory_id, start_time FROM command_history
+            WHERE session_id = ? AND command_id IS NOT NULL AND
+                  (start_time > ? OR (start_time = ? AND id > ?))
+            ORDER BY start_time ASC, id ASC
+            LIMIT 1
+            """,
+            [session_id, start, start, ch_id]):
+            pass
+        if delta < 0:
+            start = next_start = None  # do not touch last_used
+        if prev is not None and next_ is not None:
+            self._count_transition(db, prev, next_, next_dir, None, -delta)
+        if prev is not None:
+            self._count_transition(db, prev, command_id, directory_id, start,
+                                   delta)
+        if next_ is not None:
+            self._count_transition(db, command_id, next_, next_dir,
+                                   next_start, delta)
+
+    def _count_transition(self, db, prev, next_, directory_id, time,
+                          delta=1):
+        update = lambda table, where, params: self._upsert_usage(
+            db, table, where, params, time, delta)
+        update('command_transition',
+               ['prev_command_id', 'next_command_id'], [prev, next_])
+        if directory_id is not None:
+            update('command_directory_transition',
+                   ['prev_command_id', 'next_command_id', 'directory_id'],
+                   [prev, next_, directory_id])
+
+    @staticmethod
+    def _upsert_usage(db, table, where, params, time, delta=1):
+        db.execute(
+            'INSERT OR IGNORE INTO {0} ({1}) VALUES ({2})'.format(
+                table, ', '.join(where), ', '.join('?' for _ in where)),
+            params)
+        db.execute(
+            """
+            UPDATE {0}
+            SET use_count = use_count + ?,
+                last_used = CASE WHEN last_used IS NULL OR last_used < ?
+                            THEN ? ELSE last_used END
+            WHERE {1}
+            """.format(table, ' AND '.join(map('{0} = ?'.format, where))),
+            [delta, time, time] + params)
 
     def _insert_environ(self, db, table, id_name, ch_id, environ):
         if not environ:
@@ -289,18 +1399,6 @@ class DataBase(object):
                 '''.format(table, id_name),
                 [ch_id, ev_id])
 
-    def _insert_pipe_status(self, db, ch_id, pipe_status):
-        if not pipe_status:
-            return
-        for (i, code) in enumerate(pipe_status):
-            db.execute(
-                '''
-                INSERT INTO pipe_status_map
-                    (ch_id, program_position, exit_code)
-                VALUES (?, ?, ?)
-                ''',
-                [ch_id, i, code])
-
     def _get_maybe_new_command_id(self, db, command):
         if command is None:
             return None
@@ -420,12 +1518,110 @@ class DataBase(object):
 
         return records
 
+    _search_value_keys = [
+        'match_pattern', 'include_pattern', 'exclude_pattern',
+        'match_regexp', 'include_regexp', 'exclude_regexp',
+        'cwd', 'cwd_glob',
+        'time_after', 'time_before',
+        'duration_longer_than', 'duration_less_than',
+        'include_exit_code', 'exclude_exit_code',
+        'include_session_history_id', 'exclude_session_history_id',
+        'match_environ_pattern', 'include_environ_pattern',
+        'exclude_environ_pattern',
+        'match_environ_regexp', 'include_environ_regexp',
+        'exclude_environ_regexp',
+        'sort_by_cwd_distance',
+    ]
+    """
+    Search parameters whose values go to SQL parameters (``?``).
+    Other parameters change the shape of SQL.
+    """
+
+    _sql_shape_cache = {}
+    sql_shape_cache_size = 256
+
     @classmethod
-    def _compile_sql_search_command_record(
+    def _compile_sql_search_command_record(cls, **kwds):
+        """
+        Compile search query into 3-tuple ``(sql, params, keys)``.
+
+        Compiled SQL is cached by the "shape" of the query, i.e., the
+        arguments except for the values that go into SQL parameters.
+        So, the same SQL string is used for the queries that differ only
+        in the pattern or directory, etc. and prepared statements
+        cached in :mod:`sqlite3` can be reused.
+
+        """
+        kwds = cls._normalize_search_kwds(kwds)
+        shape = cls._search_shape_key(kwds)
+        try:
+            (sql, template, keys) = cls._sql_shape_cache[shape]
+        except KeyError:
+            symbolic = dict(kwds)
+            for key in cls._search_value_keys:
+                symbolic[key] = cls._symbolic_value(key, kwds[key])
+            (sql, template, keys) = \
+                cls._build_sql_search_command_record(**symbolic)
+            if len(cls._sql_shape_cache) >= cls.sql_shape_cache_size:
+                cls._sql_shape_cache.clear()
+            cls._sql_shape_cache[shape] = (sql, template, keys)
+        params = [p.resolve(kwds) if isinstance(p, ParamSlot) else p
+                  for p in template]
+        return (sql, params, keys)
+
+    @staticmethod
+    def _normalize_search_kwds(kwds):
+        """
+        Resolve paths etc. so that values can be fed to SQL directly.
+        """
+        kwds = dict(kwds)
+        cwd_under = kwds.pop('cwd_under', [])
+        kwds['cwd_glob'] = list(kwds['cwd_glob']) + [
+            os.path.join(os.path.abspath(p), "*") for p in cwd_under]
+        kwds['cwd'] = [normalize_directory(os.path.abspath(p))
+                       for p in kwds['cwd']]
+        if kwds['sort_by_cwd_distance']:
+            kwds['sort_by_cwd_distance'] = normalize_directory(
+                os.path.abspath(kwds['sort_by_cwd_distance']))
+        else:
+            kwds['sort_by_cwd_distance'] = None
+        return kwds
+
+    @classmethod
+    def _search_shape_key(cls, kwds):
+        def shape(val):
+            if isinstance(val, (list, tuple)):
+                return tuple(len(v) if isinstance(v, (list, tuple)) else None
+                             for v in val)
+            return val is not None
+        key = []
+        for (name, val) in sorted(kwds.items()):
+            if name in cls._search_value_keys:
+                val = shape(val)
+            elif isinstance(val, (list, tuple)):
+                val = tuple(val)
+            elif isinstance(val, (set, frozenset)):
+                val = tuple(sorted(val))
+            key.append((name, val))
+        return tuple(key)
+
+    @staticmethod
+    def _symbolic_value(name, val):
+        if val is None:
+            return None
+        elif isinstance(val, (list, tuple)):
+            return [[ParamSlot(name, i, j) for j in range(len(v))]
+                    if isinstance(v, (list, tuple)) else ParamSlot(name, i)
+                    for (i, v) in enumerate(val)]
+        else:
+            return ParamSlot(name)
+
+    @classmethod
+    def _build_sql_search_command_record(
             cls, limit, unique,
             match_pattern, include_pattern, exclude_pattern,
             match_regexp, include_regexp, exclude_regexp,
-            cwd, cwd_glob, cwd_under,
+            cwd, cwd_glob,
             time_after, time_before, duration_longer_than, duration_less_than,
             include_exit_code, exclude_exit_code,
             include_session_history_id, exclude_session_history_id,
@@ -449,10 +1645,6 @@ class DataBase(object):
             'LEFT JOIN directory_list AS DL ON directory_id = DL.id '
             'LEFT JOIN terminal_list AS TL ON terminal_id = TL.id')
 
-        if cwd_under:
-            cwd_glob.extend(os.path.join(os.path.abspath(p), "*")
-                            for p in cwd_under)
-
         if ignore_case:
             glob = "glob(lower({1}), lower({0}))".format
         else:
@@ -472,8 +1664,8 @@ class DataBase(object):
             if unique:
                 col_cwd_dist = 'MIN({0})'.format(col_cwd_dist)
             col_cwd_dist += ' AS cwd_distance'
-            path0 = normalize_directory(os.path.abspath(sort_by_cwd_distance))
-            sc.add_column(col_cwd_dist, 'cwd_distance', params=[path0])
+            sc.add_column(col_cwd_dist, 'cwd_distance',
+                          params=[sort_by_cwd_distance])
             sc.order_by('cwd_distance', 'DESC' if reverse else 'ASC')
         for k in sort_by:
             sc.order_by(k, 'ASC' if reverse else 'DESC')
@@ -482,9 +1674,7 @@ class DataBase(object):
         sc.add_matches(regexp, 'CL.command',
                        match_regexp, include_regexp, exclude_regexp)
         sc.add_or_matches(glob, 'DL.directory', cwd_glob)
-        sc.add_or_matches(
-            eq, 'DL.directory',
-            [normalize_directory(os.path.abspath(p)) for p in cwd])
+        sc.add_or_matches(eq, 'DL.directory', cwd)
         sc.add_and_matches('DATETIME({0}) >= {1}', 'start_time', time_after)
         sc.add_and_matches('DATETIME({0}) <= {1}', 'start_time', time_before)
         comdura = (
@@ -575,12 +1765,12 @@ class DataBase(object):
         command_table_alias = 'CEnv{0}'.format(suffix)
         session_table_alias = 'SEnv{0}'.format(suffix)
         sc_ce = cls._sc_history_environ(
-            'command_environment_map', 'ch_id', matcher, lhs, match_params,
+            'environment_set_map', 'es_id', matcher, lhs, match_params,
             table_alias=command_table_alias, **kwds)
         sc_se = cls._sc_history_environ(
             'session_environment_map', 'sh_id', matcher, lhs, match_params,
             table_alias=session_table_alias, **kwds)
-        sc.join(sc_ce, op='LEFT JOIN', on='command_history.id = {r}.ch_id')
+        sc.join(sc_ce, op='LEFT JOIN', on='environment_set_id = {r}.es_id')
         sc.join(sc_se, op='LEFT JOIN', on='session_id = {r}.sh_id')
         if and_match:
             # When doing AND match, there should be at least matches
@@ -658,6 +1848,383 @@ class DataBase(object):
         (sql, params, keys) = sc.compile()
         return self._select_rows(EnvironRecord, keys, sql, params)
 
+    suggest_directory_weight = 4.0
+    """
+    How much a use of a command in the current directory counts,
+    compared to a use of it in other directories.
+    """
+
+    def suggest_command(self, prefix, cwd=None, limit=1):
+        """
+        Yield commands starting with `prefix`, most likely one first.
+
+        Candidates are found by a range scan of the unique index of
+        ``command_list`` and then ranked by the usage count (runs in
+        `cwd` are weighted by :attr:`suggest_directory_weight`)
+        divided by the number of days since the last use.
+
+        :type prefix: str
+        :type    cwd: str or None
+        :rtype: [CommandRecord]
+
+        """
+        if not prefix:
+            return iter([])
+        keys = ['command', 'command_count', 'start', 'score']
+        sql = """
+        SELECT CL.command, CU.use_count, CU.last_used,
+            (CU.use_count + ? * IFNULL(CDU.use_count, 0)) /
+            (1.0 + JULIANDAY('now') - IFNULL(JULIANDAY(CU.last_used), 0))
+            AS score
+        FROM command_list AS CL
+        JOIN command_usage AS CU ON CU.command_id = CL.id
+        LEFT JOIN command_directory_usage AS CDU
+            ON CDU.command_id = CL.id AND CDU.directory_id = (
+                SELECT id FROM directory_list WHERE directory = ?)
+        WHERE CL.command > ? {0}
+        ORDER BY score DESC
+        LIMIT ?
+        """
+        params = [self.suggest_directory_weight,
+                  normalize_directory(cwd and os.path.abspath(cwd)),
+                  prefix]
+        upper = prefix_upper_bound(prefix)
+        if upper is None:
+            sql = sql.format('')
+        else:
+            sql = sql.format('AND CL.command < ?')
+            params.append(upper)
+        params.append(limit)
+        return self._select_rows(CommandRecord, keys, sql, params)
+
+    def predict_command(self, after=None, cwd=None, session_id=None,
+                        limit=10):
+        """
+        Yield commands likely to be run next, most likely one first.
+
+        Prediction is based on how many times each command is run
+        right after the command `after` in the same session.  It is
+        looked up from the ``command_transition`` table maintained at
+        import time.  Transitions observed in `cwd` are weighted by
+        :attr:`suggest_directory_weight`.
+
+        :type      after: str or None
+        :arg       after: the last command.  If it is not given, the
+                          last command in the session `session_id`
+                          (or any session) is used.
+        :type        cwd: str or None
+        :type session_id: str or None
+        :arg  session_id: session ID generated by ``rash record``.
+        :rtype: [CommandRecord]
+
+        """
+        if after is None:
+            after = self._get_last_command(session_id)
+            if after is None:
+                return iter([])
+        keys = ['command', 'command_count', 'start', 'score']
+        sql = """
+        SELECT CL.command, CT.use_count, CT.last_used,
+            CT.use_count + ? * IFNULL(CDT.use_count, 0) AS score
+        FROM command_transition AS CT
+        JOIN command_list AS CL ON CL.id = CT.next_command_id
+        LEFT JOIN command_directory_transition AS CDT
+            ON CDT.prev_command_id = CT.prev_command_id AND
+               CDT.next_command_id = CT.next_command_id AND
+               CDT.directory_id = (
+                   SELECT id FROM directory_list WHERE directory = ?)
+        WHERE CT.prev_command_id = (
+            SELECT id FROM command_list WHERE command = ?) AND
+            CT.use_count > 0
+        ORDER BY score DESC, CT.last_used DESC
+        LIMIT ?
+        """
+        params = [self.suggest_directory_weight,
+                  normalize_directory(cwd and os.path.abspath(cwd)),
+                  after, limit]
+        return self._select_rows(CommandRecord, keys, sql, params)
+
+    def _get_last_command(self, session_id=None):
+        sql = """
+        SELECT CL.command
+        FROM command_history
+        JOIN command_list AS CL ON command_id = CL.id
+        {0}
+        ORDER BY command_history.id DESC
+        LIMIT 1
+        """
+        if session_id is None:
+            (sql, params) = (sql.format(''), [])
+        else:
+            sql = sql.format("""
+            WHERE session_id = (
+                SELECT id FROM session_history WHERE session_long_id = ?)
+            """)
+            params = [session_id]
+        with self.connection() as connection:
+            for (command,) in connection.execute(sql, params):
+                return command
+
+    def navigate_directory(self, cwd, before_id=None, after_id=None,
+                           skip_command=None):
+        """
+        Get the command run in `cwd` right before/after given ID.
+
+        This is a keyset pagination using the index on
+        ``command_history(directory_id, id)``, so each step costs
+        O(log n) regardless of how far it goes back.
+
+        :type           cwd: str
+        :type     before_id: int or None
+        :arg      before_id: return the latest command whose ID is
+                             smaller than this.  If both `before_id`
+                             and `after_id` are None, the latest
+                             command in `cwd` is returned.
+        :type      after_id: int or None
+        :arg       after_id: return the oldest command whose ID is
+                             larger than this.
+        :type  skip_command: str or None
+        :arg   skip_command: skip records of this command (e.g., the
+                             one currently shown in the command line).
+        :rtype: CommandRecord or None
+
+        """
+        keys = ['command_history_id', 'command', 'session_history_id',
+                'start', 'stop', 'exit_code']
+        conditions = ['directory_id = ('
+                      'SELECT id FROM directory_list WHERE directory = ?)']
+        params = [normalize_directory(os.path.abspath(cwd))]
+        if after_id is not None:
+            conditions.append('command_history.id > ?')
+            params.append(after_id)
+            order = 'ASC'
+        else:
+            if before_id is not None:
+                conditions.append('command_history.id < ?')
+                params.append(before_id)
+            order = 'DESC'
+        if skip_command is not None:
+            conditions.append('CL.command != ?')
+            params.append(skip_command)
+        sql = """
+        SELECT command_history.id, CL.command, session_id,
+               start_time, stop_time, exit_code
+        FROM command_history
+        JOIN command_list AS CL ON command_id = CL.id
+        WHERE {0}
+        ORDER BY command_history.id {1}
+        LIMIT 1
+        """.format(' AND '.join(conditions), order)
+        with self.connection() as connection:
+            for row in connection.execute(sql, params):
+                return CommandRecord(cwd=params[0], **dict(zip(keys, row)))
+
+    def delete_command_history(self, command_history_ids):
+        """
+        Delete commands in one transaction and return the number of them.
+
+        Usage and transition counts derived from the commands are
+        updated as if they were never imported.  Rows in
+        ``command_list`` etc. which are not used anymore are left;
+        call :meth:`delete_garbage` to remove them.
+
+        """
+        deleted = 0
+        with self.connection(commit=True) as connection:
+            db = connection.cursor()
+            for ch_id in command_history_ids:
+                deleted += self._delete_command_history(db, ch_id)
+            for table in USAGE_TABLES:
+                db.execute(
+                    'DELETE FROM {0} WHERE use_count <= 0'.format(table))
+        return deleted
+
+    def _delete_command_history(self, db, ch_id):
+        for (command_id, session_id, directory_id, start) in db.execute(
+                """
+                SELECT command_id, session_id, directory_id, start_time
+                FROM command_history WHERE id = ?
+                """, [ch_id]):
+            break
+        else:
+            return 0
+        db.execute('DELETE FROM command_history WHERE id = ?', [ch_id])
+        # Tables not used since schema version 0.7 and 0.9:
+        db.execute('DELETE FROM command_environment_map WHERE ch_id = ?',
+                   [ch_id])
+        db.execute('DELETE FROM pipe_status_map WHERE ch_id = ?', [ch_id])
+        self._update_command_usage(db, command_id, directory_id, None, -1)
+        self._update_command_transition(
+            db, ch_id, session_id, command_id, directory_id, start, -1)
+        return 1
+
+    def select_expired_command_ids(self, max_age=None, max_count=None,
+                                   now=None):
+        """
+        Return IDs of commands older than `max_age` days or not in the
+        newest `max_count` commands.
+        """
+        ids = set()
+        with self.connection() as db:
+            if max_age is not None:
+                now = time.time() if now is None else now
+                cutoff = convert_ts(now - max_age * 24 * 60 * 60)
+                ids.update(i for (i,) in db.execute(
+                    """
+                    SELECT id FROM command_history
+                    WHERE COALESCE(start_time, stop_time) < ?
+                    """, [cutoff]))
+            if max_count is not None:
+                ids.update(i for (i,) in db.execute(
+                    """
+                    SELECT id FROM command_history
+                    ORDER BY COALESCE(start_time, stop_time) DESC, id DESC
+                    LIMIT -1 OFFSET ?
+                    """, [max_count]))
+        return sorted(ids)
+
+    def select_command_ids_by_pattern(self, patterns=[], regexps=[]):
+        """
+        Return IDs of commands matching any of glob `patterns` or
+        `regexps`.
+        """
+        if not (patterns or regexps):
+            return []
+        conditions = (['glob(?, CL.command)'] * len(patterns) +
+                      ['regexp(?, CL.command)'] * len(regexps))
+        sql = """
+        SELECT command_history.id FROM command_history
+        JOIN command_list AS CL ON command_id = CL.id
+        WHERE {0}
+        """.format(' OR '.join(conditions))
+        with self.connection() as db:
+            return [i for (i,) in db.execute(
+                sql, list(patterns) + list(regexps))]
+
+    def delete_garbage(self, table, limit=500):
+        """
+        Delete at most `limit` rows in `table` nothing refers to.
+
+        `table` is one of :data:`GARBAGE_QUERIES`.  Return the number
+        of deleted rows.  Call this until it returns 0 to delete all.
+
+        """
+        sql = dict(GARBAGE_QUERIES)[table]
+        with self.connection(commit=True) as db:
+            return self._delete_unused(
+                db, table, '{0} LIMIT {1:d}'.format(sql, limit), [])
+
+    def delete_empty_sessions(self, before):
+        """
+        Delete sessions which have no command and ended `before`.
+        """
+        sql = """
+        SELECT id FROM session_history
+        WHERE COALESCE(stop_time, start_time) < ?
+        EXCEPT SELECT session_id FROM command_history
+        """
+        with self.connection(commit=True) as db:
+            return self._delete_unused(
+                db, 'session_history', sql, [convert_ts(before)])
+
+    @staticmethod
+    def _delete_unused(db, table, sql, params):
+        """
+        Delete rows in `table` (and derived rows) whose IDs `sql` selects.
+
+        IDs are not selected before deletion, as a row may be referred
+        to by a command inserted by another process in between.  All
+        statements are write statements, so `sql` is evaluated while
+        the write lock of the DB is held, i.e., it selects the same
+        rows in all of them.
+
+        """
+        for (t, column) in GARBAGE_REFERENCES.get(table, []):
+            db.execute('DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                t, column, sql), params)
+        return db.execute('DELETE FROM {0} WHERE id IN ({1})'.format(
+            table, sql), params).rowcount
+
+    def get_indexed_files(self, prefix=None):
+        """
+        Return a dict ``{path: (size, mtime)}`` of already indexed files.
+
+        If `prefix` is given, only paths starting with it are returned.
+
+        """
+        sql = 'SELECT path, size, mtime FROM indexed_file ' \
+              'WHERE size IS NOT NULL'
+        params = []
+        if prefix:
+            sql += ' AND path >= ?'
+            params.append(prefix)
+            upper = prefix_upper_bound(prefix)
+            if upper is not None:
+                sql += ' AND path < ?'
+                params.append(upper)
+        with self.connection() as connection:
+            return dict((path, (size, mtime)) for (path, size, mtime)
+                        in connection.execute(sql, params))
+
+    def get_indexed_dirs(self):
+        """
+        Return a dict ``{path: mtime}`` of directory high-water marks.
+
+        They are stored in the manifest of indexed files with NULL
+        size and a path ending with the path separator.  See
+        :meth:`rash.indexer.Indexer.find_files_in_changed_dirs`.
+
+        """
+        with self.connection() as connection:
+            return dict(connection.execute(
+                'SELECT path, mtime FROM indexed_file WHERE size IS NULL'))
+
+    def set_indexed_dirs(self, marks, removed=()):
+        """
+        Record directory high-water `marks` and remove `removed` ones.
+        """
+        with self.connection(commit=True) as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO indexed_file (path, size, mtime) '
+                'VALUES (?, NULL, ?)',
+                list(marks.items()))
+            connection.executemany(
+                'DELETE FROM indexed_file WHERE path = ? AND size IS NULL',
+                [(path,) for path in removed])
+
+    def is_indexed_file(self, path, size, mtime):
+        with self.connection() as connection:
+            return nonempty(connection.execute(
+                'SELECT 1 FROM indexed_file '
+                'WHERE path = ? AND size = ? AND mtime = ?',
+                [path, size, mtime]))
+
+    def add_indexed_file(self, path, size, mtime):
+        with self.connection(commit=True) as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO indexed_file (path, size, mtime) '
+                'VALUES (?, ?, ?)',
+                [path, size, mtime])
+
+    def remove_indexed_file(self, path, size, mtime):
+        """
+        Remove `path` from the manifest and return true if it was there.
+        """
+        with self.connection(commit=True) as connection:
+            return connection.execute(
+                'DELETE FROM indexed_file '
+                'WHERE path = ? AND size = ? AND mtime = ?',
+                [path, size, mtime]).rowcount > 0
+
+    def prune_indexed_files(self, paths):
+        """
+        Remove `paths` from the manifest regardless of size and mtime.
+        """
+        with self.connection(commit=True) as connection:
+            connection.executemany(
+                'DELETE FROM indexed_file WHERE path = ?',
+                [(path,) for path in paths])
+
     def import_init_dict(self, dct, overwrite=True):
         long_id = dct['session_id']
         srec = SessionRecord(**dct)
@@ -716,9 +2283,13 @@ class DataBase(object):
     def _update_session_environ(self, db, sh_id, environ):
         if not environ:
             return
+        old = select_session_environ(db, sh_id)
+        if old == environ:
+            return
         db.execute('DELETE FROM session_environment_map WHERE sh_id=?',
                    [sh_id])
         self._insert_session_environ(db, sh_id, environ)
+        rebase_session_commands(db, sh_id, old, environ)
 
     def _insert_session_environ(self, db, sh_id, environ):
         self._insert_environ(db, 'session_environment_map', 'sh_id', sh_id,
@@ -739,75 +2310,140 @@ class DataBase(object):
     def search_session_record(self, session_id):
         return self.select_session_by_long_id(session_id)
 
+    def get_session_records(self, session_history_ids, batch_size=500):
+        """
+        Yield :class:`SessionRecord` instances (with `environ`) by IDs.
+        """
+        keys = ['session_history_id', 'session_id', 'start', 'stop']
+        for ids in chunks(session_history_ids, batch_size):
+            sql = """
+            SELECT id, session_long_id, start_time, stop_time
+            FROM session_history
+            WHERE id IN ({0})
+            """.format(', '.join('?' * len(ids)))
+            with self.connection() as db:
+                srecs = [SessionRecord(**dict(zip(keys, row)))
+                         for row in db.execute(sql, ids)]
+                environs = self._select_environ_sets(
+                    db, 'session_environment_map', 'sh_id', ids)
+            for srec in srecs:
+                srec.environ = environs.get(srec.session_history_id, {})
+                yield srec
+
     def get_full_command_record(self, command_history_id,
                                 merge_session_environ=True):
         """
         Get fully retrieved :class:`CommandRecord` instance by ID.
 
         By "fully", it means that complex slots such as `environ` and
-        `pipestatus` are available.
+        `pipestatus` are available.  As environ of a command is stored
+        as a delta against its session, `environ` has only the
+        variables differ from the session's unless
+        `merge_session_environ` is true.
 
         :type    command_history_id: int
         :type merge_session_environ: bool
 
         """
-        with self.connection() as db:
-            crec = self._select_command_record(db, command_history_id)
-            crec.pipestatus = self._get_pipestatus(db, command_history_id)
-            # Set environment variables
-            cenv = self._select_environ(db, 'command', command_history_id)
-            crec.environ.update(cenv)
-            if merge_session_environ:
-                senv = self._select_environ(
-                    db, 'session', crec.session_history_id)
-                crec.environ.update(senv)
-        return crec
-
-    def _select_command_record(self, db, command_history_id):
-        keys = ['session_history_id', 'command', 'cwd', 'terminal',
-                'start', 'stop', 'exit_code']
+        for crec in self.get_full_command_records(
+                [command_history_id], merge_session_environ):
+            return crec
+        raise ValueError("Command record of id={0} is not found"
+                         .format(command_history_id))
+
+    def get_full_command_records(self, command_history_ids,
+                                 merge_session_environ=True,
+                                 batch_size=500):
+        """
+        Yield fully retrieved :class:`CommandRecord` instances by IDs.
+
+        This is a batch version of :meth:`get_full_command_record`.
+        Records are fetched `batch_size` at once by a few queries per
+        batch, instead of several queries per record.  Records are
+        yielded in the order of `command_history_ids`.  IDs not in DB
+        are ignored.
+
+        """
+        for ids in chunks(command_history_ids, batch_size):
+            with self.connection() as db:
+                crecs = self._select_command_records(db, ids)
+                es_ids = set(es_id for (_, es_id) in crecs.values())
+                cenvs = self._select_environ_sets(
+                    db, 'environment_set_map', 'es_id', es_ids)
+                if merge_session_environ:
+                    senvs = self._select_environ_sets(
+                        db, 'session_environment_map', 'sh_id',
+                        set(c.session_history_id
+                            for (c, _) in crecs.values()))
+            for ch_id in ids:
+                if ch_id not in crecs:
+                    continue
+                (crec, es_id) = crecs[ch_id]
+                if merge_session_environ:
+                    crec.environ.update(
+                        senvs.get(crec.session_history_id, {}))
+                crec.environ.update(cenvs.get(es_id, {}))
+                yield crec
+
+    @staticmethod
+    def _select_command_records(db, ids):
+        """
+        Return a dict ``{id: (crec, environment_set_id)}``.
+        """
+        keys = ['command_history_id', 'session_history_id', 'command',
+                'cwd', 'terminal', 'start', 'stop', 'exit_code']
         sql = """
         SELECT
-            session_id, CL.command, DL.directory, TL.terminal,
-            start_time, stop_time, exit_code
+            command_history.id, session_id, CL.command, DL.directory,
+            TL.terminal, start_time, stop_time, exit_code, pipestatus,
+            environment_set_id
         FROM command_history
         LEFT JOIN command_list AS CL ON command_id = CL.id
         LEFT JOIN directory_list AS DL ON directory_id = DL.id
         LEFT JOIN terminal_list AS TL ON terminal_id = TL.id
-        WHERE command_history.id = ?
-        """
-        params = [command_history_id]
-        for row in db.execute(sql, params):
+        WHERE command_history.id IN ({0})
+        """.format(', '.join('?' * len(ids)))
+        crecs = {}
+        for row in db.execute(sql, ids):
             crec = CommandRecord(**dict(zip(keys, row)))
-            crec.command_history_id = command_history_id
-            return crec
-        raise ValueError("Command record of id={0} is not found"
-                         .format(command_history_id))
+            crec.pipestatus = unpack_pipestatus(row[-2])
+            crecs[crec.command_history_id] = (crec, row[-1])
+        return crecs
 
-    def _get_pipestatus(self, db, command_history_id):
-        sql = """
-        SELECT program_position, exit_code
-        FROM pipe_status_map
-        WHERE ch_id = ?
-        """
-        params = [command_history_id]
-        records = list(db.execute(sql, params))
-        length = max(r[0] for r in records) + 1
-        pipestatus = [None] * length
-        for (i, s) in records:
-            pipestatus[i] = s
-        return pipestatus
-
-    def _select_environ(self, db, recname, recid):
+    @staticmethod
+    def _select_environ_sets(db, map_table, map_id, ids):
+        """
+        Return a dict which maps `ids` to environ dicts.
+        """
+        ids = [i for i in ids if i is not None]
+        environs = {}
+        if not ids:
+            return environs
         sql = """
-        SELECT
-            EVar.variable_name, EVar.variable_value
-        FROM {recname}_environment_map as EMap
-        LEFT JOIN environment_variable AS EVar ON EMap.ev_id = EVar.id
-        WHERE EMap.{hist_id} = ?
-        """.format(
-            recname=recname,
-            hist_id='ch_id' if recname == 'command' else 'sh_id',
-        )
-        params = [recid]
-        return db.execute(sql, params)
+        SELECT EMap.{1}, EVar.variable_name, EVar.variable_value
+        FROM {0} AS EMap
+        JOIN environment_variable AS EVar ON EMap.ev_id = EVar.id
+        WHERE EMap.{1} IN ({2})
+        """.format(map_table, map_id, ', '.join('?' * len(ids)))
+        for (i, name, value) in db.execute(sql, ids):
+            environs.setdefault(i, {})[name] = value
+        return environs
+
+    def get_pipestatuses(self, command_history_ids, batch_size=500):
+        """
+        Return a dict which maps command history ID to its pipestatus.
+
+        IDs are queried `batch_size` at once, instead of one query
+        per ID.  IDs not in DB are not in the returned dict.
+
+        """
+        pipestatuses = {}
+        with self.connection() as db:
+            for ids in chunks(command_history_ids, batch_size):
+                sql = """
+                SELECT id, pipestatus FROM command_history
+                WHERE id IN ({0})
+                """.format(', '.join('?' * len(ids)))
+                for (ch_id, packed) in db.execute(sql, ids):
+                    pipestatuses[ch_id] = unpack_pipestatus(packed)
+        return pipestatuses
@@ -0,0 +1,232 @@
+"""
+Search several RASH DBs at once.
+
+:func:`federated_search` runs the same search query on several DB
+files (e.g., archive DBs made by ``rash archive`` or DBs collected
+from other hosts) in worker processes and merges the results into one
+list as if they were in one DB.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import heapq
+import itertools
+
+AGGREGATE_KEYS = set([
+    'command_count', 'success_count', 'success_ratio', 'program_count'])
+"""
+Columns computed over all occurrences of a command.
+"""
+
+SORT_KEY_ATTRS = {'start_time': 'start', 'stop_time': 'stop'}
+
+
+class SortKey(object):
+
+    """
+    Sort key which compares in the same way as SQL ``ORDER BY``.
+
+    Each value is compared in ascending or descending order and NULL
+    (None) is smaller than any other value, as in SQLite.
+
+    >>> SortKey([1, 'b'], [True, False]) < SortKey([0, 'a'], [True, False])
+    True
+    >>> SortKey([None], [False]) < SortKey([0], [False])
+    True
+    >>> sorted([2, None, 1], key=lambda v: SortKey([v], [True]))
+    [2, 1, None]
+
+    """
+
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for (a, b, desc) in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None or b is None:
+                less = a is None
+            else:
+                less = a < b
+            return less != desc
+        return False
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def sort_key_func(sort_by, reverse=False, sort_by_cwd_distance=None, **_):
+    """
+    Return a function to get :class:`SortKey` of a record.
+
+    The order is the same as the one used by
+    :meth:`rash.database.DataBase.search_command_record`.
+
+    """
+    attrs = []
+    descending = []
+    if sort_by_cwd_distance:
+        attrs.append('cwd_distance')
+        descending.append(reverse)
+    for key in sort_by:
+        attrs.append(SORT_KEY_ATTRS.get(key, key))
+        descending.append(not reverse)
+    return lambda crec: SortKey([getattr(crec, a, None) for a in attrs],
+                                descending)
+
+
+def merge_sorted(streams, key):
+    """
+    Merge sorted `streams` into one sorted stream (k-way heap merge).
+
+    Items with the same key are yielded in the order of `streams`.
+    Items themselves are never compared.
+
+    >>> list(merge_sorted([[5, 3, 1], [4, 2]], key=lambda v: -v))
+    [5, 4, 3, 2, 1]
+    >>> list(merge_sorted([[{'a': 1}], [{'a': 0}]], key=lambda v: 0))
+    [{'a': 1}, {'a': 0}]
+
+    """
+    def decorate(i, stream):
+        return ((key(item), i, j, item) for (j, item) in enumerate(stream))
+    decorated = [decorate(i, s) for (i, s) in enumerate(streams)]
+    return (item for (_, _, _, item) in heapq.merge(*decorated))
+
+
+def unique_by_command(records):
+    """
+    Yield only the first record of each command.
+    """
+    seen = set()
+    for crec in records:
+        if crec.command not in seen:
+            seen.add(crec.command)
+            yield crec
+
+
+def merge_unique(records):
+    """
+    Merge records of the same command searched in different DBs.
+
+    The most recent record is used and aggregated columns are summed.
+
+    """
+    merged = {}
+    for crec in records:
+        old = merged.get(crec.command)
+        if old is None:
+            merged[crec.command] = crec
+            continue
+        if (crec.start or '') > (old.start or ''):
+            merged[crec.command] = crec
+            (old, crec) = (crec, old)
+        for key in ['command_count', 'success_count', 'program_count']:
+            if getattr(old, key, None) is not None:
+                setattr(old, key, getattr(old, key) +
+                        (getattr(crec, key, None) or 0))
+        if getattr(old, 'cwd_distance', None) is not None:
+            old.cwd_distance = min(old.cwd_distance, crec.cwd_distance)
+    for crec in merged.values():
+        if getattr(crec, 'success_ratio', None) is not None:
+            crec.success_ratio = crec.success_count * 1.0 / crec.command_count
+    return list(merged.values())
+
+
+def search_db(dbpath, kwds):
+    """
+    Search DB at `dbpath` and return a list of records.
+
+    This is run in worker processes, so it must be picklable.
+
+    """
+    from .database import DataBase
+    db = DataBase(dbpath, readonly=True)
+    return list(db.search_command_record(**kwds))
+
+
+def federated_search(dbpaths, jobs=None, **kwds):
+    """
+    Search DBs at `dbpaths` by the same query and merge the results.
+
+    Each DB is searched by :func:`search_db` in a pool of `jobs`
+    processes (no process is started when `jobs` is 1 or there is
+    only one DB).  Each DB returns at most `limit` records sorted by
+    `sort_by` and they are merged by a k-way heap merge.  Unique
+    search sorted by aggregated columns (e.g., ``command_count``)
+    needs all matching records from each DB to sum them up, so the
+    results are merged and sorted after fetching all of them.
+
+    Context search (e.g., `context`) results are concatenated in the
+    order of `dbpaths` and at most `limit` records (including context
+    lines) are returned in total, as in one DB.  Note that
+    ``command_history_id`` and ``session_history_id`` of a record are
+    the IDs in the DB where it is found.
+
+    :type dbpaths: [str]
+    :type    jobs: int or None
+    :arg     jobs: number of worker processes.  Default is the number
+                   of CPUs.
+    :arg     kwds: passed to
+                   :meth:`rash.database.DataBase.search_command_record`
+    :rtype: [CommandRecord]
+
+    """
+    limit = kwds['limit']
+    context = (kwds.get('context') or kwds.get('before_context') or
+               kwds.get('after_context'))
+    columns = set(kwds['sort_by']) | set(kwds.get('additional_columns', []))
+    aggregate = kwds['unique'] and columns & AGGREGATE_KEYS
+    if aggregate:
+        kwds = dict(kwds, limit=-1)
+    if jobs is None:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(dbpaths))
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = [pool.apply_async(search_db, (path, kwds))
+                       for path in dbpaths]
+            streams = [r.get() for r in results]
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        streams = [search_db(path, kwds) for path in dbpaths]
+
+    key = sort_key_func(**kwds)
+    if context:
+        records = itertools.chain(*streams)
+    elif aggregate:
+        records = sorted(merge_unique(itertools.chain(*streams)), key=key)
+    else:
+        records = merge_sorted(streams, key)
+        if kwds['unique']:
+            records = unique_by_command(records)
+    if limit >= 0:
+        records = itertools.islice(records, limit)
+    return list(records)
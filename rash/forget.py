@@ -0,0 +1,177 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import threading
+
+from .utils.iterutils import chunks
+
+
+def forget(db, command_history_ids, batch_size=500, lock=None, gc=True):
+    """
+    Delete commands from `db` in batches and collect garbage.
+
+    Each batch is committed in its own transaction.  If `lock` is
+    given, it is held only while a batch is deleted so that indexing
+    in the same process is not blocked for long.
+
+    Return a pair ``(deleted, garbage)`` where `garbage` is a dict
+    which maps table name to the number of rows deleted by
+    :meth:`rash.database.DataBase.delete_garbage`.
+
+    """
+    from .database import GARBAGE_QUERIES
+    lock = lock or threading.Lock()
+    deleted = 0
+    for ids in chunks(command_history_ids, batch_size):
+        with lock:
+            deleted += db.delete_command_history(ids)
+    garbage = {}
+    for (table, _) in (GARBAGE_QUERIES if gc else []):
+        garbage[table] = 0
+        while True:
+            with lock:
+                count = db.delete_garbage(table, batch_size)
+            if not count:
+                break
+            garbage[table] += count
+    return (deleted, garbage)
+
+
+def select_commands(db, pattern=(), regexp=(), max_age=None,
+                    max_count=None, now=None):
+    """
+    Return sorted IDs of commands matching to `pattern` or `regexp`
+    or expired by `max_age` or `max_count`.
+    """
+    ids = set(db.select_command_ids_by_pattern(pattern, regexp))
+    ids.update(db.select_expired_command_ids(max_age, max_count, now))
+    return sorted(ids)
+
+
+def forget_commands(db, pattern=(), regexp=(), max_age=None,
+                    max_count=None, now=None, **kwds):
+    """
+    Forget commands selected by :func:`select_commands`.
+
+    Sessions which have no commands and are older than `max_age` are
+    deleted as well.  `kwds` are passed to :func:`forget`.
+
+    """
+    now = time.time() if now is None else now
+    ids = select_commands(db, pattern, regexp, max_age, max_count, now)
+    result = forget(db, ids, **kwds)
+    if max_age is not None:
+        db.delete_empty_sessions(now - max_age * 24 * 60 * 60)
+    return result
+
+
+def apply_retention(db, retention, now=None, **kwds):
+    """
+    Forget commands expired by `retention` policy.
+
+    :type retention: rash.config.RetentionConfig
+    :arg       kwds: passed to :func:`forget_commands`
+
+    """
+    return forget_commands(db, max_age=retention.max_age,
+                           max_count=retention.max_count, now=now, **kwds)
+
+
+def forget_run(pattern, regexp, older_than, keep_last, retention,
+               dry_run, no_gc, batch_size):
+    """
+    Forget commands matching to given patterns.
+
+    Commands are deleted from the DB with statistics derived from
+    them (used by ``rash suggest`` and ``rash predict``).  Then
+    commands, directories, terminals and environment variables which
+    are not used by any command anymore are deleted.  Example::
+
+      rash forget 'mysql -p*'         # glob pattern
+      rash forget --older-than 365    # days
+      rash forget --keep-last 100000  # keep only newest commands
+      rash forget --retention         # use config.retention
+
+    Records are deleted in batches of small transactions.  If the
+    daemon is running, it deletes them between indexing.
+
+    """
+    from .config import ConfigStore, RetentionConfig
+    from .database import DataBase
+    from .server import call_daemon_or_lock
+    cfstore = ConfigStore()
+    if retention:
+        policy = cfstore.get_config().retention
+    else:
+        policy = RetentionConfig()
+        policy.max_age = older_than
+        policy.max_count = keep_last
+    if not (pattern or regexp or
+            policy.max_age is not None or policy.max_count is not None):
+        raise RuntimeError('Nothing to forget.  Give patterns or options.')
+
+    params = dict(pattern=pattern, regexp=regexp, max_age=policy.max_age,
+                  max_count=policy.max_count)
+    if dry_run:
+        ids = select_commands(DataBase(cfstore.db_path, readonly=True),
+                              **params)
+        print('{0} commands will be forgotten.'.format(len(ids)))
+        return
+    params.update(batch_size=batch_size, gc=not no_gc)
+    (deleted, garbage) = call_daemon_or_lock(
+        cfstore, 'forget',
+        lambda: forget_commands(DataBase(cfstore.db_path), **params),
+        **params)
+    print('Forgot {0} commands.'.format(deleted))
+    for (table, count) in sorted(garbage.items()):
+        if count:
+            print('Deleted {0} unused rows from {1}.'.format(count, table))
+
+
+def forget_add_arguments(parser):
+    parser.add_argument(
+        'pattern', nargs='*',
+        help='glob patterns of commands to forget.')
+    parser.add_argument(
+        '--regexp', action='append', default=[],
+        help='regular expression of commands to forget.')
+    parser.add_argument(
+        '--older-than', type=float, metavar='DAYS',
+        help='forget commands older than DAYS days.')
+    parser.add_argument(
+        '--keep-last', type=int, metavar='N',
+        help='forget commands except for the newest N commands.')
+    parser.add_argument(
+        '--retention', action='store_true', default=False,
+        help="""
+        forget commands according to `config.retention` in the
+        configuration file instead of --older-than and --keep-last.
+        """)
+    parser.add_argument(
+        '--dry-run', action='store_true', default=False,
+        help='only print the number of commands to forget.')
+    parser.add_argument(
+        '--no-gc', action='store_true', default=False,
+        help='do not delete unused rows after forgetting commands.')
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='number of rows deleted in one transaction.')
+
+
+commands = [
+    ('forget', forget_add_arguments, forget_run),
+]
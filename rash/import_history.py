@@ -0,0 +1,270 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import re
+import socket
+
+ZSH_EXTENDED_RE = re.compile(r'^: *(\d+):(\d+);(.*)$', re.DOTALL)
+BASH_TIMESTAMP_RE = re.compile(r'^#(\d+)$')
+ZSH_META = 0x83
+
+
+def unmetafy(line):
+    r"""
+    Decode zsh "metafied" bytes in history file.
+
+    zsh stores some special bytes as 0x83 followed by the byte XOR 32.
+
+    >>> unmetafy(b'\x83\xa3') == b'\x83'
+    True
+    >>> unmetafy(b'abc') == b'abc'
+    True
+
+    """
+    if b'\x83' not in line:
+        return line
+    data = bytearray(line)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        if data[i] == ZSH_META and i + 1 < len(data):
+            i += 1
+            out.append(data[i] ^ 32)
+        else:
+            out.append(data[i])
+        i += 1
+    return bytes(out)
+
+
+def decode_lines(fp, metafied=False):
+    """
+    Yield unicode lines without trailing newline from binary file `fp`.
+    """
+    for line in fp:
+        if metafied:
+            line = unmetafy(line)
+        yield line.decode('utf-8', 'replace').rstrip('\r\n')
+
+
+def parse_zsh_history(lines):
+    r"""
+    Parse zsh history lines and yield record dictionaries.
+
+    Both extended (``: START:ELAPSED;COMMAND``) and plain format are
+    supported.  A multi-line command is stored as lines ending with a
+    backslash.  Key ``line`` is the line number where the command
+    starts.
+
+    >>> for dct in parse_zsh_history([
+    ...         ': 1373500000:2;make \\',
+    ...         'test',
+    ...         'ls']):
+    ...     print(sorted(dct.items()))  # doctest: +NORMALIZE_WHITESPACE
+    [('command', 'make \ntest'), ('line', 1), ('start', 1373500000),
+     ('stop', 1373500002)]
+    [('command', 'ls'), ('line', 3)]
+
+    """
+    buf = []
+    first = None
+    for (lineno, line) in enumerate(lines, 1):
+        if not buf:
+            first = lineno
+        if line.endswith('\\'):
+            buf.append(line[:-1])
+            continue
+        buf.append(line)
+        entry = '\n'.join(buf)
+        buf = []
+        match = ZSH_EXTENDED_RE.match(entry)
+        if match:
+            start = int(match.group(1))
+            yield dict(command=match.group(3), start=start,
+                       stop=start + int(match.group(2)), line=first)
+        elif entry:
+            yield dict(command=entry, line=first)
+    if buf:
+        for dct in parse_zsh_history(['\n'.join(buf)]):
+            dct['line'] = first
+            yield dct
+
+
+def parse_bash_history(lines):
+    """
+    Parse bash history lines and yield record dictionaries.
+
+    When the history is written with ``HISTTIMEFORMAT``, each command
+    is preceded by a ``#TIMESTAMP`` line and all lines up to the next
+    timestamp belong to the command.  Otherwise each line is a
+    command.  Key ``line`` is the line number where the command
+    starts.
+
+    >>> for dct in parse_bash_history([
+    ...         '#1373500000', 'for i in 1 2', 'do echo $i; done',
+    ...         '#1373500001', 'ls']):
+    ...     print(sorted(dct.items()))  # doctest: +NORMALIZE_WHITESPACE
+    [('command', 'for i in 1 2\\ndo echo $i; done'), ('line', 2),
+     ('start', 1373500000)]
+    [('command', 'ls'), ('line', 5), ('start', 1373500001)]
+
+    """
+    start = None
+    buf = []
+    first = None
+    for (lineno, line) in enumerate(lines, 1):
+        match = BASH_TIMESTAMP_RE.match(line)
+        if match:
+            if buf:
+                yield dict(command='\n'.join(buf), start=start, line=first)
+            start = int(match.group(1))
+            buf = []
+        elif start is None:
+            if line:
+                yield dict(command=line, line=lineno)
+        else:
+            if not buf:
+                first = lineno
+            buf.append(line)
+    if buf:
+        yield dict(command='\n'.join(buf), start=start, line=first)
+
+
+def detect_format(path):
+    """
+    Guess format of history file at `path` (``'zsh'`` or ``'bash'``).
+    """
+    with open(path, 'rb') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if ZSH_EXTENDED_RE.match(line.decode('utf-8', 'replace')):
+                return 'zsh'
+            break
+    return 'zsh' if 'zsh' in path else 'bash'
+
+
+def iter_history(path, format='auto'):
+    """
+    Yield record dictionaries in history file at `path`.
+
+    The file is read as a stream, so that huge history can be
+    imported in constant memory.
+
+    A command without timestamps cannot be told apart from the other
+    runs of the same command.  Its ``origin`` is set to the host name,
+    the path and the line number where it is found, so that all runs
+    are imported but importing the same file again does not duplicate
+    them (see :func:`rash.database.command_fingerprint`).
+
+    """
+    if format == 'auto':
+        format = detect_format(path)
+    host = socket.gethostname()
+    abspath = os.path.abspath(path)
+    with open(path, 'rb') as fp:
+        if format == 'zsh':
+            records = parse_zsh_history(decode_lines(fp, metafied=True))
+        elif format == 'bash':
+            records = parse_bash_history(decode_lines(fp))
+        else:
+            raise ValueError('Unknown history format: {0}'.format(format))
+        for dct in records:
+            line = dct.pop('line')
+            if dct.get('start') is None and dct.get('stop') is None:
+                dct['origin'] = '{0}:{1}:{2}'.format(host, abspath, line)
+            yield dct
+
+
+def import_history(db, path, format='auto', check_duplicate=True,
+                   batch_size=10000):
+    """
+    Import history file at `path` into `db`.
+
+    Return a list ``[imported, skipped]`` of the numbers of imported
+    commands and skipped duplicates.
+
+    :type db: rash.database.DataBase
+
+    """
+    return list(db.import_dicts(iter_history(path, format),
+                                check_duplicate=check_duplicate,
+                                batch_size=batch_size))
+
+
+def import_history_run(history, format, no_check_duplicate, batch_size):
+    """
+    Import existing shell history files into RASH DB.
+
+    zsh history (extended format written with the EXTENDED_HISTORY
+    option or plain format) and bash history (with timestamps written
+    when HISTTIMEFORMAT is set or without them) are supported.
+    Example::
+
+      rash import-history ~/.zsh_history
+      rash import-history --format bash ~/.bash_history
+
+    Start and stop times are imported if they are in the file, but
+    current directory, exit code and session are not known.  Records
+    which are already imported are skipped, so it is safe to import
+    the same file again.  Commands without timestamps are identified
+    by the host, the path of the file and the line number, so every
+    run of them is imported once.
+
+    If the daemon is running, it imports the files instead so that
+    importing does not compete with indexing.
+
+    """
+    from .config import ConfigStore
+    from .database import DataBase
+    from .server import call_daemon_or_lock
+    cfstore = ConfigStore()
+    for path in history:
+        if not os.path.exists(path):
+            raise RuntimeError('No such file: {0}'.format(path))
+    kwds = dict(format=format, check_duplicate=not no_check_duplicate,
+                batch_size=batch_size)
+    for path in map(os.path.abspath, history):
+        (imported, skipped) = call_daemon_or_lock(
+            cfstore, 'import_history',
+            lambda: import_history(DataBase(cfstore.db_path), path, **kwds),
+            path=path, **kwds)
+        print('{0}: imported {1} commands ({2} duplicates skipped)'
+              .format(path, imported, skipped))
+
+
+def import_history_add_arguments(parser):
+    parser.add_argument(
+        'history', nargs='+',
+        help='history files to import.')
+    parser.add_argument(
+        '--format', default='auto', choices=['auto', 'zsh', 'bash'],
+        help="""
+        format of the history files.  By default, it is guessed from
+        the first line of the file and the file name.
+        """)
+    parser.add_argument(
+        '--no-check-duplicate', default=False, action='store_true',
+        help='import records even if they are already in DB.')
+    parser.add_argument(
+        '--batch-size', default=10000, type=int,
+        help='number of records committed at once.')
+
+
+commands = [
+    ('import-history', import_history_add_arguments, import_history_run),
+]
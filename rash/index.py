@@ -14,19 +14,49 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-def index_run(record_path, keep_json, check_duplicate):
+def index_run(record_path, keep_json, check_duplicate, jobs, progress):
     """
     Convert raw JSON records into sqlite3 DB.
 
     Normally RASH launches a daemon that takes care of indexing.
-    See ``rash daemon --help``.
+    See ``rash daemon --help``.  If the daemon is running, records
+    are indexed by the daemon.  In that case, options --keep-json and
+    --check-duplicate default to the ones of the daemon.
 
     """
+    import os
+    import sys
     from .config import ConfigStore
     from .indexer import Indexer
+    from .server import call_daemon_or_lock
     cfstore = ConfigStore()
-    indexer = Indexer(cfstore, check_duplicate, keep_json, record_path)
-    indexer.index_all()
+
+    def report(indexed, seconds):
+        sys.stderr.write('\rIndexed {0} records ({1:.1f} sec)'
+                         .format(indexed, seconds))
+        sys.stderr.flush()
+
+    def index():
+        indexer = Indexer(cfstore, bool(check_duplicate), bool(keep_json),
+                          record_path)
+        indexer.index_all(jobs=jobs, progress=report if progress else None)
+        if progress:
+            sys.stderr.write('\n')
+
+    # Let the daemon do the job if it holds the index lock, rather
+    # than competing with it for the DB.
+    try:
+        indexed = call_daemon_or_lock(
+            cfstore, 'index', index,
+            record_path=record_path and os.path.abspath(record_path),
+            keep_json=keep_json, check_duplicate=check_duplicate)
+    except RuntimeError as err:
+        raise RuntimeError(
+            'Failed to index records: {0}\n'
+            'If the daemon is old, restart it by: rash daemon --restart'
+            .format(err))
+    if indexed is not None and progress:
+        sys.stderr.write('Indexed {0} records by daemon\n'.format(indexed))
 
 
 def index_add_arguments(parser):
@@ -36,13 +66,21 @@ def index_add_arguments(parser):
         specify the directory that has JSON records.
         """)
     parser.add_argument(
-        '--keep-json', default=False, action='store_true',
+        '--keep-json', default=None, action='store_true',
         help="""
         Do not remove old JSON files.  It turns on --check-duplicate.
         """)
     parser.add_argument(
-        '--check-duplicate', default=False, action='store_true',
+        '--check-duplicate', default=None, action='store_true',
         help='do not store already existing history in DB.')
+    parser.add_argument(
+        '--jobs', '-j', default=4, type=int,
+        help="""
+        number of threads to read JSON files.
+        """)
+    parser.add_argument(
+        '--progress', default=False, action='store_true',
+        help='print the number of indexed records to stderr.')
 
 
 commands = [
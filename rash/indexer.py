@@ -16,9 +16,27 @@
 
 import os
 import json
+import time
 import warnings
+import functools
+import threading
 
 from .database import DataBase
+from .metrics import Metrics
+from .record import is_past_record_dir
+
+RECORD_TYPES = ('command', 'init', 'exit')
+
+
+def synchronized(method):
+    """
+    Decorate `method` to hold :attr:`Indexer.write_lock` while it runs.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwds):
+        with self.write_lock:
+            return method(self, *args, **kwds)
+    return wrapper
 
 
 class Indexer(object):
@@ -27,7 +45,14 @@ class Indexer(object):
     Translate JSON files into SQLite DB.
     """
 
-    def __init__(self, cfstore, check_duplicate, keep_json, record_path=None):
+    mtime_slack = 2.0
+    """
+    Directories modified within this many seconds are listed again by
+    :meth:`find_files_in_changed_dirs`.
+    """
+
+    def __init__(self, cfstore, check_duplicate, keep_json, record_path=None,
+                 readonly=False):
         """
         Create an indexer.
 
@@ -40,6 +65,10 @@ class Indexer(object):
                                Imply ``check_duplicate=True``.
         :type     record_path: str or None
         :arg      record_path: Default to `cfstore.record_path`.
+        :type        readonly: bool
+        :arg         readonly: Open DB with ``readonly=True``.  Use
+                               :meth:`sibling` to get an indexer
+                               which can write records.
 
         """
         from .log import logger
@@ -50,7 +79,10 @@ class Indexer(object):
         self.check_duplicate = check_duplicate
         self.keep_json = keep_json
         self.record_path = record_path or cfstore.record_path
-        self.db = DataBase(cfstore.db_path)
+        self.db = DataBase(cfstore.db_path, readonly=readonly)
+        self.metrics = Metrics()
+        self.metrics.set('spool_backlog', 0)
+        self.write_lock = threading.Lock()
         if record_path:
             self.check_path(record_path, '`record_path`')
 
@@ -59,13 +91,36 @@ class Indexer(object):
         self.logger.debug('keep_json = %r', self.keep_json)
         self.logger.debug('record_path = %r', self.record_path)
 
+    def sibling(self, check_duplicate=None, keep_json=None,
+                record_path=None):
+        """
+        Create an indexer sharing :attr:`write_lock` and :attr:`metrics`.
+
+        The new indexer has its own DB connection so that it can be
+        used in another thread.  Its DB is never opened with
+        ``readonly=True``.  Options not given are taken from this
+        indexer.
+
+        """
+        default = lambda val, defv: defv if val is None else val
+        if not record_path and self.record_path != self.cfstore.record_path:
+            record_path = self.record_path
+        indexer = self.__class__(
+            self.cfstore,
+            default(check_duplicate, self.check_duplicate),
+            default(keep_json, self.keep_json),
+            record_path)
+        indexer.write_lock = self.write_lock
+        indexer.metrics = self.metrics
+        return indexer
+
     def get_record_type(self, path):
         relpath = os.path.relpath(path, self.cfstore.record_path)
         dirs = relpath.split(os.path.sep, 1)
         return dirs[0] if dirs else None
 
     def check_path(self, path, name='path'):
-        if self.get_record_type(path) not in ['command', 'init', 'exit']:
+        if self.get_record_type(path) not in RECORD_TYPES:
             raise RuntimeError(
                 '{0} must be under {1}'.format(
                     name,
@@ -73,22 +128,66 @@ class Indexer(object):
                                  '{command,init,exit}',
                                  '')))
 
-    def index_record(self, json_path):
+    def get_spool_dirs(self):
+        """
+        Return directories under which record files are written.
+        """
+        record_path = os.path.abspath(self.record_path)
+        if self.get_record_type(record_path) in RECORD_TYPES:
+            return [record_path]
+        return [os.path.join(record_path, t) for t in RECORD_TYPES]
+
+    def get_manifest_key(self, path):
+        return os.path.relpath(path, self.cfstore.record_path)
+
+    def index_record(self, json_path, check_manifest=True, remove=True):
         """
         Import `json_path` and remove it if :attr:`keep_json` is false.
+
+        If :attr:`keep_json` is true, the file is recorded in the
+        manifest of indexed files in DB and it is skipped next time
+        unless its size or mtime is changed.  Set `check_manifest` to
+        false if the caller already checked it.
+
+        Set `remove` to false if the file should not be removed yet,
+        e.g., when the caller commits the DB later.  Return true if
+        the record is imported.
+
         """
         self.logger.debug('Indexing record: %s', json_path)
         json_path = os.path.abspath(json_path)
         self.check_path(json_path, '`json_path`')
 
-        with open(json_path) as fp:
-            try:
-                dct = json.load(fp)
-            except ValueError:
-                warnings.warn(
-                    'Ignoring invalid JSON file at: {0}'.format(json_path))
-                return
+        if self.keep_json and check_manifest:
+            stat = os.stat(json_path)
+            if self.db.is_indexed_file(self.get_manifest_key(json_path),
+                                       stat.st_size, stat.st_mtime):
+                self.logger.debug('Already indexed: %s', json_path)
+                return False
 
+        (_, dct, size, mtime) = load_record(json_path)
+        if dct is None:
+            warnings.warn(
+                'Ignoring invalid JSON file at: {0}'.format(json_path))
+            return False
+        self.import_record(json_path, dct, size, mtime)
+
+        if remove:
+            self.remove_records([json_path])
+        return True
+
+    def import_record(self, json_path, dct, size, mtime):
+        """
+        Import already loaded record `dct` read from `json_path`.
+
+        If :attr:`keep_json` is false but the file is already in the
+        manifest (e.g., imported by :func:`catch_up`), it is not
+        imported again but removed from the manifest.
+
+        """
+        if not self.keep_json and self.db.remove_indexed_file(
+                self.get_manifest_key(json_path), size, mtime):
+            return
         record_type = self.get_record_type(json_path)
         kwds = {}
         if record_type == 'command':
@@ -101,25 +200,438 @@ class Indexer(object):
         else:
             raise ValueError("Unknown record type: {0}".format(record_type))
         importer(dct, **kwds)
+        if self.keep_json:
+            self.db.add_indexed_file(self.get_manifest_key(json_path),
+                                     size, mtime)
 
-        if not self.keep_json:
+    def remove_records(self, paths):
+        """
+        Remove record files unless :attr:`keep_json` is true.
+
+        Directories of past days emptied by removing them are removed
+        as well (see :meth:`remove_empty_dirs`).
+
+        """
+        if self.keep_json:
+            return
+        for json_path in paths:
             self.logger.info('Removing JSON record: %s', json_path)
-            os.remove(json_path)
+            try:
+                os.remove(json_path)
+            except OSError:
+                pass  # removed by another indexer
+        self.remove_empty_dirs(set(map(os.path.dirname, paths)))
+
+    def is_past_dir(self, path):
+        """
+        Return true if `path` is a record directory of a past day.
+
+        See :func:`rash.record.is_past_record_dir`.  Unless
+        :attr:`keep_json` is true, such a directory is removed once it
+        is emptied.  Otherwise, it is not visited again by the record
+        watchers and :meth:`find_files_in_changed_dirs` once its mtime
+        is settled.
+
+        """
+        parts = self.get_manifest_key(path).split(os.path.sep, 1)
+        return (len(parts) == 2 and parts[0] in RECORD_TYPES and
+                is_past_record_dir(parts[1]))
+
+    def remove_empty_dirs(self, dirs):
+        """
+        Remove empty directories of past days in `dirs` and parents.
+
+        Their high-water marks recorded by :func:`catch_up` are
+        removed too.  Return the number of removed directories.
+
+        """
+        removed = []
+        for path in sorted(dirs, reverse=True):
+            while self.is_past_dir(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    break  # not empty, or removed by another indexer
+                self.logger.debug('Removed empty directory: %s', path)
+                removed.append(self.get_manifest_key(path) + os.path.sep)
+                path = os.path.dirname(path)
+        if removed:
+            self.db.set_indexed_dirs({}, removed)
+        return len(removed)
+
+    def index_records(self, paths):
+        """
+        Index records at `paths` at once and return the number of them.
+
+        Paths are indexed in the given order but duplicates and
+        files which do not exist anymore are ignored.  A record which
+        cannot be indexed is logged and skipped.  All records are
+        committed in one transaction and JSON files are removed
+        after that.
+
+        The records are counted in gauge ``spool_backlog`` until they
+        are committed, including the time waiting for
+        :attr:`write_lock`.
+
+        """
+        num = len(set(paths))
+        self.metrics.add('spool_backlog', num)
+        try:
+            return self._index_records(paths)
+        finally:
+            self.metrics.add('spool_backlog', -num)
+
+    @synchronized
+    def _index_records(self, paths):
+        done = set()
+        imported = []
+        mtimes = []
+        start = time.time()
+        with self.db.connection():
+            for json_path in paths:
+                if json_path in done:
+                    continue
+                done.add(json_path)
+                try:
+                    mtime = os.stat(json_path).st_mtime
+                except OSError:
+                    continue
+                try:
+                    if self.index_record(json_path, remove=False):
+                        imported.append(json_path)
+                        mtimes.append(mtime)
+                except Exception:
+                    self.logger.exception('Failed to index %s', json_path)
+                    self.metrics.inc('records_failed')
+        self._observe_batch(start, mtimes)
+        self.remove_records(imported)
+        return len(imported)
+
+    def _observe_batch(self, start, mtimes):
+        if not mtimes:
+            return
+        now = time.time()
+        self.metrics.observe_batch(len(mtimes), now - start, mtimes, now)
 
     def find_record_files(self):
         """
         Yield paths to record files.
+
+        Files are yielded in a sorted order, but only one directory is
+        sorted at a time so that the whole tree is not loaded in memory.
+
         """
-        for (root, _, files) in os.walk(self.record_path):
-            for f in (f for f in files if f.endswith('.json')):
+        for (root, dirs, files) in os.walk(self.record_path):
+            dirs.sort()
+            for f in sorted(f for f in files if f.endswith('.json')):
                 yield os.path.join(root, f)
 
-    def index_all(self):
+    def find_unindexed_files(self, db=None, seen=None):
+        """
+        Yield paths to record files which are not indexed yet.
+
+        Unless :attr:`keep_json` is true, it is the same as
+        :meth:`find_record_files`.  Manifest of indexed files is read
+        from `db` if given (default to :attr:`db`).  If `seen` (a set)
+        is given, manifest keys of all found files are added to it.
+
+        """
+        if not self.keep_json:
+            for json_path in self.find_record_files():
+                if seen is not None:
+                    seen.add(self.get_manifest_key(json_path))
+                yield json_path
+            return
+        db = db or self.db
+        with db.connection():
+            manifest = db.get_indexed_files()
+        self.logger.debug('%d files are already indexed', len(manifest))
+        for json_path in self.find_record_files():
+            stat = os.stat(json_path)
+            key = self.get_manifest_key(json_path)
+            if seen is not None:
+                seen.add(key)
+            if manifest.get(key) != (stat.st_size, stat.st_mtime):
+                yield json_path
+
+    def find_files_in_changed_dirs(self, db=None):
+        """
+        Find record files in directories changed since the last call.
+
+        Return a tuple ``(paths, marks, removed)``.  Only directories
+        whose mtime differs from the high-water mark recorded in the
+        manifest (see :meth:`DataBase.get_indexed_dirs`) are listed
+        and `paths` are files in them which are not in the manifest.
+        `marks` is a dict ``{key: mtime}`` of new high-water marks and
+        `removed` is a list of keys of directories which do not exist
+        anymore.  The caller should record them using
+        :meth:`DataBase.set_indexed_dirs` after `paths` are indexed.
+
+        The mark of a directory modified within :attr:`mtime_slack`
+        seconds is None so that it is listed again next time, as
+        files may still be written in it (see also
+        :class:`rash.watchrecord.RecordPoller`).  If :attr:`keep_json`
+        is true, directories of past days (see :meth:`is_past_dir`)
+        whose marks are settled are not even stat'ed.
+
+        """
+        from .watchrecord import list_directory
+        db = db or self.db
+        with db.connection():
+            dirmarks = db.get_indexed_dirs()
+        subdirs = {}
+        for key in dirmarks:
+            parent = os.path.dirname(key[:-len(os.path.sep)])
+            subdirs.setdefault(parent + os.path.sep, []).append(key)
+
+        now = time.time()
+        paths = []
+        marks = {}
+        visited = set()
+        stack = self.get_spool_dirs()[::-1]
+        while stack:
+            path = stack.pop()
+            key = self.get_manifest_key(path) + os.path.sep
+            if dirmarks.get(key) is not None and self.keep_json and \
+                    self.is_past_dir(path):
+                mtime = dirmarks[key]  # settled; not modified anymore
+            else:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue  # not created yet, or removed
+            visited.add(key)
+            if key in dirmarks and dirmarks[key] == mtime:
+                stack.extend(
+                    os.path.join(self.cfstore.record_path, sub)
+                    for sub in sorted(subdirs.get(key, []), reverse=True))
+                continue
+            (files, dirs) = list_directory(path)
+            paths.extend(self._find_unindexed_in(db, path, key, files))
+            stack.extend(os.path.join(path, d)
+                         for d in sorted(dirs, reverse=True))
+            mark = mtime if now - mtime > self.mtime_slack else None
+            if key not in dirmarks or dirmarks[key] != mark:
+                marks[key] = mark
+        removed = [key for key in dirmarks if key not in visited]
+        return (paths, marks, removed)
+
+    def _find_unindexed_in(self, db, path, key, files):
+        with db.connection():
+            manifest = db.get_indexed_files(prefix=key)
+        for name in sorted(files):
+            if not name.endswith('.json'):
+                continue
+            json_path = os.path.join(path, name)
+            try:
+                stat = os.stat(json_path)
+            except OSError:
+                continue
+            if manifest.get(self.get_manifest_key(json_path)) != \
+                    (stat.st_size, stat.st_mtime):
+                yield json_path
+
+    @synchronized
+    def prune_manifest(self, seen):
+        """
+        Remove manifest entries of files removed or moved.
+
+        Entries under :attr:`record_path` whose keys are not in `seen`
+        (see :meth:`find_unindexed_files`) and whose files do not
+        exist anymore are removed.  Return the number of them.
+
+        """
+        prefix = self.get_manifest_key(self.record_path)
+        prefix = '' if prefix == os.curdir else prefix + os.path.sep
+        stale = [
+            key for key in self.db.get_indexed_files()
+            if key.startswith(prefix) and key not in seen and
+            not os.path.exists(os.path.join(self.cfstore.record_path, key))]
+        if stale:
+            self.logger.debug('Pruning %d manifest entries', len(stale))
+            self.db.prune_indexed_files(stale)
+        return len(stale)
+
+    @synchronized
+    def import_loaded_records(self, records):
+        """
+        Import a batch of :func:`load_record` results in one transaction.
+
+        JSON files are removed only after the transaction is committed.
+        Return the number of imported records.
+
+        """
+        imported = []
+        mtimes = []
+        start = time.time()
+        with self.db.connection():
+            for (json_path, dct, size, mtime) in records:
+                if size is None:
+                    continue  # removed by another indexer
+                if dct is None:
+                    warnings.warn(
+                        'Ignoring invalid JSON file at: {0}'.format(json_path))
+                    self.metrics.inc('records_failed')
+                    continue
+                self.import_record(json_path, dct, size, mtime)
+                imported.append(json_path)
+                mtimes.append(mtime)
+        self._observe_batch(start, mtimes)
+        self.remove_records(imported)
+        return len(imported)
+
+    def index_all(self, jobs=4, batch_size=500, max_pending=4,
+                  progress=None):
         """
         Index all records under :attr:`record_path`.
+
+        Record files are read and decoded by `jobs` threads, in
+        batches of `batch_size` files.  Batches are imported by this
+        thread in the order of :meth:`find_record_files` and each
+        batch is committed at once.  At most `max_pending` batches are
+        decoded ahead of the import, so that memory usage is bounded
+        even when there are a huge number of records.  Files found but
+        not imported yet are counted in gauge ``spool_backlog``.  Then
+        the manifest of indexed files is pruned (see
+        :meth:`prune_manifest`).
+
+        :type      jobs: int
+        :arg       jobs: number of threads to read files.
+                         If it is 1, no thread is started.
+        :type  progress: callable or None
+        :arg   progress: called as ``progress(num_indexed, seconds)``
+                         after each batch.
+
         """
+        from collections import deque
+        from .utils.iterutils import chunks
+
         self.logger.debug('Start indexing all records under: %s',
                           self.record_path)
-        with self.db.connection():
-            for json_path in sorted(self.find_record_files()):
-                self.index_record(json_path)
+        start = time.time()
+        seen = set()
+        batches = chunks(self.find_unindexed_files(seen=seen), batch_size)
+        if jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            load = lambda batch: pool.apply_async(load_records, (batch,))
+        else:
+            pool = None
+            load = lambda batch: DoneResult(load_records(batch))
+
+        indexed = 0
+        pending = deque()
+
+        def import_next():
+            (size, result) = pending.popleft()
+            try:
+                return self.import_loaded_records(result.get())
+            finally:
+                self.metrics.add('spool_backlog', -size)
+
+        try:
+            for batch in batches:
+                self.metrics.add('spool_backlog', len(batch))
+                pending.append((len(batch), load(batch)))
+                if len(pending) < max_pending:
+                    continue
+                indexed += import_next()
+                self._report_progress(progress, indexed, start)
+            while pending:
+                indexed += import_next()
+                self._report_progress(progress, indexed, start)
+        finally:
+            self.metrics.add('spool_backlog',
+                             -sum(size for (size, _) in pending))
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.prune_manifest(seen)
+        self.logger.debug('Indexed %d records in %.3f sec.',
+                          indexed, time.time() - start)
+        return indexed
+
+    def _report_progress(self, progress, indexed, start):
+        elapsed = time.time() - start
+        self.logger.info('Indexed %d records in %.1f sec.', indexed, elapsed)
+        if progress:
+            progress(indexed, elapsed)
+
+
+class DoneResult(object):
+
+    """
+    Result of a function already called (mimics ``AsyncResult``).
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def load_record(json_path):
+    """
+    Read a record file and return ``(json_path, dct, size, mtime)``.
+
+    `dct` is None if the file is not a valid JSON.  `size` and
+    `mtime` are also None if the file does not exist.
+
+    """
+    try:
+        stat = os.stat(json_path)
+        with open(json_path) as fp:
+            data = fp.read()
+    except (IOError, OSError):
+        return (json_path, None, None, None)
+    try:
+        dct = json.loads(data)
+    except ValueError:
+        dct = None
+    return (json_path, dct, stat.st_size, stat.st_mtime)
+
+
+def load_records(paths):
+    return [load_record(json_path) for json_path in paths]
+
+
+def catch_up(cfstore):
+    """
+    Index pending records before searching.
+
+    This is called before searching so that the latest commands are
+    found even if the daemon is not running.
+
+    If another process holds the index lock (i.e., the daemon or
+    ``rash index`` is running), nothing is done as the records are
+    indexed by that process.  Otherwise records are indexed in this
+    process.  Only directories changed since the last catch-up are
+    listed (see :meth:`Indexer.find_files_in_changed_dirs`) and DB is
+    opened for writing only when there is something to record, so
+    that this is cheap when there is nothing to index.  Record files
+    are not removed but recorded in the manifest of indexed files,
+    since whether the daemon keeps them (``--keep-json``) is not known
+    here.
+
+    Return the number of indexed records, or None if they are not
+    indexed because the lock is held.
+
+    """
+    from .utils.lockfile import FileLock
+    lock = FileLock(cfstore.index_lock_path)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        indexer = Indexer(cfstore, check_duplicate=True, keep_json=True,
+                          readonly=True)
+        (paths, marks, removed) = indexer.find_files_in_changed_dirs()
+        if not (paths or marks or removed):
+            return 0
+        indexer = indexer.sibling()
+        indexed = indexer.index_records(paths) if paths else 0
+        if marks or removed:
+            indexer.db.set_indexed_dirs(marks, removed)
+        return indexed
+    finally:
+        lock.release()
@@ -0,0 +1,278 @@
+"""
+Minimal Linux inotify binding based on ctypes.
+
+This is used by RASH daemon to watch record directories without
+depending on watchdog.  Only the events needed to know that a record
+file is completely written are used: ``IN_CLOSE_WRITE`` and
+``IN_MOVED_TO``.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from .utils.pathutils import mkdirp
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_STRUCT = struct.Struct('iIII')
+
+
+def load_libc():
+    """
+    Return libc having inotify functions or None if not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not all(hasattr(libc, name) for name in
+               ['inotify_init1', 'inotify_add_watch', 'inotify_rm_watch']):
+        return None
+    return libc
+
+_libc = load_libc()
+
+
+def is_available():
+    return _libc is not None
+
+
+def _check_call(ret, *args):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), *args)
+    return ret
+
+
+class Inotify(object):
+
+    """
+    Thin wrapper of an inotify file descriptor.
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise RuntimeError('inotify is not available.')
+        self.fd = _check_call(_libc.inotify_init1(IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        """
+        Watch `path` and return the watch descriptor.
+        """
+        return _check_call(
+            _libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask),
+            path)
+
+    def rm_watch(self, wd):
+        """
+        Stop watching the directory of the watch descriptor `wd`.
+        """
+        _check_call(_libc.inotify_rm_watch(self.fd, wd), wd)
+
+    def read_events(self, timeout=None):
+        """
+        Return a list of ``(wd, mask, cookie, name)``.
+
+        Empty list is returned if no event is available within
+        `timeout` seconds.  If `timeout` is None, block until some
+        events come.
+
+        """
+        try:
+            (ready, _, _) = select.select([self.fd], [], [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_STRUCT.unpack_from(data, offset)
+            offset += EVENT_STRUCT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name.decode('utf-8')))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class RecordWatcher(object):
+
+    """
+    Watch record directories using inotify and index records in batch.
+
+    A record file is indexed only after it is closed
+    (``IN_CLOSE_WRITE``) or renamed into the directory
+    (``IN_MOVED_TO``), so half-written files are never read.
+    Events arriving within :attr:`batch_delay` seconds are indexed
+    together by :meth:`rash.indexer.Indexer.index_records` so that
+    they are committed at once.
+
+    """
+
+    file_mask = IN_CLOSE_WRITE | IN_MOVED_TO
+    dir_mask = file_mask | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+    batch_delay = 0.05
+    max_batch_size = 1000
+
+    def __init__(self, indexer):
+        """
+        :type indexer: rash.indexer.Indexer
+        """
+        self.indexer = indexer
+        self.inotify = Inotify()
+        self.watches = {}  # wd -> directory
+        for path in indexer.get_spool_dirs():
+            mkdirp(path)
+            self.add_tree(path)
+
+    def add_tree(self, path):
+        """
+        Watch `path` and its subdirectories.
+
+        Return a list of record files which already exist in the
+        directories, as they might be created before they are watched.
+
+        """
+        found = []
+        for (root, dirs, files) in os.walk(path):
+            found.extend(os.path.join(root, f)
+                         for f in files if f.endswith('.json'))
+            if self.is_settled(root):
+                continue
+            try:
+                wd = self.inotify.add_watch(root, self.dir_mask)
+            except OSError:
+                continue  # removed while walking
+            self.watches[wd] = root
+        return found
+
+    def is_settled(self, path):
+        """
+        Return true if `path` does not need to be watched anymore.
+
+        When :attr:`Indexer.keep_json` is true, a directory of a past
+        day (see :meth:`Indexer.is_past_dir`) is not watched once its
+        mtime is settled, so that the number of watches does not grow
+        every day.  Otherwise, such a directory is removed by the
+        indexer when it is emptied.
+
+        """
+        if not (self.indexer.keep_json and self.indexer.is_past_dir(path)):
+            return False
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime > self.indexer.mtime_slack
+
+    def drop_settled_watches(self):
+        """
+        Stop watching directories which became settled.
+        """
+        for (wd, root) in list(self.watches.items()):
+            if self.is_settled(root):
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass  # removed already
+                del self.watches[wd]
+
+    def collect(self, events):
+        """
+        Return paths to records which are ready to be indexed.
+        """
+        paths = []
+        for (wd, mask, _, name) in events:
+            if mask & IN_Q_OVERFLOW:
+                self.indexer.logger.warning(
+                    'inotify queue overflowed.  Indexing all records.')
+                paths.extend(self.indexer.find_record_files())
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self.watches.pop(wd, None)
+                continue
+            root = self.watches.get(wd)
+            if root is None:
+                continue
+            path = os.path.join(root, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    paths.extend(self.add_tree(path))
+                    # A new day started:
+                    self.drop_settled_watches()
+            elif mask & self.file_mask and name.endswith('.json'):
+                paths.append(path)
+        return paths
+
+    def poll(self, timeout=None):
+        """
+        Wait for records at most `timeout` seconds and index them.
+
+        Return the number of indexed records.
+
+        """
+        paths = self.collect(self.inotify.read_events(timeout))
+        while paths and len(paths) < self.max_batch_size:
+            events = self.inotify.read_events(self.batch_delay)
+            if not events:
+                break
+            paths.extend(self.collect(events))
+        if not paths:
+            return 0
+        return self.indexer.index_records(paths)
+
+    def run(self):
+        """
+        Keep indexing records until KeyboardInterrupt.
+        """
+        self.indexer.logger.debug('Start watching by inotify.')
+        try:
+            while True:
+                self.poll()
+        except KeyboardInterrupt:
+            self.indexer.logger.debug('Got KeyboardInterrupt. Stop watching.')
+        finally:
+            self.inotify.close()
@@ -15,7 +15,6 @@
 
 
 import re
-import shlex
 
 try:
     from percol.finder import FinderMultiQueryString
@@ -24,8 +23,7 @@ except ImportError:
     # Dummy class for making this module importable:
     FinderMultiQueryString = object
 
-from .search import search_add_arguments
-from .query import SafeArgumentParser, expand_query, preprocess_kwds
+from .query import QueryFrontend
 
 
 def strip_glob(string, split_str=' '):
@@ -58,8 +56,7 @@ class RashFinder(FinderMultiQueryString):
     def __init__(self, *args, **kwds):
         super(RashFinder, self).__init__(*args, **kwds)
 
-        self.__parser = parser = SafeArgumentParser()
-        search_add_arguments(parser)
+        self.__frontend = QueryFrontend(self.rashconfig, self.base_query)
 
     # Generator should be terminated in order to close connection to
     # sqlite.  Otherwise, sqlite3 modules raise an error saying that
@@ -71,9 +68,7 @@ class RashFinder(FinderMultiQueryString):
     def find(self, query, collection=None):
         try:
             # shlex < 2.7.3 does not work with unicode:
-            args = self.base_query + shlex.split(query.encode())
-            ns = self.__parser.parse_args(args)
-            kwds = preprocess_kwds(expand_query(self.rashconfig, vars(ns)))
+            kwds = self.__frontend.parse(query.encode())
         except (ValueError, SyntaxError):
             return super(RashFinder, self).find(query, collection)
 
@@ -112,12 +107,14 @@ def launch_isearch(cfstore, rcfile=None, input_encoding=None,
     import percol.actions as actions
 
     from .database import DataBase
+    from .indexer import catch_up
 
+    catch_up(cfstore)
     config = cfstore.get_config()
     default = lambda val, defv: defv if val is None else val
 
     # Pass db instance to finder.  Not clean but works and no harm.
-    RashFinder.db = DataBase(cfstore.db_path)
+    RashFinder.db = DataBase(cfstore.db_path, readonly=True)
     RashFinder.base_query = default(base_query, config.isearch.base_query)
     RashFinder.rashconfig = config
 
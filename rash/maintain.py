@@ -0,0 +1,350 @@
+"""
+Maintenance of RASH DB.
+
+SQLite does not collect statistics for the query planner nor reclaim
+free pages by itself.  :func:`maintain` runs these tasks:
+
+analyze
+  Collect statistics for the query planner (``ANALYZE``).
+optimize
+  Let SQLite run whatever it thinks useful (``PRAGMA optimize``).
+vacuum
+  Return free pages to the file system (``PRAGMA incremental_vacuum``).
+checkpoint
+  Write back and truncate WAL file if it is used
+  (``PRAGMA wal_checkpoint``).
+check
+  Check integrity of the DB (``PRAGMA integrity_check``).
+
+It is run by ``rash maintain`` and by the daemon when it is idle (see
+:class:`rash.config.MaintenanceConfig`).
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import sqlite3
+
+from .utils.jobqueue import JobQueue
+
+TASKS = ['analyze', 'optimize', 'vacuum', 'checkpoint', 'check']
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+PROBE_QUERIES = [
+    ('recent_commands', """
+    SELECT CL.command FROM command_history
+    LEFT JOIN command_list AS CL ON command_id = CL.id
+    ORDER BY start_time DESC LIMIT 100
+    """),
+    ('frequent_commands', """
+    SELECT command_id, COUNT(*) AS count FROM command_history
+    GROUP BY command_id ORDER BY count DESC LIMIT 100
+    """),
+]
+"""
+``(name, sql)`` of queries timed before and after maintenance.
+"""
+
+
+def file_size(path):
+    """
+    Return the total size of the DB file at `path` and its WAL file.
+    """
+    size = 0
+    for p in [path, path + '-wal']:
+        if os.path.exists(p):
+            size += os.path.getsize(p)
+    return size
+
+
+def time_probes(db):
+    timings = {}
+    for (name, sql) in PROBE_QUERIES:
+        start = time.time()
+        list(db.execute(sql))
+        timings[name] = time.time() - start
+    return timings
+
+
+def task_analyze(db, analysis_limit=0, **_):
+    if analysis_limit:
+        # Ignored by SQLite older than 3.32:
+        db.execute('PRAGMA analysis_limit = {0:d}'.format(analysis_limit))
+    db.execute('ANALYZE')
+
+
+def task_optimize(db, **_):
+    list(db.execute('PRAGMA optimize'))
+
+
+def task_vacuum(db, vacuum_pages=0, **_):
+    """
+    Reclaim at most `vacuum_pages` free pages (0 means all).
+
+    Incremental vacuum is only possible when ``auto_vacuum`` is
+    ``INCREMENTAL``, which can be set to an existing DB only by a full
+    ``VACUUM``.  The full ``VACUUM`` is done only when there is no
+    budget (`vacuum_pages` is 0), i.e., when it is requested by
+    ``rash maintain`` rather than by the daemon.
+
+    """
+    ((mode,),) = db.execute('PRAGMA auto_vacuum')
+    ((before,),) = db.execute('PRAGMA freelist_count')
+    if mode == AUTO_VACUUM_INCREMENTAL:
+        # `execute` frees only one page as it steps the statement
+        # once.  `executescript` runs it to the end.
+        db.executescript(
+            'PRAGMA incremental_vacuum({0:d});'.format(vacuum_pages))
+    elif vacuum_pages:
+        return dict(skipped='full VACUUM is required; run rash maintain')
+    else:
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    ((after,),) = db.execute('PRAGMA freelist_count')
+    return dict(freed_pages=before - after)
+
+
+def task_checkpoint(db, **_):
+    ((busy, log, checkpointed),) = db.execute(
+        'PRAGMA wal_checkpoint(TRUNCATE)')
+    return dict(busy=busy, log=log, checkpointed=checkpointed)
+
+
+def task_check(db, **_):
+    messages = [row[0] for row in db.execute('PRAGMA integrity_check')]
+    return dict(ok=messages == ['ok'], messages=messages)
+
+
+def maintain(db, tasks=TASKS, time_budget=None, **kwds):
+    """
+    Run maintenance `tasks` on `db` and return a report (a dict).
+
+    :type           db: rash.database.DataBase
+    :type        tasks: list of str
+    :arg         tasks: names in :data:`TASKS`
+    :type  time_budget: float or None
+    :arg   time_budget: do not start the next task after this many
+                        seconds
+    :arg          kwds: budgets passed to tasks (`analysis_limit` and
+                        `vacuum_pages`)
+
+    """
+    start = time.time()
+    report = dict(size_before=file_size(db.dbpath), tasks={})
+    with db.connection() as connection:
+        report['probes_before'] = time_probes(connection)
+        for name in tasks:
+            if time_budget is not None and time.time() - start > time_budget:
+                report['tasks'][name] = dict(skipped='out of time budget')
+                continue
+            task_start = time.time()
+            try:
+                result = globals()['task_' + name](connection, **kwds)
+            except sqlite3.OperationalError as err:
+                result = dict(error=str(err))  # e.g., DB is locked
+            result = result or {}
+            result['seconds'] = time.time() - task_start
+            report['tasks'][name] = result
+        report['probes_after'] = time_probes(connection)
+    report['size_after'] = file_size(db.dbpath)
+    report['seconds'] = time.time() - start
+    return report
+
+
+def format_report(report):
+    """
+    Format `report` returned by :func:`maintain` as a list of lines.
+    """
+    lines = ['size: {0} -> {1} bytes ({2:.3f} sec)'.format(
+        report['size_before'], report['size_after'], report['seconds'])]
+    for name in TASKS:
+        if name not in report['tasks']:
+            continue
+        result = dict(report['tasks'][name])
+        seconds = result.pop('seconds', 0)
+        lines.append('{0}: {1:.3f} sec {2}'.format(
+            name, seconds,
+            ' '.join('{0}={1}'.format(*kv) for kv in sorted(result.items()))
+        ).rstrip())
+    for (name, before) in sorted(report['probes_before'].items()):
+        lines.append('probe {0}: {1:.4f} -> {2:.4f} sec'.format(
+            name, before, report['probes_after'][name]))
+    return lines
+
+
+class IdleMaintainer(object):
+
+    """
+    Run :func:`maintain` in a background thread while indexer is idle.
+
+    Maintenance is run every :attr:`config.interval` seconds (never if
+    it is 0), but only when nothing is indexed for :attr:`config.idle`
+    seconds.  It holds :attr:`rash.indexer.Indexer.write_lock` so that
+    no record is written by the daemon while it is running.  Requests
+    of ``rash maintain`` are run in the same thread (see :meth:`submit`).
+
+    """
+
+    check_interval = 10
+
+    def __init__(self, indexer, config, retention=None):
+        """
+        :type   indexer: rash.indexer.Indexer
+        :type    config: rash.config.MaintenanceConfig
+        :type retention: rash.config.RetentionConfig
+        :arg  retention: expired commands are forgotten before
+                         maintenance
+        """
+        self.indexer = indexer
+        self.config = config
+        self.retention = retention
+        self.logger = indexer.logger
+        self.last_run = self.started = time.time()
+        self.jobs = JobQueue(idle=self.run_if_due,
+                             idle_interval=self.check_interval)
+
+    def is_due(self, now):
+        if not self.config.interval:
+            return False
+        last_batch = self.indexer.metrics.last_batch_time or self.started
+        return (now - self.last_run >= self.config.interval and
+                now - last_batch >= self.config.idle)
+
+    def run_once(self):
+        from .database import DataBase
+        db = DataBase(self.indexer.cfstore.db_path)
+        if self.retention and (self.retention.max_age is not None or
+                               self.retention.max_count is not None):
+            self.forget_expired(db)
+        with self.indexer.write_lock:
+            report = maintain(
+                db,
+                tasks=self.config.tasks,
+                time_budget=self.config.time_budget,
+                analysis_limit=self.config.analysis_limit,
+                vacuum_pages=self.config.vacuum_pages)
+        self.last_run = time.time()
+        for line in format_report(report):
+            self.logger.info('DB maintenance: %s', line)
+        self.indexer.metrics.set('db_size_bytes', report['size_after'])
+        self.indexer.metrics.inc('maintenance_runs')
+        return report
+
+    def forget_expired(self, db):
+        from .forget import apply_retention
+        (deleted, garbage) = apply_retention(
+            db, self.retention, lock=self.indexer.write_lock)
+        self.logger.info('Forgot %d expired commands.', deleted)
+        for (table, count) in sorted(garbage.items()):
+            if count:
+                self.logger.info('Deleted %d unused rows from %s.',
+                                 count, table)
+
+    def run_if_due(self):
+        if self.is_due(time.time()):
+            try:
+                self.run_once()
+            except Exception:
+                self.logger.exception('DB maintenance failed.')
+
+    def submit(self, func, *args, **kwds):
+        """
+        Call `func` in the maintainer thread while holding the write lock.
+
+        Return a :class:`rash.utils.jobqueue.Job`.  Jobs are run one by
+        one, and never together with the idle maintenance.
+
+        """
+        return self.jobs.submit(self._call_locked, func, args, kwds)
+
+    def _call_locked(self, func, args, kwds):
+        with self.indexer.write_lock:
+            return func(*args, **kwds)
+
+    def start(self):
+        self.jobs.start()
+
+    def stop(self):
+        self.jobs.stop()
+
+
+def maintain_run(tasks, analysis_limit, vacuum_pages, time_budget):
+    """
+    Run maintenance tasks on RASH DB.
+
+    All tasks (analyze, optimize, vacuum, checkpoint and check) are
+    run by default.  The first vacuum of a DB created by old RASH
+    version runs a full VACUUM which may take long time, since it is
+    needed to enable incremental vacuum.  The daemon runs these tasks
+    except for check automatically when it is idle.
+
+    If the daemon is running, it runs the tasks instead, so that
+    they do not compete with indexing.
+
+    """
+    from .config import ConfigStore
+    from .database import DataBase
+    from .server import call_daemon_or_lock
+    cfstore = ConfigStore()
+    params = dict(tasks=tasks or TASKS, time_budget=time_budget,
+                  analysis_limit=analysis_limit, vacuum_pages=vacuum_pages)
+    report = call_daemon_or_lock(
+        cfstore, 'maintain',
+        lambda: maintain(DataBase(cfstore.db_path), **params),
+        **params)
+    for line in format_report(report):
+        print(line)
+    check = report['tasks'].get('check')
+    if check and not check.get('ok', True):
+        raise RuntimeError('Integrity check failed.')
+
+
+def task_name(name):
+    if name not in TASKS:
+        import argparse
+        raise argparse.ArgumentTypeError(
+            'invalid task: {0!r} (choose from {1})'.format(
+                name, ', '.join(TASKS)))
+    return name
+
+
+def maintain_add_arguments(parser):
+    parser.add_argument(
+        'tasks', nargs='*', type=task_name, metavar='TASK',
+        help="""
+        tasks to run ({0}).  Default is to run all of them.
+        """.format(', '.join(TASKS)))
+    parser.add_argument(
+        '--analysis-limit', default=0, type=int,
+        help="""
+        approximate number of rows to scan per index by ANALYZE.
+        0 means no limit.
+        """)
+    parser.add_argument(
+        '--vacuum-pages', default=0, type=int,
+        help='maximum number of pages to reclaim.  0 means no limit.')
+    parser.add_argument(
+        '--time-budget', type=float,
+        help='do not start the next task after this many seconds.')
+
+
+commands = [
+    ('maintain', maintain_add_arguments, maintain_run),
+]
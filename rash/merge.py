@@ -0,0 +1,275 @@
+"""
+Merge RASH DBs.
+
+:func:`merge` copies commands in another RASH DB (e.g., the one
+collected from another host) into a DB without going through
+:meth:`rash.database.DataBase.import_dict`.  The source DB is
+``ATTACH``-ed and everything is done by a fixed number of set-based
+SQL statements:
+
+1. Rows of ``command_list``, ``directory_list``, ``terminal_list``,
+   ``session_history``, ``environment_set`` and
+   ``environment_variable`` which are not in the destination yet are
+   inserted, and temporary tables mapping source IDs to destination
+   IDs are made by joining on their values.
+2. ``command_history`` rows are copied with the IDs replaced.  Rows
+   whose fingerprint (see :func:`rash.database.command_fingerprint`)
+   is already in the destination are skipped, so merging the same DB
+   twice does not duplicate commands.  Commands imported without
+   timestamps (``rash import-history``) have their source line in the
+   fingerprint, so repeated ones are merged as they are.  Duplicates
+   stored without fingerprint (``check_duplicate=False``) are skipped.
+3. Usage and transition statistics are updated by the differences
+   caused by the new rows.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+DICTIONARY_TABLES = [
+    ('command_list', ['command'], []),
+    ('directory_list', ['directory'], []),
+    ('terminal_list', ['terminal'], []),
+    ('session_history', ['session_long_id'], ['start_time', 'stop_time']),
+    ('environment_set', ['digest'], []),
+    ('environment_variable', ['variable_name', 'variable_value'], []),
+]
+"""
+``(table, key_columns, other_columns)`` of tables whose IDs are
+remapped.  Rows are identified by `key_columns`.
+"""
+
+COMMAND_HISTORY_COLUMNS = [
+    # (column, map table or None)
+    ('command_id', 'command_list'),
+    ('session_id', 'session_history'),
+    ('directory_id', 'directory_list'),
+    ('terminal_id', 'terminal_list'),
+    ('start_time', None),
+    ('stop_time', None),
+    ('exit_code', None),
+    ('fingerprint', None),
+    ('environment_set_id', 'environment_set'),
+    ('pipestatus', None),
+]
+
+
+def remap_table(db, table, keys, others):
+    """
+    Insert rows of `table` only in source and make its ID map.
+
+    The map is a temporary table ``merge_TABLE`` with columns
+    ``src_id`` and ``dst_id``.  Return the number of inserted rows.
+
+    """
+    columns = ', '.join(keys + others)
+    match = ' AND '.join('M.{0} = S.{0}'.format(k) for k in keys)
+    inserted = db.execute(
+        """
+        INSERT INTO main.{0} ({1})
+        SELECT {1} FROM src.{0} AS S
+        WHERE S.id IN (SELECT MIN(id) FROM src.{0} GROUP BY {2})
+          AND NOT EXISTS (SELECT 1 FROM main.{0} AS M WHERE {3})
+        ORDER BY S.id
+        """.format(table, columns, ', '.join(keys), match)).rowcount
+    db.execute('DROP TABLE IF EXISTS temp.merge_{0}'.format(table))
+    db.execute(
+        'CREATE TEMP TABLE merge_{0} '
+        '(src_id INTEGER PRIMARY KEY, dst_id INTEGER)'.format(table))
+    db.execute(
+        """
+        INSERT INTO temp.merge_{0} (src_id, dst_id)
+        SELECT S.id, MIN(M.id) FROM src.{0} AS S
+        JOIN main.{0} AS M ON {1}
+        GROUP BY S.id
+        """.format(table, match))
+    return inserted
+
+
+def merge_attached(db):
+    """
+    Merge DB attached as ``src`` into the main DB of connection `db`.
+    """
+    from .database import rebase_session_commands, select_session_environ, \
+        max_id, select_transitions, count_new_commands
+    report = {}
+    last_ids = dict((table, max_id(db, table))
+                    for (table, _, _) in DICTIONARY_TABLES)
+    last_ch_id = max_id(db, 'command_history')
+    for (table, keys, others) in DICTIONARY_TABLES:
+        report[table] = remap_table(db, table, keys, others)
+
+    # Sessions in both DBs: fill in times and environ missing in main.
+    for column in ['start_time', 'stop_time']:
+        db.execute(
+            """
+            UPDATE main.session_history SET {0} = (
+              SELECT S.{0} FROM src.session_history AS S
+              JOIN temp.merge_session_history AS SM ON S.id = SM.src_id
+              WHERE SM.dst_id = session_history.id)
+            WHERE {0} IS NULL AND id <= ?
+              AND id IN (SELECT dst_id FROM temp.merge_session_history)
+            """.format(column), [last_ids['session_history']])
+    rebase = [sh_id for (sh_id,) in db.execute(
+        """
+        SELECT DISTINCT SM.dst_id FROM src.session_environment_map AS E
+        JOIN temp.merge_session_history AS SM ON E.sh_id = SM.src_id
+        WHERE SM.dst_id <= ? AND SM.dst_id NOT IN
+          (SELECT sh_id FROM main.session_environment_map)
+        """, [last_ids['session_history']])]
+    db.execute(
+        """
+        INSERT INTO main.session_environment_map (sh_id, ev_id)
+        SELECT SM.dst_id, VM.dst_id FROM src.session_environment_map AS E
+        JOIN temp.merge_session_history AS SM ON E.sh_id = SM.src_id
+        JOIN temp.merge_environment_variable AS VM ON E.ev_id = VM.src_id
+        WHERE SM.dst_id NOT IN
+          (SELECT sh_id FROM main.session_environment_map)
+        """)
+    for sh_id in rebase:
+        # Commands already in main were stored against empty baseline.
+        rebase_session_commands(db, sh_id, {},
+                                select_session_environ(db, sh_id))
+    db.execute(
+        """
+        INSERT OR IGNORE INTO main.environment_set_map (es_id, ev_id)
+        SELECT SM.dst_id, VM.dst_id FROM src.environment_set_map AS E
+        JOIN temp.merge_environment_set AS SM ON E.es_id = SM.src_id
+        JOIN temp.merge_environment_variable AS VM ON E.ev_id = VM.src_id
+        WHERE SM.dst_id > ?
+        """, [last_ids['environment_set']])
+
+    # Transitions in the sessions getting new commands are counted
+    # before and after inserting commands.
+    db.execute('DROP TABLE IF EXISTS temp.merge_sessions')
+    db.execute(
+        """
+        CREATE TEMP TABLE merge_sessions AS
+        SELECT DISTINCT SM.dst_id AS id FROM src.command_history AS H
+        JOIN temp.merge_session_history AS SM ON H.session_id = SM.src_id
+        WHERE H.fingerprint IS NOT NULL AND H.fingerprint NOT IN
+          (SELECT fingerprint FROM main.command_history
+           WHERE fingerprint IS NOT NULL)
+        """)
+    select_transitions(db, 'merge_transition_before', 'merge_sessions')
+
+    columns = []
+    sources = []
+    joins = []
+    for (column, table) in COMMAND_HISTORY_COLUMNS:
+        columns.append(column)
+        if table:
+            alias = 'M_' + column
+            sources.append('{0}.dst_id'.format(alias))
+            joins.append(
+                'LEFT JOIN temp.merge_{0} AS {1} ON H.{2} = {1}.src_id'
+                .format(table, alias, column))
+        else:
+            sources.append('H.' + column)
+    # Duplicates in source (no fingerprint) cannot be told from
+    # already merged ones.  They are skipped.
+    report['command_history'] = db.execute(
+        """
+        INSERT OR IGNORE INTO main.command_history ({0})
+        SELECT {1} FROM src.command_history AS H {2}
+        WHERE H.fingerprint IS NOT NULL
+        ORDER BY H.id
+        """.format(', '.join(columns), ', '.join(sources),
+                   ' '.join(joins))).rowcount
+    ((total,),) = db.execute('SELECT COUNT(*) FROM src.command_history')
+    report['skipped'] = total - report['command_history']
+
+    count_new_commands(db, last_ch_id, 'merge_sessions',
+                       'merge_transition_before')
+
+    for table in (['merge_{0}'.format(t) for (t, _, _) in DICTIONARY_TABLES]
+                  + ['merge_sessions']):
+        db.execute('DROP TABLE temp.{0}'.format(table))
+    return report
+
+
+def merge(db, source):
+    """
+    Merge commands in RASH DB at path `source` into `db`.
+
+    The source DB is migrated first if its schema is old.  Everything
+    is done in one transaction.  Return a dict which maps table name
+    to the number of inserted rows.  Key ``skipped`` is the number of
+    commands in `source` not merged, i.e., the ones already in `db`.
+
+    :type db: rash.database.DataBase
+
+    """
+    from .database import DataBase
+    if os.path.exists(db.dbpath) and os.path.samefile(db.dbpath, source):
+        raise ValueError('Cannot merge DB to itself: {0}'.format(source))
+    DataBase(source, readonly=True)
+    with db.connection() as connection:
+        connection.execute('ATTACH DATABASE ? AS src', [source])
+        try:
+            report = merge_attached(connection)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.execute('DETACH DATABASE src')
+    return report
+
+
+def merge_run(sources):
+    """
+    Merge commands in other RASH DBs into RASH DB.
+
+    This is useful to combine histories collected on several hosts.
+    Commands already in RASH DB are skipped, so it is safe to merge
+    the same DB again (e.g., an updated copy of it).  Example::
+
+      scp host1:.config/rash/data/db.sqlite host1.sqlite
+      rash merge host1.sqlite
+
+    If the daemon is running, it merges the DBs instead so that
+    merging does not compete with indexing.
+
+    """
+    from .config import ConfigStore
+    from .database import DataBase
+    from .server import call_daemon_or_lock
+    cfstore = ConfigStore()
+    for source in sources:
+        if not os.path.exists(source):
+            raise RuntimeError('No such DB: {0}'.format(source))
+    for source in map(os.path.abspath, sources):
+        report = call_daemon_or_lock(
+            cfstore, 'merge',
+            lambda: merge(DataBase(cfstore.db_path), source),
+            source=source)
+        print('Merged {0} commands from {1} ({2} already merged).'.format(
+            report['command_history'], source, report['skipped']))
+
+
+def merge_add_arguments(parser):
+    parser.add_argument(
+        'sources', nargs='+', metavar='DB',
+        help='path to RASH DB (db.sqlite) to merge.')
+
+
+commands = [
+    ('merge', merge_add_arguments, merge_run),
+]
@@ -0,0 +1,186 @@
+"""
+Counters and histograms of RASH daemon.
+
+Metrics are kept in memory by :class:`Metrics` and exposed by the
+``status`` method of the daemon socket (see :mod:`rash.server`),
+which ``rash daemon --status`` reads.
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+
+class Histogram(object):
+
+    """
+    Cumulative histogram with fixed bucket upper bounds.
+
+    >>> hist = Histogram([1, 10])
+    >>> for value in [0.5, 2, 20]:
+    ...     hist.observe(value)
+    >>> hist.to_dict()['buckets']
+    [[1, 1], [10, 2], ['+Inf', 3]]
+
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for (i, bound) in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for (bound, count) in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            yield (bound, total)
+
+    def to_dict(self):
+        return dict(buckets=[list(b) for b in self.cumulative()],
+                    sum=self.sum, count=self.count)
+
+
+class Metrics(object):
+
+    """
+    Thread-safe store of counters, gauges and histograms.
+    """
+
+    histogram_bounds = {
+        'batch_size': [1, 10, 100, 1000, 10000],
+        'commit_seconds': [0.001, 0.01, 0.1, 1, 10],
+        'lag_seconds': [0.1, 1, 10, 60, 600, 3600, 86400],
+    }
+
+    descriptions = {
+        'records_indexed': 'Number of record files imported into DB.',
+        'records_failed': 'Number of record files failed to import.',
+        'batches': 'Number of committed batches.',
+        'batch_size': 'Number of records committed at once.',
+        'commit_seconds': 'Time to import and commit a batch.',
+        'lag_seconds': 'Time from record file mtime to its commit.',
+        'spool_backlog': 'Number of record files found but not indexed.',
+        'uptime_seconds': 'Seconds since the daemon started.',
+        'db_size_bytes': 'Size of DB file after the last maintenance.',
+        'maintenance_runs': 'Number of DB maintenance runs.',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = dict(
+            (name, Histogram(bounds))
+            for (name, bounds) in self.histogram_bounds.items())
+        self.last_batch_time = None
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add(self, name, value):
+        """
+        Add `value` to gauge `name` (it can be negative).
+        """
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def observe_batch(self, size, seconds, mtimes, now):
+        """
+        Record metrics of a batch committed at `now`.
+        """
+        with self.lock:
+            self.last_batch_time = now
+            self.counters['batches'] = self.counters.get('batches', 0) + 1
+            self.counters['records_indexed'] = (
+                self.counters.get('records_indexed', 0) + size)
+            self.histograms['batch_size'].observe(size)
+            self.histograms['commit_seconds'].observe(seconds)
+            for mtime in mtimes:
+                self.histograms['lag_seconds'].observe(max(now - mtime, 0))
+
+    def to_dict(self):
+        with self.lock:
+            return dict(
+                counters=dict(self.counters),
+                gauges=dict(self.gauges),
+                histograms=dict(
+                    (name, hist.to_dict())
+                    for (name, hist) in self.histograms.items()))
+
+
+def format_prometheus(status, prefix='rash_'):
+    """
+    Format `status` (:meth:`Metrics.to_dict`) in Prometheus text format.
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('records_indexed', 3)
+    >>> print(format_prometheus(dict(counters=metrics.to_dict()['counters'],
+    ...                              gauges={}, histograms={})))
+    # HELP rash_records_indexed_total Number of record files imported into DB.
+    # TYPE rash_records_indexed_total counter
+    rash_records_indexed_total 3
+    <BLANKLINE>
+
+    """
+    lines = []
+    describe = Metrics.descriptions.get
+
+    def header(name, key, kind):
+        if describe(key):
+            lines.append('# HELP {0} {1}'.format(name, describe(key)))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    for (key, value) in sorted(status['counters'].items()):
+        name = '{0}{1}_total'.format(prefix, key)
+        header(name, key, 'counter')
+        lines.append('{0} {1}'.format(name, value))
+    for (key, value) in sorted(status['gauges'].items()):
+        if value is None:
+            continue
+        name = prefix + key
+        header(name, key, 'gauge')
+        lines.append('{0} {1}'.format(name, value))
+    for (key, hist) in sorted(status['histograms'].items()):
+        name = prefix + key
+        header(name, key, 'histogram')
+        for (bound, count) in hist['buckets']:
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                name, bound, count))
+        lines.append('{0}_sum {1}'.format(name, hist['sum']))
+        lines.append('{0}_count {1}'.format(name, hist['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,91 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+
+def nav_run(cwd, before_id, after_id, skip_command, no_daemon, output):
+    """
+    Walk through commands run in a directory, one step at a time.
+
+    It prints the ID and the command separated by a tab.  Give the
+    printed ID to --before-id to get the previous one (and to
+    --after-id to go forward).  Without --before-id and --after-id,
+    the latest command run in the directory is printed.  Nothing is
+    printed when there is no more command.
+
+    This is meant to be used as a replacement of Up/Down arrow in
+    shell.  For example, in zsh::
+
+      _rash_nav_id=""
+      rash-zle-nav-up(){
+        local result
+        result="$(rash nav --cwd "$PWD" ${_rash_nav_id:+--before-id} \\
+                  $_rash_nav_id --skip-command "$BUFFER")" || return
+        [ -z "$result" ] && return
+        _rash_nav_id="${result%%$'\\t'*}"
+        BUFFER="${result#*$'\\t'}"
+        CURSOR=$#BUFFER
+      }
+      zle -N rash-zle-nav-up
+      bindkey "^[[1;5A" rash-zle-nav-up   # Ctrl-Up
+      # Reset position when a new command line is started
+      zle-line-init(){ _rash_nav_id="" }
+      zle -N zle-line-init
+
+    The query is sent to the daemon if it is running.
+
+    """
+    from .config import ConfigStore
+    from .server import call_daemon_or_db
+    result = call_daemon_or_db(
+        ConfigStore(), 'nav', no_daemon,
+        cwd=os.path.abspath(cwd), before_id=before_id, after_id=after_id,
+        skip_command=skip_command)
+    if result:
+        output.write('{command_history_id}\t{command}\n'.format(**result))
+
+
+def nav_add_arguments(parser):
+    import argparse
+    parser.add_argument(
+        '--cwd', '-d', default='.',
+        help='directory in which commands are run.')
+    parser.add_argument(
+        '--before-id', '-b', type=int, metavar='ID',
+        help='print the latest command older than this ID.')
+    parser.add_argument(
+        '--after-id', '-a', type=int, metavar='ID',
+        help='print the oldest command newer than this ID.')
+    parser.add_argument(
+        '--skip-command', metavar='COMMAND',
+        help="""
+        skip this command.  Useful to skip repeated commands by
+        passing the current command line.
+        """)
+    parser.add_argument(
+        '--no-daemon', action='store_true', default=False,
+        help='always read DB directly rather than asking daemon.')
+    parser.add_argument(
+        '--output', default='-', type=argparse.FileType('w'),
+        help="""
+        Output file to write the results in. Default is stdout.
+        """)
+
+
+commands = [
+    ('nav', nav_add_arguments, nav_run),
+]
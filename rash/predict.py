@@ -0,0 +1,77 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+
+def predict_run(after, session_id, cwd, limit, no_daemon, output):
+    """
+    Print commands likely to be run next.
+
+    Commands are ranked by how many times they are run right after
+    the last command (--after) in the same shell session.  Commands
+    run after it in the directory given by --cwd are preferred.
+
+    If --after is not given, the last command recorded in the session
+    given by --session-id is used.  In zsh/bash, the current session
+    ID is stored in ``$_RASH_SESSION_ID``::
+
+      rash predict --session-id "$_RASH_SESSION_ID"
+
+    The query is sent to the daemon if it is running.
+
+    """
+    from .config import ConfigStore
+    from .server import call_daemon_or_db
+    commands = call_daemon_or_db(
+        ConfigStore(), 'predict', no_daemon,
+        after=after, session_id=session_id, cwd=os.path.abspath(cwd),
+        limit=limit)
+    for command in commands:
+        output.write(command)
+        output.write('\n')
+
+
+def predict_add_arguments(parser):
+    import argparse
+    parser.add_argument(
+        '--after', '-a', metavar='COMMAND',
+        help='the last command.')
+    parser.add_argument(
+        '--session-id',
+        help="""
+        RASH session ID.  The last command in this session is used
+        when --after is not given.
+        """)
+    parser.add_argument(
+        '--cwd', '-d', default='.',
+        help='prefer commands run in this directory.')
+    parser.add_argument(
+        '--limit', '-l', type=int, default=10,
+        help='maximum number of commands to print.')
+    parser.add_argument(
+        '--no-daemon', action='store_true', default=False,
+        help='always read DB directly rather than asking daemon.')
+    parser.add_argument(
+        '--output', default='-', type=argparse.FileType('w'),
+        help="""
+        Output file to write the results in. Default is stdout.
+        """)
+
+
+commands = [
+    ('predict', predict_add_arguments, predict_run),
+]
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import shlex
 from argparse import ArgumentParser
 
 from .search import SORT_KEY_SYNONYMS, search_add_arguments
@@ -29,6 +30,57 @@ class SafeArgumentParser(ArgumentParser):
     print_help = print_version = print_usage
 
 
+def get_search_parser():
+    """
+    Return a :class:`SafeArgumentParser` for search query (shared).
+
+    Adding search arguments to a parser takes much longer than parsing
+    a query with it, so the parser is created only once per process.
+
+    """
+    global _SEARCH_PARSER
+    if _SEARCH_PARSER is None:
+        _SEARCH_PARSER = SafeArgumentParser()
+        search_add_arguments(_SEARCH_PARSER)
+    return _SEARCH_PARSER
+_SEARCH_PARSER = None
+
+
+def copy_kwds(kwds):
+    """
+    Copy `kwds` so that lists in it can be modified in place safely.
+
+    >>> kwds = {'include_pattern': ['*a*'], 'limit': 10}
+    >>> copied = copy_kwds(kwds)
+    >>> copied['include_pattern'].append('*b*')
+    >>> kwds['include_pattern']
+    ['*a*']
+
+    """
+    return dict((k, list(v) if isinstance(v, list) else v)
+                for (k, v) in kwds.items())
+
+
+def parse_alias(expansion):
+    """
+    Parse alias `expansion` (a list of str) and return a dict.
+
+    Result is cached as the same alias is expanded over and over
+    again in isearch.  Do not modify the returned value; use
+    :func:`copy_kwds` first.
+
+    """
+    key = tuple(expansion)
+    try:
+        return _ALIAS_CACHE[key]
+    except KeyError:
+        pass
+    ns = get_search_parser().parse_args(list(expansion))
+    _ALIAS_CACHE[key] = parsed = vars(ns)
+    return parsed
+_ALIAS_CACHE = {}
+
+
 def expand_query(config, kwds):
     """
     Expand `kwds` based on `config.search.query_expander`.
@@ -45,10 +97,7 @@ def expand_query(config, kwds):
         if expansion is None:
             pattern.append(query)
         else:
-            parser = SafeArgumentParser()
-            search_add_arguments(parser)
-            ns = parser.parse_args(expansion)
-            for (key, value) in vars(ns).items():
+            for (key, value) in copy_kwds(parse_alias(expansion)).items():
                 if isinstance(value, (list, tuple)):
                     if not kwds.get(key):
                         kwds[key] = value
@@ -67,7 +116,7 @@ def preprocess_kwds(kwds):
     from .utils.timeutils import parse_datetime, parse_duration
 
     for key in ['output', 'format', 'format_level',
-                'with_command_id', 'with_session_id']:
+                'with_command_id', 'with_session_id', 'db', 'jobs']:
         kwds.pop(key, None)
 
     for key in ['time_after', 'time_before']:
@@ -92,3 +141,66 @@ def preprocess_kwds(kwds):
         kwds['sort_by'] = ['count']
     kwds['sort_by'] = [SORT_KEY_SYNONYMS[k] for k in kwds['sort_by']]
     return kwds
+
+
+class QueryFrontend(object):
+
+    """
+    Memoized query parser for search and isearch.
+
+    Parsing query string, expanding aliases and applying
+    :attr:`.config.SearchConfig.kwds_adapter` are done only once for
+    each query string.  As :attr:`~.config.SearchConfig.kwds_adapter`
+    is called only for the first time, it must not depend on anything
+    other than its argument.
+
+    >>> from .config import Configuration
+    >>> frontend = QueryFrontend(Configuration())
+    >>> kwds = frontend.parse('-d /tmp git')
+    >>> kwds['cwd']
+    ['/tmp']
+    >>> kwds['match_pattern']
+    ['*git*']
+
+    """
+
+    def __init__(self, config, base_query=[], cache_size=512):
+        self.config = config
+        self.base_query = list(base_query)
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def parse_args(self, args):
+        """
+        Parse a list of arguments and return alias-expanded kwds.
+        """
+        ns = get_search_parser().parse_args(self.base_query + list(args))
+        return expand_query(self.config, vars(ns))
+
+    def parse(self, query):
+        """
+        Parse `query` string and return kwds for `search_command_record`.
+
+        Returned dictionary is a fresh copy which can be modified.
+
+        :type query: str
+        :rtype: dict
+        :raises: ValueError or SyntaxError when `query` is invalid.
+
+        """
+        try:
+            (kwds, preprocessed) = self._cache[query]
+        except KeyError:
+            kwds = self.parse_args(shlex.split(query))
+            # Relative time such as "1 hour ago" must be re-evaluated
+            # every time, so preprocess_kwds result cannot be cached.
+            preprocessed = not (kwds['time_after'] or kwds['time_before'])
+            if preprocessed:
+                kwds = preprocess_kwds(copy_kwds(kwds))
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[query] = (kwds, preprocessed)
+        if preprocessed:
+            return copy_kwds(kwds)
+        else:
+            return preprocess_kwds(copy_kwds(kwds))
@@ -30,6 +30,8 @@ directory.
 import os
 import time
 import json
+import errno
+import itertools
 
 from .utils.pathutils import mkdirp
 from .utils.py3compat import getcwd
@@ -99,6 +101,104 @@ def generate_session_id(data):
         host, tty, os.getppid(), data['start']]))
 
 
+_record_counter = itertools.count()
+
+
+def get_record_path(record_path, record_type, now=None):
+    """
+    Return a unique path to a new record file.
+
+    Records are sharded into a directory for each date so that
+    directory listing is kept cheap.  The file name consists of the
+    time (in microseconds), PID and a counter so that records written
+    at the same second by different processes do not collide.
+
+    >>> path = get_record_path('/record', 'command', now=1373500000.25)
+    >>> dirname, basename = os.path.split(path)
+    >>> dirname == time.strftime('/record/command/%Y/%m/%d',
+    ...                          time.localtime(1373500000))
+    True
+    >>> basename.split('-')[4:5]
+    ['250000']
+
+    """
+    if now is None:
+        now = time.time()
+    localtime = time.localtime(now)
+    name = '{0}-{1:06d}-{2}-{3}.json'.format(
+        time.strftime('%Y-%m-%d-%H%M%S', localtime),
+        int(round(now % 1 * 1e6)) % 1000000,
+        os.getpid(),
+        next(_record_counter))
+    return os.path.join(record_path, record_type,
+                        time.strftime(os.path.join('%Y', '%m', '%d'),
+                                      localtime),
+                        name)
+
+
+def is_past_record_dir(relpath, now=None):
+    """
+    Return true if `relpath` is a directory of a day which has passed.
+
+    `relpath` is a path relative to a spool directory (e.g.,
+    ``command``) made by :func:`get_record_path`, i.e., one of
+    ``%Y``, ``%Y/%m`` and ``%Y/%m/%d``.  No new record is written in
+    such a directory.
+
+    >>> now = time.mktime((2013, 7, 11, 12, 0, 0, 0, 0, -1))
+    >>> is_past_record_dir(os.path.join('2013', '07', '10'), now)
+    True
+    >>> is_past_record_dir(os.path.join('2013', '07', '11'), now)
+    False
+    >>> is_past_record_dir(os.path.join('2013', '07'), now)
+    False
+    >>> is_past_record_dir('2012', now)
+    True
+    >>> is_past_record_dir(os.curdir, now)
+    False
+
+    """
+    parts = relpath.split(os.path.sep)
+    if not 1 <= len(parts) <= 3 or not all(p.isdigit() for p in parts):
+        return False
+    today = time.localtime(now)[:len(parts)]
+    return tuple(map(int, parts)) < tuple(today)
+
+
+def write_record(json_path, data):
+    """
+    Write `data` to `json_path` atomically.
+
+    Data is written to a temporary file in the same directory and
+    then renamed to `json_path`, so that the indexer never sees a
+    half-written record.  Temporary files do not end with ``.json``
+    and therefore they are ignored by the indexer.
+
+    As the indexer removes emptied directories of past days, the
+    directory is created again if it is removed just after it is
+    created (this happens only around midnight).
+
+    """
+    (dirname, basename) = os.path.split(json_path)
+    tmp_path = os.path.join(dirname, '.{0}.tmp'.format(basename))
+    for retry in range(3):
+        mkdirp(dirname)
+        try:
+            fp = open(tmp_path, 'w')
+            break
+        except IOError as err:
+            if err.errno != errno.ENOENT or retry == 2:
+                raise
+    try:
+        with fp:
+            json.dump(data, fp)
+        os.rename(tmp_path, json_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def record_run(record_type, print_session_id, **kwds):
     """
     Record shell history.
@@ -113,10 +213,7 @@ def record_run(record_type, print_session_id, **kwds):
     # is faster.
     config = cfstore.get_config()
     envkeys = config.record.environ[record_type]
-    json_path = os.path.join(cfstore.record_path,
-                             record_type,
-                             time.strftime('%Y-%m-%d-%H%M%S.json'))
-    mkdirp(os.path.dirname(json_path))
+    json_path = get_record_path(cfstore.record_path, record_type)
 
     # Command line options directly map to record keys
     data = dict((k, v) for (k, v) in kwds.items() if v is not None)
@@ -135,8 +232,7 @@ def record_run(record_type, print_session_id, **kwds):
         data['session_id'] = generate_session_id(data)
         print(data['session_id'])
 
-    with open(json_path, 'w') as fp:
-        json.dump(data, fp)
+    write_record(json_path, data)
 
 
 def record_add_arguments(parser):
@@ -26,10 +26,20 @@ CREATE TABLE command_history (
   start_time TIMESTAMP,
   stop_time TIMESTAMP,
   exit_code INTEGER,
+  -- Hash of the values identifying this record.  NULL if it is
+  -- a duplicate of another record.  See command_fingerprint
+  -- (./database.py).
+  fingerprint TEXT,
+  -- Environment variables recorded with this command.
+  environment_set_id INTEGER,
+  -- Comma separated exit codes of the pipeline.  See pack_pipestatus
+  -- (./database.py).
+  pipestatus TEXT,
   FOREIGN KEY(command_id) REFERENCES command_list(id),
   FOREIGN KEY(session_id) REFERENCES session_history(id),
   FOREIGN KEY(directory_id) REFERENCES directory_list(id),
-  FOREIGN KEY(terminal_id) REFERENCES terminal_list(id)
+  FOREIGN KEY(terminal_id) REFERENCES terminal_list(id),
+  FOREIGN KEY(environment_set_id) REFERENCES environment_set(id)
 );
 
 DROP TABLE IF EXISTS session_history;
@@ -65,6 +75,27 @@ CREATE TABLE directory_list (
   directory TEXT NOT NULL UNIQUE
 );
 
+CREATE INDEX environment_variable_name_value
+ON environment_variable(variable_name, variable_value);
+
+-- A distinct set of environment variables.  Commands run with the
+-- same environment share one set.  See intern_environ (./database.py).
+DROP TABLE IF EXISTS environment_set;
+CREATE TABLE environment_set (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  digest TEXT NOT NULL UNIQUE
+);
+
+DROP TABLE IF EXISTS environment_set_map;
+CREATE TABLE environment_set_map (
+  es_id INTEGER NOT NULL,
+  ev_id INTEGER NOT NULL,
+  PRIMARY KEY(es_id, ev_id),
+  FOREIGN KEY(es_id) REFERENCES environment_set(id),
+  FOREIGN KEY(ev_id) REFERENCES environment_variable(id)
+);
+
+-- Not used since schema version 0.7 (replaced by environment_set).
 DROP TABLE IF EXISTS command_environment_map;
 CREATE TABLE command_environment_map (
   ch_id INTEGER NOT NULL,
@@ -81,6 +112,11 @@ CREATE TABLE session_environment_map (
   FOREIGN KEY(ev_id) REFERENCES environment_variable(id)
 );
 
+CREATE INDEX session_environment_map_sh_id
+ON session_environment_map(sh_id);
+
+-- Not used since schema version 0.9 (replaced by
+-- command_history.pipestatus).
 DROP TABLE IF EXISTS pipe_status_map;
 CREATE TABLE pipe_status_map (
   ch_id INTEGER NOT NULL,
@@ -96,3 +132,72 @@ CREATE TABLE rash_info (
   schema_version TEXT NOT NULL,
   updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+-- Usage summary of commands.  This is redundant information derived
+-- from command_history and is maintained by the indexer so that
+-- prefix search (``rash suggest``) does not need aggregation.
+DROP TABLE IF EXISTS command_usage;
+CREATE TABLE command_usage (
+  command_id INTEGER PRIMARY KEY,
+  use_count INTEGER NOT NULL DEFAULT 0,
+  last_used TIMESTAMP,
+  FOREIGN KEY(command_id) REFERENCES command_list(id)
+);
+
+DROP TABLE IF EXISTS command_directory_usage;
+CREATE TABLE command_directory_usage (
+  command_id INTEGER NOT NULL,
+  directory_id INTEGER NOT NULL,
+  use_count INTEGER NOT NULL DEFAULT 0,
+  last_used TIMESTAMP,
+  PRIMARY KEY(command_id, directory_id),
+  FOREIGN KEY(command_id) REFERENCES command_list(id),
+  FOREIGN KEY(directory_id) REFERENCES directory_list(id)
+);
+
+CREATE INDEX command_history_session_start
+ON command_history(session_id, start_time);
+
+CREATE INDEX command_history_directory
+ON command_history(directory_id, id);
+
+CREATE UNIQUE INDEX command_history_fingerprint
+ON command_history(fingerprint);
+
+-- Number of times next_command_id is run right after prev_command_id
+-- in the same session.  Maintained by the indexer (see ``rash
+-- predict``).
+DROP TABLE IF EXISTS command_transition;
+CREATE TABLE command_transition (
+  prev_command_id INTEGER NOT NULL,
+  next_command_id INTEGER NOT NULL,
+  use_count INTEGER NOT NULL DEFAULT 0,
+  last_used TIMESTAMP,
+  PRIMARY KEY(prev_command_id, next_command_id),
+  FOREIGN KEY(prev_command_id) REFERENCES command_list(id),
+  FOREIGN KEY(next_command_id) REFERENCES command_list(id)
+);
+
+-- Same as command_transition but directory_id is the directory where
+-- next_command_id is run.
+DROP TABLE IF EXISTS command_directory_transition;
+CREATE TABLE command_directory_transition (
+  prev_command_id INTEGER NOT NULL,
+  next_command_id INTEGER NOT NULL,
+  directory_id INTEGER NOT NULL,
+  use_count INTEGER NOT NULL DEFAULT 0,
+  last_used TIMESTAMP,
+  PRIMARY KEY(prev_command_id, next_command_id, directory_id),
+  FOREIGN KEY(prev_command_id) REFERENCES command_list(id),
+  FOREIGN KEY(next_command_id) REFERENCES command_list(id),
+  FOREIGN KEY(directory_id) REFERENCES directory_list(id)
+);
+
+-- Manifest of JSON records already imported.  Used when the indexer
+-- keeps JSON files (``--keep-json``) to skip them quickly.
+DROP TABLE IF EXISTS indexed_file;
+CREATE TABLE indexed_file (
+  path TEXT PRIMARY KEY,        -- relative to record_path
+  size INTEGER,
+  mtime REAL
+);
@@ -30,9 +30,18 @@ def search_run(output, **kwds):
     """
     Search command history.
 
+    Archive DBs made by ``rash archive`` are searched as well.  To
+    search other DBs (e.g., copied from other hosts), use ``--db``::
+
+      rash search --db host1.sqlite --db host2.sqlite git
+
     """
+    import os
+    from .archive import list_partitions, search_partitions
     from .config import ConfigStore
     from .database import DataBase
+    from .federated import federated_search
+    from .indexer import catch_up
     from .query import expand_query, preprocess_kwds
 
     cfstore = ConfigStore()
@@ -43,8 +52,20 @@ def search_run(output, **kwds):
         'command_count', 'success_count', 'success_ratio', 'program_count'])
     kwds['additional_columns'] = candidates & set(fmtkeys)
 
-    db = DataBase(cfstore.db_path)
-    for crec in db.search_command_record(**preprocess_kwds(kwds)):
+    dbpaths = kwds.pop('db')
+    jobs = kwds.pop('jobs')
+    kwds = preprocess_kwds(kwds)
+    if dbpaths:
+        for path in dbpaths:
+            if not os.path.exists(path):
+                raise RuntimeError('No such DB: {0}'.format(path))
+        records = federated_search(dbpaths, jobs, **kwds)
+    else:
+        catch_up(cfstore)
+        db = DataBase(cfstore.db_path, readonly=True)
+        partitions = list_partitions(cfstore.archive_path)
+        records = search_partitions(db, partitions, jobs, **kwds)
+    for crec in records:
         output.write(format.format(**crec.__dict__))
 
 
@@ -330,6 +351,18 @@ def search_add_arguments(parent_parser):
         help="""
         Output file to write the results in. Default is stdout.
         """)
+    parser.add_argument(
+        '--db', action='append', default=[], metavar='PATH',
+        help="""
+        Search DB at PATH instead of the RASH DB and its archives.
+        This can be given multiple times to search several DBs.
+        """)
+    parser.add_argument(
+        '--jobs', '-j', type=int,
+        help="""
+        Number of processes to search several DBs in parallel.
+        Default is the number of CPUs.
+        """)
 
 
 commands = [
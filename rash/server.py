@@ -0,0 +1,371 @@
+"""
+Query API served by RASH daemon.
+
+RASH daemon listens to a Unix domain socket (``rash locate
+daemon_socket``) so that latency sensitive clients such as shell
+widgets do not need to start a Python process and open the DB for
+each query.  The protocol is line-based JSON.  A request is a JSON
+object with a key ``method`` and the other keys are passed to the
+method as keyword arguments.  The daemon writes back a JSON object
+with a key ``result`` or ``error``.  For example::
+
+  $ echo '{"method": "suggest", "prefix": "git s"}' \\
+  >   | socat - UNIX-CONNECT:"$(rash locate daemon_socket)"
+  {"result": ["git status"]}
+
+"""
+
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import socket
+import threading
+
+from .utils.jobqueue import JobQueue
+from .utils.py3compat import socketserver
+
+
+class DaemonAPI(object):
+
+    """
+    Methods callable via the daemon socket.
+
+    Method ``NAME`` in the protocol is mapped to ``api_NAME``.
+
+    """
+
+    def __init__(self, db, indexer=None, maintainer=None):
+        self.db = db
+        self.indexer = indexer
+        self.maintainer = maintainer
+        self.index_jobs = JobQueue()
+        self.start_time = time.time()
+
+    def start(self):
+        """
+        Start the thread running :meth:`api_index` requests.
+        """
+        if self.indexer:
+            self.index_jobs.start()
+
+    def stop(self):
+        if self.indexer:
+            self.index_jobs.stop()
+
+    def call(self, method, params):
+        func = getattr(self, 'api_{0}'.format(method), None)
+        if func is None:
+            raise ValueError('Unknown method: {0}'.format(method))
+        return func(**params)
+
+    def api_ping(self):
+        return 'pong'
+
+    def api_suggest(self, prefix, cwd=None, limit=1):
+        return [crec.command
+                for crec in self.db.suggest_command(prefix, cwd, limit)]
+
+    def api_predict(self, after=None, cwd=None, session_id=None, limit=10):
+        return [crec.command
+                for crec in self.db.predict_command(
+                    after, cwd, session_id, limit)]
+
+    def api_status(self, format='json'):
+        """
+        Return metrics of the daemon (see :mod:`rash.metrics`).
+
+        `format` is ``'json'`` (a dictionary) or ``'prometheus'``
+        (a string in Prometheus text format).
+
+        """
+        from .metrics import Metrics, format_prometheus
+        metrics = self.indexer.metrics if self.indexer else Metrics()
+        status = metrics.to_dict()
+        status['pid'] = os.getpid()
+        status['gauges']['uptime_seconds'] = time.time() - self.start_time
+        if format == 'prometheus':
+            return format_prometheus(status)
+        elif format == 'json':
+            return status
+        raise ValueError('Unknown format: {0}'.format(format))
+
+    def api_index(self, record_path=None, keep_json=None,
+                  check_duplicate=None):
+        """
+        Index pending records and return the number of them.
+
+        Processes other than the daemon (e.g., ``rash index``) hand
+        records over to the daemon using this method while the daemon
+        holds the index lock, so that only the daemon writes records to
+        the DB.  Options not given are the ones of the daemon.
+
+        Records are indexed one request at a time in a thread for
+        indexing requests.  The thread serving this request only waits
+        for it.
+
+        """
+        if self.indexer is None:
+            raise RuntimeError('This server does not index records.')
+        indexer = self.indexer.sibling(check_duplicate, keep_json,
+                                       record_path)
+        return self.index_jobs.submit(indexer.index_all).wait()
+
+    def api_maintain(self, **kwds):
+        """
+        Run :func:`rash.maintain.maintain` and return its report.
+
+        ``rash maintain`` calls this method while the daemon holds the
+        index lock.  It is run in the thread of
+        :class:`rash.maintain.IdleMaintainer` and this method waits for
+        it.  Records are not indexed while it is running.
+
+        """
+        from .maintain import maintain
+        if self.maintainer is None:
+            raise RuntimeError('This server does not maintain DB.')
+        return self.maintainer.submit(maintain, self.db, **kwds).wait()
+
+    def api_merge(self, source):
+        """
+        Run :func:`rash.merge.merge` and return its report.
+
+        ``rash merge`` calls this method while the daemon holds the
+        index lock.  Like :meth:`api_maintain`, it is run in the
+        thread of :class:`rash.maintain.IdleMaintainer`.
+
+        """
+        from .merge import merge
+        if self.maintainer is None:
+            raise RuntimeError('This server does not maintain DB.')
+        return self.maintainer.submit(merge, self.db, source).wait()
+
+    def api_import_history(self, path, **kwds):
+        """
+        Run :func:`rash.import_history.import_history` and return
+        its result.
+
+        ``rash import-history`` calls this method while the daemon
+        holds the index lock.  Like :meth:`api_merge`, it is run in
+        the thread of :class:`rash.maintain.IdleMaintainer`.
+
+        """
+        from .import_history import import_history
+        if self.maintainer is None:
+            raise RuntimeError('This server does not maintain DB.')
+        return self.maintainer.submit(
+            import_history, self.db, path, **kwds).wait()
+
+    def api_forget(self, **kwds):
+        """
+        Run :func:`rash.forget.forget_commands` and return its result.
+
+        ``rash forget`` calls this method while the daemon holds the
+        index lock.  It is run in the thread of
+        :class:`rash.maintain.IdleMaintainer`, but the write lock is
+        held only while a batch is deleted.
+
+        """
+        from .forget import forget_commands
+        if self.maintainer is None:
+            raise RuntimeError('This server does not maintain DB.')
+        lock = self.maintainer.indexer.write_lock
+        return self.maintainer.jobs.submit(
+            forget_commands, self.db, lock=lock, **kwds).wait()
+
+    def api_archive(self, **kwds):
+        """
+        Run :func:`rash.archive.archive_commands` and return its result.
+
+        ``rash archive`` calls this method while the daemon holds the
+        index lock.  See also :meth:`api_forget`.
+
+        """
+        from .archive import archive_commands
+        if self.maintainer is None:
+            raise RuntimeError('This server does not maintain DB.')
+        lock = self.maintainer.indexer.write_lock
+        return self.maintainer.jobs.submit(
+            archive_commands, self.db, lock=lock, **kwds).wait()
+
+    def api_nav(self, cwd, before_id=None, after_id=None, skip_command=None):
+        crec = self.db.navigate_directory(cwd, before_id, after_id,
+                                          skip_command)
+        if crec:
+            return {'command_history_id': crec.command_history_id,
+                    'command': crec.command}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    # Do not let an idle client block the server forever.
+    timeout = 5
+
+    def handle(self):
+        # Keep one DB connection per client connection (and thread).
+        with self.server.api.db.connection():
+            self.handle_lines()
+
+    def handle_lines(self):
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                method = request.pop('method')
+                response = {'result': self.server.api.call(method, request)}
+            except Exception as err:
+                self.server.logger.exception('Error while handling %r', line)
+                response = {'error': '{0}: {1}'.format(
+                    err.__class__.__name__, err)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+
+    """
+    Serve :class:`DaemonAPI` in a thread per client.
+
+    Each thread uses its own DB connection, so that a slow client
+    (or a slow request) does not block other clients.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, api):
+        from .log import logger
+        self.logger = logger
+        self.api = api
+        if os.path.exists(path):
+            os.remove(path)  # stale socket from a dead daemon
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        self.api.start()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.debug('Start serving at %s', self.server_address)
+
+    def stop(self):
+        self.logger.debug('Stop serving at %s', self.server_address)
+        self.shutdown()
+        self.server_close()
+        self.api.stop()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def start_server(cfstore, indexer=None, maintainer=None):
+    """
+    Start :class:`QueryServer` at `cfstore.daemon_socket_path`.
+
+    :type    cfstore: rash.config.ConfigStore
+    :type    indexer: rash.indexer.Indexer
+    :arg     indexer: metrics of this indexer are served by ``status``.
+    :type maintainer: rash.maintain.IdleMaintainer
+    :arg  maintainer: ``maintain`` requests are run by this.
+    :rtype: QueryServer
+
+    """
+    from .database import DataBase
+    server = QueryServer(cfstore.daemon_socket_path,
+                         DaemonAPI(DataBase(cfstore.db_path), indexer,
+                                   maintainer))
+    server.start()
+    return server
+
+
+def call_daemon(cfstore, method, timeout=1.0, **params):
+    """
+    Call `method` of the running daemon and return its result.
+
+    :raises socket.error: when daemon is not available.
+    :raises RuntimeError: when the method failed in daemon.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(cfstore.daemon_socket_path)
+        request = dict(params, method=method)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error('Daemon closed connection without response.')
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+
+def call_daemon_or_db(cfstore, method, no_daemon=False, **params):
+    """
+    Call `method` via daemon if possible, otherwise run it locally.
+
+    When the daemon is not running (or `no_daemon` is true),
+    :class:`DaemonAPI` is called directly in this process.
+
+    """
+    if not no_daemon:
+        try:
+            return call_daemon(cfstore, method, **params)
+        except socket.error:
+            pass
+    from .database import DataBase
+    return DaemonAPI(DataBase(cfstore.db_path, readonly=True)).call(
+        method, params)
+
+
+def call_daemon_or_lock(cfstore, method, func, **params):
+    """
+    Call `method` via daemon if it holds the index lock, otherwise
+    call `func` (without arguments) while holding the lock.
+
+    This is for commands writing to the DB, so that they do not
+    compete with the daemon.  `params` are passed only to `method`.
+
+    :raises RuntimeError: when the lock is held by a process other
+                          than the daemon (e.g., ``rash index``), or
+                          the method failed in daemon.
+
+    """
+    from .utils.lockfile import FileLock
+    lock = FileLock(cfstore.index_lock_path)
+    if not lock.acquire(blocking=False):
+        try:
+            return call_daemon(cfstore, method, timeout=None, **params)
+        except socket.error:
+            # The holder may have just released the lock.
+            if not lock.acquire(blocking=False):
+                raise RuntimeError(
+                    'RASH DB is locked by another process ({0}).  '
+                    'Try again after it finishes.'.format(
+                        cfstore.index_lock_path))
+    try:
+        return func()
+    finally:
+        lock.release()
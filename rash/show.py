@@ -14,26 +14,64 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-def show_run(command_history_id):
+def show_run(command_history_id, format):
     """
     Show detailed command history by its ID.
+
+    A range of IDs can be given as ``START-END`` (both inclusive).
+    Use ``--format json`` to print one JSON object per line, e.g., to
+    export records::
+
+      rash show --format json 1-1000 > history.jsonl
+
     """
+    import itertools
+    import json
     from pprint import pprint
     from .config import ConfigStore
     from .database import DataBase
-    db = DataBase(ConfigStore().db_path)
+    db = DataBase(ConfigStore().db_path, readonly=True)
+    ids = itertools.chain.from_iterable(command_history_id)
     with db.connection():
-        for ch_id in command_history_id:
-            crec = db.get_full_command_record(ch_id)
-            pprint(crec.__dict__)
-            print("")
+        for crec in db.get_full_command_records(ids):
+            if format == 'json':
+                print(json.dumps(crec.__dict__, sort_keys=True, default=str))
+            else:
+                pprint(crec.__dict__)
+                print("")
+
+
+def parse_id_range(string):
+    """
+    Parse ``N`` or ``START-END`` into a sequence of IDs.
+
+    >>> list(parse_id_range('3'))
+    [3]
+    >>> list(parse_id_range('3-5'))
+    [3, 4, 5]
+
+    """
+    import argparse
+    try:
+        (start, _, end) = string.partition('-')
+        start = int(start)
+        end = int(end) if end else start
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid ID or range: {0!r}'.format(string))
+    return range(start, end + 1)
 
 
 def show_add_arguments(parser):
     parser.add_argument(
-        'command_history_id', nargs='+', type=int,
+        'command_history_id', nargs='+', type=parse_id_range,
+        help="""
+        Integer ID of command history or range of IDs such as 10-20.
+        """)
+    parser.add_argument(
+        '--format', default='pprint', choices=['pprint', 'json'],
         help="""
-        Integer ID of command history.
+        Output format.  "json" prints one record per line (JSON lines).
         """)
 
 
@@ -0,0 +1,76 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+
+def suggest_run(prefix, cwd, limit, no_daemon, output):
+    """
+    Print the most likely command which starts with PREFIX.
+
+    Candidates are ranked by how often and how recently they are used,
+    and commands used in the directory given by --cwd are preferred.
+    It is meant to be used for inline suggestion (ghost text) in
+    shell.  For example, it can be used as a strategy of
+    zsh-autosuggestions_::
+
+      _zsh_autosuggest_strategy_rash(){
+        typeset -g suggestion="$(rash suggest --prefix "$1")"
+      }
+      ZSH_AUTOSUGGEST_STRATEGY=(rash)
+
+    .. _zsh-autosuggestions:
+       https://github.com/zsh-users/zsh-autosuggestions
+
+    The query is sent to the daemon if it is running.  To avoid
+    starting Python process for each key stroke, you can also talk to
+    the daemon socket directly.  See :mod:`rash.server`.
+
+    """
+    from .config import ConfigStore
+    from .server import call_daemon_or_db
+    commands = call_daemon_or_db(
+        ConfigStore(), 'suggest', no_daemon,
+        prefix=prefix, cwd=os.path.abspath(cwd), limit=limit)
+    for command in commands:
+        output.write(command)
+        output.write('\n')
+
+
+def suggest_add_arguments(parser):
+    import argparse
+    parser.add_argument(
+        '--prefix', '-p', required=True,
+        help='the beginning of the command line typed so far.')
+    parser.add_argument(
+        '--cwd', '-d', default='.',
+        help='prefer commands run in this directory.')
+    parser.add_argument(
+        '--limit', '-l', type=int, default=1,
+        help='number of suggestions to print.')
+    parser.add_argument(
+        '--no-daemon', action='store_true', default=False,
+        help='always read DB directly rather than asking daemon.')
+    parser.add_argument(
+        '--output', default='-', type=argparse.FileType('w'),
+        help="""
+        Output file to write the results in. Default is stdout.
+        """)
+
+
+commands = [
+    ('suggest', suggest_add_arguments, suggest_run),
+]
@@ -0,0 +1,121 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import datetime
+import tempfile
+
+from ..archive import (
+    archive, list_partitions, select_partitions, search_partitions)
+from ..database import DataBase
+from .utils import BaseTestCase, search_summary, null_and_tied_records
+
+
+def utc_ts(*args):
+    epoch = datetime.datetime(1970, 1, 1)
+    return (datetime.datetime(*args) - epoch).total_seconds()
+
+
+class TestArchive(BaseTestCase):
+
+    search_kwds = [
+        dict(sort_by=['command_count', 'start_time']),
+        dict(sort_by=['start_time']),
+        dict(sort_by=['success_count', 'start_time'], reverse=True),
+        dict(unique=False, sort_by=['start_time'], limit=5),
+    ]
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.archive_path = os.path.join(self.base_path, 'archive')
+        self.db = DataBase(os.path.join(self.base_path, 'db.sqlite'))
+        self.db.import_init_dict({'session_id': 'SID',
+                                  'start': utc_ts(2011, 12, 31),
+                                  'environ': {'SHELL': 'zsh'}})
+        self.db.import_dicts(
+            {'command': 'command {0}'.format(i % 3), 'session_id': 'SID',
+             'start': utc_ts(2011 + i // 4, 6, 1 + i), 'exit_code': i % 2,
+             'environ': {'SHELL': 'zsh', 'N': str(i)}}
+            for i in range(12))
+        self.expected = [self.search(**kwds) for kwds in self.search_kwds]
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def search(self, partitions=[], **kwds):
+        return search_summary(
+            lambda **kwds: search_partitions(self.db, partitions, **kwds),
+            **kwds)
+
+    def archive_before(self, year):
+        with self.db.connection() as connection:
+            ids = [i for (i,) in connection.execute(
+                'SELECT id FROM command_history WHERE start_time < ?',
+                ['{0}-01-01 00:00:00'.format(year)])]
+        return archive(self.db, self.archive_path, ids)
+
+    def test_archive(self):
+        self.assertEqual(self.archive_before(2013),
+                         {'2011': 4, '2012': 4})
+        partitions = list_partitions(self.archive_path)
+        self.assertEqual([p.name for p in partitions], ['2012', '2011'])
+        records = sum(self.search(), [])
+        self.assertEqual(len(records), 3)
+        self.assertEqual(sum(r[4] for r in records), 4)
+
+        crec = next(partitions[1].open().get_full_command_records([1]))
+        self.assertEqual(crec.environ, {'SHELL': 'zsh', 'N': '0'})
+        self.assertEqual(crec.start, '2011-06-01 00:00:00')
+
+    def test_archive_again(self):
+        self.archive_before(2012)
+        self.assertEqual(self.archive_before(2013), {'2012': 4})
+        partitions = list_partitions(self.archive_path)
+        self.assertEqual(
+            [p.open().select_expired_command_ids(max_count=0)
+             for p in partitions],
+            [[1, 2, 3, 4], [1, 2, 3, 4]])
+
+    def test_search_partitions(self):
+        self.archive_before(2013)
+        partitions = list_partitions(self.archive_path)
+        for (kwds, expected) in zip(self.search_kwds, self.expected):
+            self.assertEqual(self.search(partitions, **kwds), expected)
+
+    def test_search_partitions_with_null_and_tied_times(self):
+        self.db.import_dicts(null_and_tied_records(utc_ts(2012, 1, 1)))
+        expected = [self.search(**kwds) for kwds in self.search_kwds]
+        # Records without start time are not archived:
+        self.assertEqual(self.archive_before(2014), {
+            '2011': 4, '2012': 6, '2013': 4})
+        partitions = list_partitions(self.archive_path)
+        for (kwds, records) in zip(self.search_kwds, expected):
+            self.assertEqual(self.search(partitions, **kwds), records)
+
+    def test_select_partitions(self):
+        self.archive_before(2013)
+        partitions = list_partitions(self.archive_path)
+        select = lambda *args: [
+            p.name for p in select_partitions(partitions, *args)]
+        dt = datetime.datetime
+        self.assertEqual(select(dt(2013, 1, 1), None), [])
+        self.assertEqual(select(dt(2012, 6, 1), None), ['2012'])
+        self.assertEqual(select(None, dt(2011, 12, 31)), ['2011'])
+        self.assertEqual(select(dt(2011, 6, 1), dt(2012, 6, 1)),
+                         ['2012', '2011'])
+        # Unparsed time is ignored:
+        self.assertEqual(select('yesterday', None), ['2012', '2011'])
@@ -15,6 +15,9 @@
 
 
 import os
+import sys
+import shutil
+import tempfile
 import datetime
 import itertools
 import string
@@ -22,8 +25,8 @@ import operator
 
 from ..model import CommandRecord, SessionRecord
 from ..database import DataBase, normalize_directory
-from ..utils.py3compat import nested
-from .utils import BaseTestCase, monkeypatch, zip_dict
+from ..utils.py3compat import nested, unichr
+from .utils import BaseTestCase, monkeypatch, zip_dict, dump_db
 
 
 def setdefaults(d, **kwds):
@@ -192,6 +195,39 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assert_same_command_record(crec, to_command_record(data))
         self.assertEqual(len(records), 1)
 
+    def get_import_dicts_records(self):
+        dcts = [dict(command='command {0}'.format(i % 4),
+                     session_id=['S1', 'S2', None][i % 3],
+                     cwd='/{0}'.format(i % 2),
+                     terminal='xterm',
+                     start=None if i % 7 == 0 else (i * 37) % 30,
+                     stop=i,
+                     exit_code=i % 2,
+                     pipestatus=[0, i % 2],
+                     environ={'SHELL': 'zsh', 'N': str(i % 3)})
+                for i in range(30)]
+        return dcts + dcts[:5]
+
+    def check_import_dicts(self, check_duplicate, expected_counts):
+        init = {'session_id': 'S1', 'start': 0,
+                'environ': {'SHELL': 'zsh', 'HOME': '/home'}}
+        dcts = self.get_import_dicts_records()
+        expected = InMemoryDataBase()
+        expected.import_init_dict(init)
+        for dct in dcts:
+            expected.import_dict(dct, check_duplicate)
+        self.db.import_init_dict(init)
+        self.assertEqual(
+            self.db.import_dicts(dcts, check_duplicate, batch_size=7),
+            expected_counts)
+        self.assertEqual(dump_db(self.db), dump_db(expected))
+
+    def test_import_dicts_same_as_import_dict(self):
+        self.check_import_dicts(True, (30, 5))
+
+    def test_import_dicts_same_as_import_dict_no_check_duplicate(self):
+        self.check_import_dicts(False, (35, 0))
+
     def test_import_command_record_no_check_duplicate(self):
         data = self.get_dummy_command_record_data()
         num = 3
@@ -462,6 +498,50 @@ class TestInMemoryDataBase(BaseTestCase):
         self.assertEqual(attrs(records, 'command'), ['c-0', 'c-2', 'c-1'])
         self.assertEqual(attrs(records, 'cwd_distance'), [0, 1, 2])
 
+    def compile_search(self, **kwds):
+        setdefaults(kwds, **self.get_default_search_kwds())
+        self.adapt_file_path_in_dict(kwds)
+        for key in ['after_context', 'before_context', 'context',
+                    'context_type']:
+            kwds.pop(key)
+        return self.db._compile_sql_search_command_record(**kwds)
+
+    def test_compile_sql_reuse_shape(self):
+        (sql1, params1, _) = self.compile_search(
+            match_pattern=['*git*'], cwd=['/A'],
+            include_environ_pattern=[('SHELL', 'zsh')])
+        (sql2, params2, _) = self.compile_search(
+            match_pattern=['*hg*'], cwd=['/B'],
+            include_environ_pattern=[('PATH', 'bin')])
+        self.assertTrue(sql1 is sql2)
+        self.assertNotEqual(params1, params2)
+        self.assertIn('*hg*', params2)
+        self.assertIn('PATH', params2)
+        self.assertIn(normalize_directory(self.abspath('B')), params2)
+
+    def test_compile_sql_different_shape(self):
+        (sql1, _, _) = self.compile_search(match_pattern=['*git*'])
+        (sql2, _, _) = self.compile_search(match_pattern=['*git*', '*st*'])
+        (sql3, _, _) = self.compile_search(match_pattern=['*git*'],
+                                           ignore_case=True)
+        self.assertNotEqual(sql1, sql2)
+        self.assertNotEqual(sql1, sql3)
+
+    def test_search_command_with_same_shape(self):
+        self.prepare_command_history_table(
+            ['command', 'cwd'],
+            [['git status', '/A'],
+             ['hg status', '/B']])
+        records = self.search_command_record(match_pattern=['git*'],
+                                             cwd=['/A'])
+        self.assertEqual(attrs(records, 'command'), ['git status'])
+        records = self.search_command_record(match_pattern=['hg*'],
+                                             cwd=['/B'])
+        self.assertEqual(attrs(records, 'command'), ['hg status'])
+        records = self.search_command_record(match_pattern=['hg*'],
+                                             cwd=['/A'])
+        self.assertEqual(records, [])
+
     def test_search_command_with_connection(self):
         num = 5
         small_num = 3
@@ -1048,3 +1128,481 @@ class TestInMemoryDataBase(BaseTestCase):
 
         crec = self.db.get_full_command_record(command_history_id)
         self.assertEqual(crec.pipestatus, command_data['pipestatus'])
+
+    def test_get_full_command_record_no_pipestatus(self):
+        self.import_command_record({'command': 'ls'})
+        crec = self.db.get_full_command_record(1)
+        self.assertEqual(crec.pipestatus, [])
+
+    def test_get_pipestatuses(self):
+        for (i, pipestatus) in enumerate([[0], [], [1, 0]]):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': pipestatus})
+        self.assertEqual(self.db.get_pipestatuses([1, 2, 3, 4]),
+                         {1: [0], 2: [], 3: [1, 0]})
+        self.assertEqual(self.db.get_pipestatuses([3, 1], batch_size=1),
+                         {1: [0], 3: [1, 0]})
+
+    def test_pipestatus_round_trip_unknown_codes(self):
+        pipestatuses = [[None], [0, None], [None, None, 1]]
+        for (i, pipestatus) in enumerate(pipestatuses):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': pipestatus})
+        self.assertEqual(self.db.get_pipestatuses([1, 2, 3]),
+                         dict(zip([1, 2, 3], pipestatuses)))
+        for (ch_id, pipestatus) in zip([1, 2, 3], pipestatuses):
+            crec = self.db.get_full_command_record(ch_id)
+            self.assertEqual(crec.pipestatus, pipestatus)
+
+    def test_get_full_command_records(self):
+        self.db.import_init_dict(
+            {'session_id': 'S', 'environ': {'SHELL': 'zsh'}})
+        for (i, path) in enumerate(['A', 'B', 'C']):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': [i],
+                 'session_id': 'S', 'environ': {'PATH': path}})
+        crecs = list(self.db.get_full_command_records(
+            [3, 100, 1, 2], batch_size=2))
+        self.assertEqual([c.command_history_id for c in crecs], [3, 1, 2])
+        self.assertEqual([c.pipestatus for c in crecs], [[2], [0], [1]])
+        self.assertEqual(crecs[0].environ, {'PATH': 'C', 'SHELL': 'zsh'})
+        for crec in crecs:
+            single = self.db.get_full_command_record(crec.command_history_id)
+            self.assertEqual(crec.__dict__, single.__dict__)
+
+    def test_suggest_command_prefix(self):
+        self.prepare_command_history_table(
+            ['command'],
+            [['git status'], ['git stash'], ['git status'], ['gitk'],
+             ['hg status']])
+        suggested = attrs(self.db.suggest_command('git st', limit=5),
+                          'command')
+        self.assertEqual(suggested, ['git status', 'git stash'])
+        self.assertEqual(
+            attrs(self.db.suggest_command('hg', limit=5), 'command'),
+            ['hg status'])
+        self.assertEqual(list(self.db.suggest_command('svn')), [])
+        self.assertEqual(list(self.db.suggest_command('')), [])
+
+    def test_suggest_command_last_code_point(self):
+        last = unichr(sys.maxunicode)
+        self.prepare_command_history_table(
+            ['command'], [[last + last + 'a'], ['a']])
+        self.assertEqual(
+            attrs(self.db.suggest_command(last, limit=5), 'command'),
+            [last + last + 'a'])
+
+    def test_suggest_command_prefers_cwd(self):
+        self.prepare_command_history_table(
+            ['command', 'cwd'],
+            [['make test', '/A'],
+             ['make test', '/A'],
+             ['make doc', '/B']])
+        (crec,) = self.db.suggest_command('make', cwd=self.abspath('A'))
+        self.assertEqual(crec.command, 'make test')
+        self.assertEqual(crec.command_count, 2)
+        (crec,) = self.db.suggest_command('make', cwd=self.abspath('B'))
+        self.assertEqual(crec.command, 'make doc')
+
+    def test_migrate_command_usage(self):
+        self.prepare_command_history_table(
+            ['command'], [['git status'], ['git status'], ['hg status']])
+        from .. import database
+        with self.db.connection(commit=True) as db:
+            db.execute('DROP TABLE command_usage')
+            db.execute('DROP TABLE command_directory_usage')
+        with monkeypatch(database, 'schema_version', '0.1'):
+            with self.db.connection(commit=True) as db:
+                db.execute('DELETE FROM rash_info')
+            self.db.update_version_records()
+        self.db.update_version_records()
+        records = list(self.db.suggest_command('git', limit=5))
+        self.assertEqual(attrs(records, 'command'), ['git status'])
+        self.assertEqual(attrs(records, 'command_count'), [2])
+
+    def import_session_commands(self, session_id, commands, start=0,
+                                cwd=None):
+        for (i, command) in enumerate(commands):
+            data = {'command': command, 'session_id': session_id,
+                    'start': start + i}
+            if cwd:
+                data['cwd'] = self.abspath(cwd)
+            self.db.import_dict(data)
+
+    def test_predict_command(self):
+        self.import_session_commands(
+            'SID-1', ['make', 'make test', 'make', 'make test'])
+        self.import_session_commands('SID-2', ['make', 'make doc'],
+                                     start=10)
+        records = list(self.db.predict_command('make'))
+        self.assertEqual(attrs(records, 'command'), ['make test', 'make doc'])
+        self.assertEqual(attrs(records, 'command_count'), [2, 1])
+        self.assertEqual(list(self.db.predict_command('unknown')), [])
+
+    def test_predict_command_last_in_session(self):
+        self.import_session_commands('SID-1', ['cd', 'ls', 'cd', 'ls', 'cd'])
+        self.import_session_commands('SID-2', ['ls'], start=10)
+        records = list(self.db.predict_command(session_id='SID-1'))
+        self.assertEqual(attrs(records, 'command'), ['ls'])
+        records = list(self.db.predict_command(session_id='SID-2'))
+        self.assertEqual(attrs(records, 'command'), ['cd'])
+
+    def test_predict_command_prefers_cwd(self):
+        self.import_session_commands('SID-1', ['make', 'make test'], cwd='A')
+        self.import_session_commands('SID-2', ['make', 'make doc',
+                                               'make', 'make doc'],
+                                     start=10, cwd='B')
+        records = list(self.db.predict_command('make', cwd=self.abspath('A')))
+        self.assertEqual(attrs(records, 'command'), ['make test', 'make doc'])
+
+    def test_predict_command_out_of_order_import(self):
+        for (start, command) in [(0, 'a'), (2, 'c'), (1, 'b')]:
+            self.db.import_dict({'command': command, 'session_id': 'SID',
+                                 'start': start})
+        self.assertEqual(attrs(self.db.predict_command('a'), 'command'),
+                         ['b'])
+        self.assertEqual(attrs(self.db.predict_command('b'), 'command'),
+                         ['c'])
+
+    def test_migrate_command_transition(self):
+        self.import_session_commands('SID', ['a', 'b', 'a', 'b', 'a', 'c'])
+        from .. import database
+        with self.db.connection(commit=True) as db:
+            db.execute('DROP TABLE command_transition')
+            db.execute('DROP TABLE command_directory_transition')
+        with monkeypatch(database, 'schema_version', '0.2'):
+            with self.db.connection(commit=True) as db:
+                db.execute('DELETE FROM rash_info')
+            self.db.update_version_records()
+        self.db.update_version_records()
+        records = list(self.db.predict_command('a'))
+        self.assertEqual(attrs(records, 'command'), ['b', 'c'])
+        self.assertEqual(attrs(records, 'command_count'), [2, 1])
+
+    def command_counts(self, db):
+        with db.connection() as connection:
+            usage = sorted(connection.execute("""
+            SELECT CL.command, use_count FROM command_usage
+            JOIN command_list AS CL ON command_id = CL.id
+            """))
+            transition = sorted(connection.execute("""
+            SELECT P.command, N.command, use_count FROM command_transition
+            JOIN command_list AS P ON prev_command_id = P.id
+            JOIN command_list AS N ON next_command_id = N.id
+            WHERE use_count > 0
+            """))
+        return (usage, transition)
+
+    def test_delete_command_history(self):
+        commands = ['a', 'b', 'a', 'c', 'b', 'd']
+        self.import_session_commands('SID', commands)
+        self.assertEqual(self.db.delete_command_history([2, 4, 100]), 2)
+        expected = InMemoryDataBase()
+        for (start, command) in enumerate(commands):
+            if start + 1 not in (2, 4):
+                expected.import_dict({'command': command, 'start': start,
+                                      'session_id': 'SID'})
+        self.assertEqual(self.command_counts(self.db),
+                         self.command_counts(expected))
+        self.assertEqual(attrs(self.db.predict_command('a'), 'command'),
+                         attrs(expected.predict_command('a'), 'command'))
+
+    def transition_counts(self, recount=False):
+        """
+        Return counts of command and command-directory transitions.
+
+        If `recount` is true, they are counted from the scratch using
+        :data:`rash.database.TRANSITION_SQL`.
+
+        """
+        from ..database import select_transitions
+        sql = """
+        SELECT P.command, N.command, T.use_count FROM {0} AS T
+        JOIN command_list AS P ON prev_command_id = P.id
+        JOIN command_list AS N ON next_command_id = N.id
+        WHERE T.use_count != 0
+        """
+        recount_sql = """
+        (SELECT prev_command_id, next_command_id,
+                COUNT(*) AS use_count FROM temp.recount
+         {0} GROUP BY prev_command_id, next_command_id{1})
+        """
+        with self.db.connection() as db:
+            if recount:
+                db.execute('DROP TABLE IF EXISTS temp.all_sessions')
+                db.execute('CREATE TEMP TABLE all_sessions AS '
+                           'SELECT id FROM session_history')
+                select_transitions(db, 'recount', 'all_sessions')
+                sources = [
+                    recount_sql.format('', ''),
+                    recount_sql.format('WHERE directory_id IS NOT NULL',
+                                       ', directory_id')]
+            else:
+                sources = ['command_transition',
+                           'command_directory_transition']
+            return [sorted(db.execute(sql.format(source)))
+                    for source in sources]
+
+    def test_command_transition_with_tied_start_times(self):
+        for (command, start) in [('a', 1), ('b', 1), ('c', 1), ('d', 2),
+                                 ('e', 0), ('f', 1), ('g', None)]:
+            self.db.import_dict({'command': command, 'start': start,
+                                 'cwd': '/', 'session_id': 'SID'})
+        self.assertEqual(self.transition_counts(),
+                         self.transition_counts(recount=True))
+        self.assertEqual(self.transition_counts()[0], [
+            ('a', 'b', 1), ('b', 'c', 1), ('c', 'f', 1), ('e', 'a', 1),
+            ('f', 'd', 1)])
+        self.assertEqual(self.db.delete_command_history([2, 6]), 2)
+        self.assertEqual(self.transition_counts(),
+                         self.transition_counts(recount=True))
+        self.assertEqual(self.transition_counts()[0], [
+            ('a', 'c', 1), ('c', 'd', 1), ('e', 'a', 1)])
+
+    def test_delete_garbage(self):
+        self.import_session_commands('SID', ['a', 'b'])
+        self.db.import_dict({'command': 'c', 'cwd': '/tmp', 'start': 10,
+                             'terminal': 'xterm',
+                             'environ': {'PATH': '/bin'}})
+        self.db.delete_command_history([3])
+        self.assertEqual(self.db.delete_garbage('command_list', 1), 1)
+        self.assertEqual(self.db.delete_garbage('command_list'), 0)
+        for table in ['directory_list', 'terminal_list', 'environment_set',
+                      'environment_variable']:
+            self.assertEqual(self.db.delete_garbage(table), 1)
+        self.assertEqual(self.count_rows('environment_set_map'), 0)
+        self.assertEqual(self.count_rows('command_list'), 2)
+
+    def test_delete_empty_sessions(self):
+        for sid in ['S1', 'S2', 'S3']:
+            self.db.import_init_dict({'session_id': sid, 'start': 1,
+                                      'environ': {'SHELL': sid}})
+        self.db.import_dict({'command': 'a', 'session_id': 'S2', 'start': 2})
+        self.db.import_init_dict({'session_id': 'S3', 'start': 200})
+        self.assertEqual(self.db.delete_empty_sessions(100), 1)
+        self.assertEqual(self.count_rows('session_history'), 2)
+        self.assertEqual(self.count_rows('session_environment_map'), 2)
+
+    def test_navigate_directory(self):
+        self.prepare_command_history_table(
+            ['command', 'cwd'],
+            [['a', '/A'], ['b', '/B'], ['c', '/A'], ['c', '/A'],
+             ['d', '/A']])
+        cwd = self.abspath('A')
+        walk = []
+        crec = self.db.navigate_directory(cwd)
+        while crec:
+            walk.append(crec.command)
+            crec = self.db.navigate_directory(
+                cwd, before_id=crec.command_history_id)
+        self.assertEqual(walk, ['d', 'c', 'c', 'a'])
+
+        first = self.db.navigate_directory(cwd, before_id=2)
+        self.assertEqual(first.command, 'a')
+        self.assertEqual(first.cwd, normalize_directory(cwd))
+        crec = self.db.navigate_directory(
+            cwd, after_id=first.command_history_id)
+        self.assertEqual(crec.command, 'c')
+        self.assertEqual(self.db.navigate_directory(self.abspath('C')), None)
+
+    def test_navigate_directory_skip_command(self):
+        self.prepare_command_history_table(
+            ['command', 'cwd'],
+            [['a', '/A'], ['c', '/A'], ['c', '/A']])
+        crec = self.db.navigate_directory(self.abspath('A'),
+                                          skip_command='c')
+        self.assertEqual(crec.command, 'a')
+
+    def test_navigate_directory_uses_index(self):
+        with self.db.connection() as db:
+            plan = ' '.join(str(row) for row in db.execute(
+                'EXPLAIN QUERY PLAN '
+                'SELECT id FROM command_history '
+                'WHERE directory_id = 1 AND id < 10 '
+                'ORDER BY id DESC LIMIT 1'))
+        self.assertIn('command_history_directory', plan)
+
+    def test_import_command_record_check_duplicate_uses_index(self):
+        with self.db.connection() as db:
+            plan = ' '.join(str(row) for row in db.execute(
+                'EXPLAIN QUERY PLAN '
+                'SELECT 1 FROM command_history WHERE fingerprint = ?',
+                ['dummy']))
+        self.assertIn('command_history_fingerprint', plan)
+
+    def test_import_command_record_duplicate_after_no_check(self):
+        data = self.get_dummy_command_record_data()
+        self.import_command_record(data, check_duplicate=False)
+        self.import_command_record(data, check_duplicate=False)
+        self.import_command_record(data, check_duplicate=True)
+        records = self.search_command_record(unique=False)
+        self.assertEqual(len(records), 2)
+
+    def count_rows(self, table):
+        with self.db.connection() as db:
+            ((count,),) = db.execute('SELECT COUNT(*) FROM ' + table)
+        return count
+
+    def test_environment_set_is_shared(self):
+        for (i, path) in enumerate(['A', 'A', 'B']):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': [0],
+                 'environ': {'PATH': path, 'SHELL': 'zsh'}})
+        self.assertEqual(self.count_rows('environment_set'), 2)
+        self.assertEqual(self.count_rows('environment_set_map'), 4)
+        self.assertEqual(self.count_rows('environment_variable'), 3)
+        crec = self.db.get_full_command_record(3)
+        self.assertEqual(crec.environ, {'PATH': 'B', 'SHELL': 'zsh'})
+
+    def command_environ_delta(self, ch_id):
+        return self.db.get_full_command_record(
+            ch_id, merge_session_environ=False).environ
+
+    def test_environ_delta_against_session(self):
+        self.db.import_init_dict(
+            {'session_id': 'S', 'environ': {'PATH': 'A', 'SHELL': 'zsh'}})
+        for (i, path) in enumerate(['A', 'B']):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': [0],
+                 'session_id': 'S',
+                 'environ': {'PATH': path, 'SHELL': 'zsh'}})
+        self.assertEqual(self.command_environ_delta(1), {})
+        self.assertEqual(self.command_environ_delta(2), {'PATH': 'B'})
+        self.assertEqual(self.db.get_full_command_record(2).environ,
+                         {'PATH': 'B', 'SHELL': 'zsh'})
+
+    def test_environ_delta_rebased_by_late_init(self):
+        for (i, path) in enumerate(['A', 'B']):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': [0],
+                 'session_id': 'S',
+                 'environ': {'PATH': path, 'SHELL': 'zsh'}})
+        self.assertEqual(self.command_environ_delta(1),
+                         {'PATH': 'A', 'SHELL': 'zsh'})
+        self.db.import_init_dict(
+            {'session_id': 'S', 'environ': {'PATH': 'A', 'SHELL': 'zsh'}})
+        self.assertEqual(self.command_environ_delta(1), {})
+        self.assertEqual(self.command_environ_delta(2), {'PATH': 'B'})
+        # Changing the baseline again does not change full environ:
+        self.db.import_init_dict(
+            {'session_id': 'S', 'environ': {'PATH': 'B', 'TERM': 'xterm'}})
+        self.assertEqual(self.db.get_full_command_record(1).environ,
+                         {'PATH': 'A', 'SHELL': 'zsh', 'TERM': 'xterm'})
+        self.assertEqual(self.db.get_full_command_record(2).environ,
+                         {'PATH': 'B', 'SHELL': 'zsh', 'TERM': 'xterm'})
+        records = self.search_command_record(
+            match_environ_pattern=[('SHELL', 'zsh')], unique=False)
+        self.assertEqual(len(records), 2)
+
+    def test_rebase_deletes_orphaned_environment_sets(self):
+        for (i, path) in enumerate(['A', 'B']):
+            self.import_command_record(
+                {'command': 'ls', 'start': i, 'pipestatus': [0],
+                 'session_id': 'S',
+                 'environ': {'PATH': path, 'SHELL': 'zsh'}})
+        self.assertEqual(self.count_rows('environment_set'), 2)
+        self.db.import_init_dict(
+            {'session_id': 'S', 'environ': {'PATH': 'A', 'SHELL': 'zsh'}})
+        # Only the delta {'PATH': 'B'} of the second command is left:
+        self.assertEqual(self.count_rows('environment_set'), 1)
+        self.assertEqual(self.count_rows('environment_set_map'), 1)
+        with self.db.connection() as db:
+            self.assertEqual(list(db.execute(
+                'SELECT environment_set_id FROM command_history '
+                'EXCEPT SELECT id FROM environment_set')), [(None,)])
+        self.assertEqual(self.db.get_full_command_record(2).environ,
+                         {'PATH': 'B', 'SHELL': 'zsh'})
+
+    def test_migrate_environment_set(self):
+        for i in range(2):
+            data = self.get_dummy_command_record_data()
+            data['start'] = i
+            self.import_command_record(data)
+        from .. import database
+        # Store environment variables as schema 0.6 does:
+        with self.db.connection(commit=True) as db:
+            db.execute("""
+            INSERT INTO command_environment_map (ch_id, ev_id)
+            SELECT CH.id, EMap.ev_id FROM command_history AS CH
+            JOIN environment_set_map AS EMap
+                ON CH.environment_set_id = EMap.es_id
+            """)
+            db.execute('UPDATE command_history SET environment_set_id = NULL')
+            db.execute('DELETE FROM environment_set_map')
+            db.execute('DELETE FROM environment_set')
+        with monkeypatch(database, 'schema_version', '0.6'):
+            with self.db.connection(commit=True) as db:
+                db.execute('DELETE FROM rash_info')
+            self.db.update_version_records()
+        self.db.update_version_records()
+        self.assertEqual(self.count_rows('command_environment_map'), 0)
+        self.assertEqual(self.count_rows('environment_set'), 1)
+        crec = self.db.get_full_command_record(2)
+        self.assertEqual(crec.environ['PATH'], 'DUMMY:PATH:DATA')
+
+    def test_migrate_pipestatus(self):
+        self.import_command_record({'command': 'ls', 'pipestatus': [1, 0]})
+        from .. import database
+        # Store pipestatus as schema 0.8 does:
+        with self.db.connection(commit=True) as db:
+            db.executemany(
+                'INSERT INTO pipe_status_map '
+                '(ch_id, program_position, exit_code) VALUES (1, ?, ?)',
+                [(0, 1), (2, 0)])
+            db.execute('UPDATE command_history SET pipestatus = NULL')
+        with monkeypatch(database, 'schema_version', '0.8'):
+            with self.db.connection(commit=True) as db:
+                db.execute('DELETE FROM rash_info')
+            self.db.update_version_records()
+        self.db.update_version_records()
+        self.assertEqual(self.count_rows('pipe_status_map'), 0)
+        crec = self.db.get_full_command_record(1)
+        self.assertEqual(crec.pipestatus, [1, None, 0])
+
+    def test_migrate_fingerprint(self):
+        data = self.get_dummy_command_record_data()
+        self.import_command_record(data, check_duplicate=False)
+        self.import_command_record(data, check_duplicate=False)
+        from .. import database
+        with self.db.connection(commit=True) as db:
+            db.execute('DROP INDEX command_history_fingerprint')
+            db.execute('UPDATE command_history SET fingerprint = NULL')
+        with monkeypatch(database, 'schema_version', '0.4'):
+            with self.db.connection(commit=True) as db:
+                db.execute('DELETE FROM rash_info')
+            self.db.update_version_records()
+        self.db.update_version_records()
+        self.import_command_record(data, check_duplicate=True)
+        records = self.search_command_record(unique=False)
+        self.assertEqual(len(records), 2)
+
+
+class TestDataBaseOpen(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.dbpath = os.path.join(self.base_path, 'db.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def count_version_records(self, db):
+        return len(list(db.get_version_records()))
+
+    def test_readonly_does_not_update_version_records(self):
+        DataBase(self.dbpath)
+        db = DataBase(self.dbpath, readonly=True)
+        self.assertTrue(db.is_schema_up_to_date())
+        self.assertEqual(self.count_version_records(db), 1)
+        with monkeypatch(DataBase, 'update_version_records', None):
+            DataBase(self.dbpath, readonly=True)
+
+    def test_readonly_migrates_old_db(self):
+        db = DataBase(self.dbpath)
+        with db.connection(commit=True) as connection:
+            connection.execute('PRAGMA user_version = 0')
+            connection.execute("UPDATE rash_info SET schema_version = '0.8'")
+        self.assertFalse(db.is_schema_up_to_date())
+        db = DataBase(self.dbpath, readonly=True)
+        self.assertTrue(db.is_schema_up_to_date())
+        self.assertEqual(self.count_version_records(db), 2)
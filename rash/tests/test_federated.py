@@ -0,0 +1,100 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+
+from ..database import DataBase
+from ..federated import federated_search
+from .utils import (
+    BaseTestCase, get_default_search_kwds, search_summary,
+    null_and_tied_records)
+
+
+class TestFederatedSearch(BaseTestCase):
+
+    search_kwds = [
+        dict(sort_by=['command_count', 'start_time']),
+        dict(sort_by=['start_time'], limit=4),
+        dict(sort_by=['exit_code', 'start_time'], reverse=True),
+        dict(sort_by=['success_ratio', 'start_time']),
+        dict(unique=False, sort_by=['start_time'], limit=7),
+        dict(unique=False, sort_by=['exit_code', 'start_time'], limit=-1),
+    ]
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.combined = DataBase(os.path.join(self.base_path, 'all.sqlite'))
+        self.dbpaths = []
+        for host in range(3):
+            path = os.path.join(self.base_path, '{0}.sqlite'.format(host))
+            dcts = [{'command': 'command {0}'.format((i * host) % 5),
+                     'start': i * 3 + host, 'exit_code': (i + host) % 3}
+                    for i in range(10)]
+            DataBase(path).import_dicts(dcts)
+            self.combined.import_dicts(dcts)
+            self.dbpaths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def assert_same_results(self, jobs):
+        for kwds in self.search_kwds:
+            self.assertEqual(
+                search_summary(lambda **kwds: federated_search(
+                    self.dbpaths, jobs, **kwds), **kwds),
+                search_summary(self.combined.search_command_record, **kwds))
+
+    def test_serial(self):
+        self.assert_same_results(jobs=1)
+
+    def test_process_pool(self):
+        self.assert_same_results(jobs=2)
+
+    def test_null_and_tied_times(self):
+        for (host, path) in enumerate(self.dbpaths):
+            dcts = null_and_tied_records(100, '/{0}'.format(host))
+            DataBase(path).import_dicts(dcts)
+            self.combined.import_dicts(dcts)
+        self.assert_same_results(jobs=1)
+
+    def test_context(self):
+        kwds = dict(get_default_search_kwds(),
+                    match_pattern=['command 3'], context=1, limit=-1)
+        records = federated_search(self.dbpaths, 1, **kwds)
+        # Matches are in DB 1 (i = 3, 8) and DB 2 (i = 4, 9):
+        expected = [
+            '1970-01-01 00:00:{0:02d}'.format(i * 3 + host)
+            for (host, ids) in [(1, [9, 8, 7, 4, 3, 2]), (2, [9, 8, 5, 4, 3])]
+            for i in ids]
+        self.assertEqual([r.start for r in records], expected)
+
+        kwds['limit'] = 8
+        records = federated_search(self.dbpaths, 1, **kwds)
+        self.assertEqual([r.start for r in records], expected[:8])
+
+    def test_tied_sort_keys(self):
+        dbpaths = []
+        for host in range(2):
+            path = os.path.join(self.base_path, 'tie{0}.sqlite'.format(host))
+            DataBase(path).import_dicts([
+                {'command': 'command {0}'.format(host), 'start': 1}])
+            dbpaths.append(path)
+        kwds = dict(get_default_search_kwds(), sort_by=['start_time'])
+        records = federated_search(dbpaths, 1, **kwds)
+        self.assertEqual([r.command for r in records],
+                         ['command 0', 'command 1'])
@@ -0,0 +1,80 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from ..config import RetentionConfig
+from ..forget import forget, apply_retention
+from .test_database import InMemoryDataBase
+from .utils import BaseTestCase
+
+DAY = 24 * 60 * 60
+
+
+class TestForget(BaseTestCase):
+
+    def setUp(self):
+        self.db = InMemoryDataBase()
+        self.db.import_dicts(
+            {'command': 'command {0}'.format(i % 7), 'start': i * DAY,
+             'session_id': 'SID'}
+            for i in range(20))
+
+    def execute(self, sql):
+        with self.db.connection() as connection:
+            return list(connection.execute(sql))
+
+    def command_ids(self):
+        return [i for (i,) in self.execute(
+            'SELECT id FROM command_history ORDER BY start_time')]
+
+    def count_rows(self, table):
+        return self.execute('SELECT COUNT(*) FROM {0}'.format(table))[0][0]
+
+    def test_select_by_pattern(self):
+        ids = self.db.select_command_ids_by_pattern(['command [12]'], [])
+        self.assertEqual(len(ids), 6)
+        ids = self.db.select_command_ids_by_pattern(['*1'], ['.*3$'])
+        self.assertEqual(len(ids), 6)
+
+    def test_select_expired(self):
+        ids = self.command_ids()
+        self.assertEqual(self.db.select_expired_command_ids(max_count=15),
+                         ids[:5])
+        self.assertEqual(
+            self.db.select_expired_command_ids(max_age=10.5, now=20 * DAY),
+            ids[:10])
+        self.assertEqual(
+            self.db.select_expired_command_ids(18, 5, now=20 * DAY),
+            ids[:15])
+
+    def test_forget_in_batches(self):
+        ids = self.db.select_command_ids_by_pattern(['command [0-5]'], [])
+        (deleted, garbage) = forget(self.db, ids, batch_size=2)
+        self.assertEqual(deleted, 18)
+        self.assertEqual(garbage['command_list'], 6)
+        self.assertEqual(self.count_rows('command_list'), 1)
+        self.assertEqual(self.count_rows('command_usage'), 1)
+        self.assertEqual(self.execute('''
+        SELECT CL.command FROM command_history
+        JOIN command_list AS CL ON command_id = CL.id
+        '''), [('command 6',)] * 2)
+
+    def test_apply_retention(self):
+        retention = RetentionConfig()
+        retention.max_count = 4
+        (deleted, _) = apply_retention(self.db, retention, now=20 * DAY)
+        self.assertEqual(deleted, 16)
+        self.assertEqual(len(self.command_ids()), 4)
+        self.assertEqual(self.count_rows('session_history'), 1)
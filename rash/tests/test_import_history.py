@@ -0,0 +1,79 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+
+from ..import_history import iter_history
+from .test_database import InMemoryDataBase
+from .utils import BaseTestCase
+
+
+class TestImportHistory(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def write_history(self, name, data):
+        path = os.path.join(self.base_path, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_zsh_extended_history(self):
+        path = self.write_history(
+            'history',
+            b': 1373500000:0;ls\n'
+            b': 1373500001:3;echo a\\\nb\n'
+            b': 1373500005:0;echo \xe3\x83\xa3\xb3\n')
+        self.assertEqual(list(iter_history(path)), [
+            dict(command='ls', start=1373500000, stop=1373500000),
+            dict(command='echo a\nb', start=1373500001, stop=1373500004),
+            dict(command=b'echo \xe3\x83\xb3'.decode('utf-8'),
+                 start=1373500005, stop=1373500005),
+        ])
+
+    def test_bash_history(self):
+        path = self.write_history(
+            'bash_history', b'#1373500000\nls\n#1373500001\ncd /\n')
+        self.assertEqual(list(iter_history(path)), [
+            dict(command='ls', start=1373500000),
+            dict(command='cd /', start=1373500001),
+        ])
+
+    def test_import_dicts_skips_duplicates(self):
+        path = self.write_history(
+            'zsh_history', b'ls\n: 1373500000:0;make\n: 1373500001:0;make\n')
+        db = InMemoryDataBase()
+        self.assertEqual(db.import_dicts(iter_history(path), batch_size=2),
+                         (3, 0))
+        self.assertEqual(db.import_dicts(iter_history(path)), (0, 3))
+        with db.connection() as connection:
+            ((count,),) = connection.execute(
+                'SELECT COUNT(*) FROM command_history')
+        self.assertEqual(count, 3)
+
+    def test_import_repeated_commands_without_timestamp(self):
+        path = self.write_history('bash_history', b'ls\ncd /\nls\n')
+        db = InMemoryDataBase()
+        self.assertEqual(db.import_dicts(iter_history(path)), (3, 0))
+        self.assertEqual(db.import_dicts(iter_history(path)), (0, 3))
+        (crec,) = db.suggest_command('l')
+        self.assertEqual(crec.command_count, 2)
@@ -15,17 +15,29 @@
 
 
 import os
+import time
+import unittest
 import tempfile
 import shutil
 import json
 
 from ..config import ConfigStore
-from ..indexer import Indexer
+from ..database import DataBase
+from ..indexer import Indexer, catch_up
+from ..utils.lockfile import FileLock
+from ..watchrecord import RecordPoller, RecordHandler
+from ..record import get_record_path, write_record
+from .. import inotify
 from ..utils.pathutils import mkdirp
 from .utils import BaseTestCase
 
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
 
-class TestIndexer(BaseTestCase):
+
+class BaseIndexerTestCase(BaseTestCase):
 
     def setUp(self):
         self.base_path = tempfile.mkdtemp(prefix='rash-test-')
@@ -53,6 +65,19 @@ class TestIndexer(BaseTestCase):
                 paths.append(json_path)
         return paths
 
+    def write_dated_record(self, days_ago=0, **data):
+        """
+        Write a command record as ``rash record`` does `days_ago`.
+        """
+        json_path = get_record_path(self.cfstore.record_path, 'command',
+                                    now=time.time() - days_ago * 86400)
+        write_record(json_path, dict(data or dict(command='git status')))
+        return json_path
+
+    def set_dir_mtimes(self, mtime):
+        for (root, _, _) in os.walk(self.cfstore.record_path):
+            os.utime(root, (mtime, mtime))
+
     def get_dummy_records(self, num_command=1, num_init=1, num_exit=1):
         gen = lambda i, **kwds: dict(session_id='SID-{0}'.format(i), **kwds)
         return dict(
@@ -61,6 +86,9 @@ class TestIndexer(BaseTestCase):
             exit=[gen(i, stop=i) for i in range(num_exit)],
         )
 
+
+class TestIndexer(BaseIndexerTestCase):
+
     def test_find_record_files(self):
         indexer = self.get_indexer()
         self.assertEqual(list(indexer.find_record_files()), [])
@@ -81,3 +109,347 @@ class TestIndexer(BaseTestCase):
         indexer.index_all()
         actual_paths = list(indexer.find_record_files())
         self.assertEqual(actual_paths, [])
+
+    def test_index_all_skips_indexed_files(self):
+        self.prepare_records(**self.get_dummy_records(num_command=3))
+        indexer = self.get_indexer()
+        indexer.index_all()
+        self.assertEqual(len(indexer.db.get_indexed_files()), 5)
+
+        imported = []
+        indexer.db.import_dict = lambda dct, **_: imported.append(dct)
+        indexer.index_all()
+        self.assertEqual(imported, [])
+
+    def test_index_all_reindexes_modified_files(self):
+        (path,) = self.prepare_records(command=[dict(command='old')])
+        indexer = self.get_indexer()
+        indexer.index_all()
+        with open(path, 'w') as f:
+            json.dump(dict(command='new command'), f)
+
+        imported = []
+        indexer.db.import_dict = lambda dct, **_: imported.append(dct)
+        indexer.index_all()
+        self.assertEqual(imported, [dict(command='new command')])
+
+    def test_index_all_prunes_manifest(self):
+        paths = self.prepare_records(**self.get_dummy_records(num_command=3))
+        indexer = self.get_indexer()
+        indexer.index_all()
+        os.remove(paths[0])
+        os.rename(paths[1], paths[1] + '.moved')
+        indexer.index_all()
+        self.assertEqual(sorted(indexer.db.get_indexed_files()),
+                         sorted(map(indexer.get_manifest_key, paths[2:])))
+
+    def test_index_record_skips_indexed_file(self):
+        (path,) = self.prepare_records(command=[dict(command='command')])
+        indexer = self.get_indexer()
+        indexer.index_record(path)
+        imported = []
+        indexer.db.import_dict = lambda dct, **_: imported.append(dct)
+        indexer.index_record(path)
+        self.assertEqual(imported, [])
+
+    def test_index_all_in_parallel(self):
+        paths = self.prepare_records(
+            command=[dict(command=str(i)) for i in range(7)])
+        indexer = self.get_indexer(keep_json=False)
+        imported = []
+        indexer.db.import_dict = lambda dct, **_: imported.append(dct)
+        progress = []
+        num = indexer.index_all(jobs=3, batch_size=2, max_pending=2,
+                                progress=lambda n, _: progress.append(n))
+        self.assertEqual(num, 7)
+        self.assertEqual(imported, [dict(command=str(i)) for i in range(7)])
+        self.assertEqual(progress, [2, 4, 6, 7])
+        self.assertFalse(any(map(os.path.exists, paths)))
+
+    def test_index_all_counts_spool_backlog(self):
+        self.prepare_records(
+            command=[dict(command=str(i)) for i in range(5)])
+        indexer = self.get_indexer(keep_json=False)
+        gauges = indexer.metrics.gauges
+        backlog = []
+        indexer.db.import_dict = \
+            lambda dct, **_: backlog.append(gauges['spool_backlog'])
+        indexer.index_all(jobs=1, batch_size=2, max_pending=2)
+        self.assertEqual(backlog, [4, 4, 3, 3, 1])
+        self.assertEqual(gauges['spool_backlog'], 0)
+
+    def test_index_all_removes_files_after_commit(self):
+        paths = self.prepare_records(
+            command=[dict(command=str(i)) for i in range(4)])
+        indexer = self.get_indexer(keep_json=False)
+
+        def import_dict(dct, **_):
+            if dct['command'] == '3':
+                raise RuntimeError
+        indexer.db.import_dict = import_dict
+        self.assertRaises(RuntimeError, indexer.index_all, batch_size=2)
+        self.assertEqual(list(map(os.path.exists, paths)),
+                         [False, False, True, True])
+
+    def test_index_records(self):
+        paths = self.prepare_records(**self.get_dummy_records())
+        indexer = self.get_indexer(keep_json=False)
+        missing = os.path.join(self.cfstore.record_path, 'command', 'x.json')
+        self.assertEqual(indexer.index_records(paths + paths + [missing]), 3)
+        self.assertEqual(list(indexer.find_record_files()), [])
+        self.assertEqual(indexer.metrics.gauges['spool_backlog'], 0)
+
+    def count_command_history(self, indexer):
+        with indexer.db.connection() as db:
+            ((count,),) = db.execute('SELECT COUNT(*) FROM command_history')
+        return count
+
+    def test_catch_up(self):
+        paths = self.prepare_records(**self.get_dummy_records(num_command=2))
+        self.assertEqual(catch_up(self.cfstore), 4)
+        self.assertEqual(catch_up(self.cfstore), 0)
+        self.assertTrue(all(map(os.path.exists, paths)))
+
+        # Daemon removes the records without importing them again:
+        indexer = self.get_indexer(keep_json=False, check_duplicate=False)
+        indexer.index_all()
+        self.assertEqual(list(indexer.find_record_files()), [])
+        self.assertEqual(self.count_command_history(indexer), 2)
+        self.assertEqual(indexer.db.get_indexed_files(), {})
+
+    def test_catch_up_lists_changed_dirs_only(self):
+        self.prepare_records(**self.get_dummy_records())
+        old = time.time() - 100
+        self.set_dir_mtimes(old)
+        self.assertEqual(catch_up(self.cfstore), 3)
+
+        # A new file is not found as long as the directory is unchanged:
+        command_dir = os.path.join(self.cfstore.record_path, 'command')
+        with open(os.path.join(command_dir, 'new.json'), 'w') as f:
+            json.dump(dict(session_id='SID-0', command='git'), f)
+        os.utime(command_dir, (old, old))
+        self.assertEqual(catch_up(self.cfstore), 0)
+        os.utime(command_dir, (old + 1, old + 1))
+        self.assertEqual(catch_up(self.cfstore), 1)
+
+    def test_catch_up_finds_new_subdirectory(self):
+        old = time.time() - 100
+        self.set_dir_mtimes(old)
+        self.assertEqual(catch_up(self.cfstore), 0)
+        subdir = os.path.join(self.cfstore.record_path, 'command', '2013')
+        json_path = os.path.join(subdir, '01', '0.json')
+        mkdirp(os.path.dirname(json_path))
+        with open(json_path, 'w') as f:
+            json.dump(dict(command='git'), f)
+        self.assertEqual(catch_up(self.cfstore), 1)
+        self.assertEqual(catch_up(self.cfstore), 0)
+
+        shutil.rmtree(subdir)
+        catch_up(self.cfstore)
+        self.assertEqual(list(self.get_indexer().db.get_indexed_dirs()),
+                         [os.path.join('command', '')])
+
+    def test_index_records_removes_past_day_dirs(self):
+        past = self.write_dated_record(days_ago=400)
+        today = self.write_dated_record()
+        self.set_dir_mtimes(time.time() - 100)
+        self.assertEqual(catch_up(self.cfstore), 2)
+        indexer = self.get_indexer(keep_json=False)
+        self.assertEqual(indexer.index_records([past, today]), 2)
+
+        # Emptied directories of past days are removed with their marks:
+        command_dir = os.path.join(self.cfstore.record_path, 'command')
+        (past_year, today_year) = [
+            os.path.relpath(p, command_dir).split(os.path.sep)[0]
+            for p in [past, today]]
+        self.assertEqual(os.listdir(command_dir), [today_year])
+        self.assertTrue(os.path.isdir(os.path.dirname(today)))
+        past_key = os.path.join('command', past_year, '')
+        self.assertEqual(
+            [k for k in indexer.db.get_indexed_dirs()
+             if k.startswith(past_key)], [])
+
+    def test_index_records_keeps_past_day_dirs_with_keep_json(self):
+        past = self.write_dated_record(days_ago=400)
+        indexer = self.get_indexer(keep_json=True)
+        self.assertEqual(indexer.index_records([past]), 1)
+        self.assertTrue(os.path.exists(past))
+
+    def test_catch_up_skips_settled_past_day_dirs(self):
+        past = self.write_dated_record(days_ago=400)
+        today = self.write_dated_record()
+        self.set_dir_mtimes(time.time() - 100)
+        self.assertEqual(catch_up(self.cfstore), 2)
+        for path in [past, today]:
+            write_record(os.path.join(os.path.dirname(path), 'new.json'),
+                         dict(command='git'))
+        self.assertEqual(catch_up(self.cfstore), 1)
+
+    def test_catch_up_opens_db_for_writing_only_when_needed(self):
+        self.set_dir_mtimes(time.time() - 100)
+        catch_up(self.cfstore)
+        called = []
+        orig = DataBase.update_version_records
+        DataBase.update_version_records = lambda self: called.append(self)
+        try:
+            self.assertEqual(catch_up(self.cfstore), 0)
+        finally:
+            DataBase.update_version_records = orig
+        self.assertEqual(called, [])
+
+    def test_catch_up_when_locked(self):
+        self.prepare_records(**self.get_dummy_records())
+        with FileLock(self.cfstore.index_lock_path):
+            self.assertEqual(catch_up(self.cfstore), None)
+        self.assertEqual(catch_up(self.cfstore), 3)
+
+
+class TestRecordPoller(BaseIndexerTestCase):
+
+    def get_poller(self, keep_json=False, **kwds):
+        indexer = self.get_indexer(keep_json=keep_json)
+        poller = RecordPoller(indexer, **kwds)
+        poller.mtime_slack = -1  # do not wait for mtime to be settled
+        return poller
+
+    def test_scan_indexes_new_records(self):
+        poller = self.get_poller()
+        self.assertEqual(poller.scan(), 0)
+        self.prepare_records(**self.get_dummy_records(num_command=2))
+        self.assertEqual(poller.scan(), 4)
+        self.assertEqual(list(poller.indexer.find_record_files()), [])
+        with poller.indexer.db.connection() as db:
+            ((count,),) = db.execute('SELECT COUNT(*) FROM command_history')
+        self.assertEqual(count, 2)
+
+    def test_scan_skips_unchanged_directory(self):
+        self.prepare_records(**self.get_dummy_records())
+        poller = self.get_poller(keep_json=True)
+        self.assertEqual(poller.scan(), 3)
+        listed = poller.stats['listed_dirs']
+        self.assertEqual(poller.scan(), 0)
+        self.assertEqual(poller.stats['listed_dirs'], listed)
+
+    def test_scan_skips_files_in_manifest(self):
+        self.prepare_records(**self.get_dummy_records())
+        self.get_indexer().index_all()
+        poller = self.get_poller(keep_json=True)
+        self.assertEqual(poller.scan(), 0)
+
+    def test_scan_finds_records_in_subdirectory(self):
+        poller = self.get_poller()
+        poller.scan()
+        json_path = os.path.join(self.cfstore.record_path,
+                                 'command', '2013', '00000.json')
+        mkdirp(os.path.dirname(json_path))
+        with open(json_path, 'w') as f:
+            json.dump(dict(command='git status'), f)
+        self.assertEqual(poller.scan(), 1)
+
+    def test_scan_removes_past_day_dirs(self):
+        past = self.write_dated_record(days_ago=400)
+        poller = self.get_poller()
+        self.assertEqual(poller.scan(), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(past)))
+        self.assertEqual(poller.scan(), 0)
+
+    def test_scan_stops_checking_settled_past_day_dirs(self):
+        self.write_dated_record(days_ago=400)
+        poller = self.get_poller(keep_json=True)
+        self.assertEqual(poller.scan(), 1)
+        poller.scan()
+        checked = poller.stats['checked_dirs']
+        self.assertEqual(poller.scan(), 0)
+        # Only the spool directory "command" is stat'ed:
+        self.assertEqual(poller.stats['checked_dirs'], checked + 1)
+
+    def test_next_interval(self):
+        poller = self.get_poller(interval=1, max_interval=5)
+        self.assertEqual(
+            [poller.next_interval(0) for _ in range(4)], [2, 4, 5, 5])
+        self.assertEqual(poller.next_interval(1), 1)
+
+
+@unittest.skipUnless(inotify.is_available(), 'inotify is not available')
+class TestInotifyRecordWatcher(BaseIndexerTestCase):
+
+    def test_poll_indexes_closed_record(self):
+        watcher = inotify.RecordWatcher(self.get_indexer(keep_json=False))
+        self.addCleanup(watcher.inotify.close)
+        self.assertEqual(watcher.poll(0), 0)
+        self.prepare_records(command=[dict(command='git status')])
+        self.assertEqual(watcher.poll(1), 1)
+
+    def test_poll_ignores_file_being_written(self):
+        watcher = inotify.RecordWatcher(self.get_indexer(keep_json=False))
+        self.addCleanup(watcher.inotify.close)
+        json_path = os.path.join(self.cfstore.record_path,
+                                 'command', '00000.json')
+        with open(json_path, 'w') as f:
+            f.write('{"command": ')
+            f.flush()
+            self.assertEqual(watcher.poll(0.1), 0)
+            f.write('"git status"}')
+        self.assertEqual(watcher.poll(1), 1)
+
+    def test_poll_watches_new_subdirectory(self):
+        watcher = inotify.RecordWatcher(self.get_indexer(keep_json=False))
+        self.addCleanup(watcher.inotify.close)
+        json_path = os.path.join(self.cfstore.record_path,
+                                 'command', '2013', '00000.json')
+        mkdirp(os.path.dirname(json_path))
+        self.assertEqual(watcher.poll(1), 0)
+        with open(json_path, 'w') as f:
+            json.dump(dict(command='git status'), f)
+        self.assertEqual(watcher.poll(1), 1)
+
+
+    def test_past_day_dirs_are_not_watched_once_settled(self):
+        past = os.path.dirname(self.write_dated_record(days_ago=400))
+        self.set_dir_mtimes(time.time() - 100)
+        watcher = inotify.RecordWatcher(self.get_indexer(keep_json=True))
+        self.addCleanup(watcher.inotify.close)
+        self.assertNotIn(past, watcher.watches.values())
+        self.assertIn(os.path.join(self.cfstore.record_path, 'command'),
+                      watcher.watches.values())
+
+    def test_settled_watches_are_dropped_on_new_day(self):
+        watcher = inotify.RecordWatcher(self.get_indexer(keep_json=True))
+        self.addCleanup(watcher.inotify.close)
+        past = os.path.dirname(self.write_dated_record(days_ago=400))
+        self.assertEqual(watcher.poll(1), 1)
+        self.assertIn(past, watcher.watches.values())
+        self.set_dir_mtimes(time.time() - 100)
+        self.write_dated_record()
+        self.assertEqual(watcher.poll(1), 1)
+        self.assertNotIn(past, watcher.watches.values())
+
+@unittest.skipIf(Observer is None, 'watchdog is not available')
+class TestRecordHandler(BaseIndexerTestCase):
+
+    def test_index_record_written_by_write_record(self):
+        indexer = self.get_indexer(keep_json=False)
+        indexed = []
+        index_records = indexer.index_records
+
+        def record_paths(paths):
+            indexed.extend(paths)
+            return index_records(paths)
+        indexer.index_records = record_paths
+        json_path = get_record_path(self.cfstore.record_path, 'command')
+        mkdirp(os.path.dirname(json_path))
+        observer = Observer()
+        observer.schedule(RecordHandler(indexer),
+                          path=self.cfstore.record_path, recursive=True)
+        observer.start()
+        self.addCleanup(observer.join)
+        self.addCleanup(observer.stop)
+        write_record(json_path, dict(command='git status'))
+        for _ in range(50):
+            if indexed:
+                break
+            time.sleep(0.1)
+        self.assertEqual(indexed, [json_path])
+        with indexer.db.connection() as db:
+            ((count,),) = db.execute('SELECT COUNT(*) FROM command_history')
+        self.assertEqual(count, 1)
@@ -0,0 +1,113 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import threading
+
+from ..config import MaintenanceConfig
+from ..database import DataBase
+from ..maintain import maintain, format_report, IdleMaintainer, TASKS
+from ..metrics import Metrics
+from .utils import BaseTestCase
+
+
+class TestMaintain(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.db = DataBase(os.path.join(self.base_path, 'db.sqlite'))
+        self.db.import_dicts(
+            {'command': 'command {0}'.format(i), 'start': i}
+            for i in range(500))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def execute(self, sql):
+        with self.db.connection(commit=True) as connection:
+            return list(connection.execute(sql))
+
+    def test_all_tasks(self):
+        report = maintain(self.db)
+        self.assertEqual(sorted(report['tasks']), sorted(TASKS))
+        self.assertTrue(report['tasks']['check']['ok'])
+        self.assertTrue(self.execute('SELECT * FROM sqlite_stat1'))
+        self.assertEqual(len(format_report(report)),
+                         1 + len(TASKS) + len(report['probes_before']))
+
+    def test_incremental_vacuum(self):
+        self.execute('DELETE FROM command_history')
+        report = maintain(self.db, ['vacuum'], vacuum_pages=2)
+        self.assertEqual(report['tasks']['vacuum']['freed_pages'], 2)
+        report = maintain(self.db, ['vacuum'])
+        self.assertEqual(self.execute('PRAGMA freelist_count'), [(0,)])
+        self.assertTrue(report['size_after'] < report['size_before'])
+
+    def test_full_vacuum_only_without_budget(self):
+        with self.db.connection() as connection:
+            connection.execute('PRAGMA auto_vacuum = NONE')
+            connection.execute('VACUUM')
+        report = maintain(self.db, ['vacuum'], vacuum_pages=10)
+        self.assertIn('skipped', report['tasks']['vacuum'])
+        maintain(self.db, ['vacuum'])
+        self.assertEqual(self.execute('PRAGMA auto_vacuum'), [(2,)])
+
+    def test_time_budget(self):
+        report = maintain(self.db, ['analyze', 'check'], time_budget=-1)
+        self.assertIn('skipped', report['tasks']['analyze'])
+        self.assertIn('skipped', report['tasks']['check'])
+
+
+class DummyIndexer(object):
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.logger = None
+        self.write_lock = threading.Lock()
+
+
+class TestIdleMaintainer(BaseTestCase):
+
+    def test_is_due(self):
+        indexer = DummyIndexer()
+        maintainer = IdleMaintainer(indexer, MaintenanceConfig())
+        now = maintainer.started
+        self.assertFalse(maintainer.is_due(now + 60))
+        self.assertTrue(maintainer.is_due(now + 3600))
+        indexer.metrics.observe_batch(1, 0.1, [now], now + 3590)
+        self.assertFalse(maintainer.is_due(now + 3600))
+        self.assertTrue(maintainer.is_due(now + 3650))
+
+    def test_is_due_when_disabled(self):
+        config = MaintenanceConfig()
+        config.interval = 0
+        maintainer = IdleMaintainer(DummyIndexer(), config)
+        self.assertFalse(maintainer.is_due(maintainer.started + 3600))
+
+    def test_submit(self):
+        indexer = DummyIndexer()
+        maintainer = IdleMaintainer(indexer, MaintenanceConfig())
+        maintainer.start()
+        try:
+            job = maintainer.submit(
+                lambda x: (threading.current_thread(),
+                           indexer.write_lock.locked(), x), 1)
+            self.assertEqual(job.wait(), (maintainer.jobs.thread, True, 1))
+        finally:
+            maintainer.stop()
+        self.assertFalse(indexer.write_lock.locked())
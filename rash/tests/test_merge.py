@@ -0,0 +1,118 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+
+from ..database import DataBase
+from ..merge import merge
+from .utils import BaseTestCase, dump_db
+
+
+def host_records(host, num, session_ids):
+    for i in range(num):
+        yield {
+            'command': 'command {0}'.format(i % 4),
+            'session_id': session_ids[i % len(session_ids)],
+            'cwd': '/{0}/{1}'.format(host, i % 2),
+            'terminal': 'xterm',
+            'start': i * 2 + (host == 'B'),
+            'stop': i * 2 + 1,
+            'exit_code': i % 3,
+            'pipestatus': [0, i % 3],
+            'environ': {'HOST': host, 'SHELL': 'zsh', 'N': str(i % 5)},
+        }
+
+
+class TestMerge(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.hosts = {
+            'A': list(host_records('A', 20, ['A1', 'AB'])),
+            'B': list(host_records('B', 15, ['B1', 'AB'])),
+        }
+        self.init = {
+            'A1': {'HOST': 'A', 'SHELL': 'zsh'},
+            'AB': {'SHELL': 'zsh'},
+            'B1': {'HOST': 'B', 'SHELL': 'bash'},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def make_db(self, name, hosts, shared_init='AB'):
+        db = DataBase(os.path.join(self.base_path, name + '.sqlite'))
+        for host in hosts:
+            for (session_id, environ) in sorted(self.init.items()):
+                if session_id.startswith(host) or (
+                        session_id == 'AB' and host in shared_init):
+                    db.import_init_dict({'session_id': session_id,
+                                         'start': -1, 'environ': environ})
+            db.import_dicts(self.hosts[host])
+        return db
+
+    def test_merge(self):
+        db = self.make_db('A', 'A')
+        report = merge(db, self.make_db('B', 'B').dbpath)
+        self.assertEqual(report['command_history'], 15)
+        self.assertEqual(report['skipped'], 0)
+        self.assertEqual(report['session_history'], 1)
+        self.assertEqual(dump_db(db), dump_db(self.make_db('AB', 'AB')))
+
+    def test_merge_twice(self):
+        db = self.make_db('A', 'A')
+        source = self.make_db('B', 'B').dbpath
+        merge(db, source)
+        expected = dump_db(db)
+        report = merge(db, source)
+        self.assertEqual(report['command_history'], 0)
+        self.assertEqual(report['skipped'], 15)
+        self.assertEqual(dump_db(db), expected)
+
+    def test_merge_overlapping(self):
+        self.hosts['B'].extend(self.hosts['A'][:10])
+        db = self.make_db('A', 'A')
+        report = merge(db, self.make_db('B', 'B').dbpath)
+        self.assertEqual(report['skipped'], 10)
+        self.assertEqual(dump_db(db), dump_db(self.make_db('AB', 'AB')))
+
+    def test_merge_session_environ(self):
+        # Only B has the environ of the shared session "AB":
+        db = self.make_db('A', 'A', shared_init='B')
+        merge(db, self.make_db('B', 'B', shared_init='B').dbpath)
+        self.assertEqual(dump_db(db),
+                         dump_db(self.make_db('AB', 'AB', shared_init='B')))
+
+    def test_merge_into_empty(self):
+        db = self.make_db('empty', '')
+        merge(db, self.make_db('A', 'A').dbpath)
+        self.assertEqual(dump_db(db), dump_db(self.make_db('A2', 'A')))
+
+    def test_merge_imported_history(self):
+        # Same command without timestamps at different lines:
+        records = [{'command': 'ls', 'origin': 'host:/history:{0}'.format(i)}
+                   for i in range(3)]
+        source = self.make_db('source', '')
+        source.import_dicts(records)
+        db = self.make_db('A', 'A')
+        self.assertEqual(merge(db, source.dbpath)['command_history'], 3)
+        self.assertEqual(merge(db, source.dbpath)['skipped'], 3)
+
+    def test_merge_to_itself(self):
+        db = self.make_db('A', 'A')
+        self.assertRaises(ValueError, merge, db, db.dbpath)
@@ -13,8 +13,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
 from ..config import Configuration
-from ..query import expand_query
+from ..query import expand_query, QueryFrontend
 from .utils import BaseTestCase
 
 
@@ -45,3 +47,55 @@ class TestExpandQuery(BaseTestCase):
         kwds = expand_query(self.config, {'pattern': ['test', 'build']})
         self.assertEqual(kwds['include_pattern'], ['*test*', '*build*'])
         self.assertEqual(kwds['pattern'], [])
+
+
+class TestQueryFrontend(BaseTestCase):
+
+    def setUp(self):
+        self.config = Configuration()
+        self.config.search.alias['test'] = ["--include-pattern", "*test*"]
+        self.frontend = QueryFrontend(self.config)
+
+    def test_parse_alias(self):
+        kwds = self.frontend.parse('test -d /tmp')
+        self.assertEqual(kwds['include_pattern'], ['*test*'])
+        self.assertEqual(kwds['cwd'], ['/tmp'])
+
+    def test_returned_kwds_are_not_shared(self):
+        kwds = self.frontend.parse('test')
+        kwds['include_pattern'].append('*make*')
+        kwds['cwd_glob'].append('/tmp/*')
+        kwds = self.frontend.parse('test')
+        self.assertEqual(kwds['include_pattern'], ['*test*'])
+        self.assertEqual(kwds['cwd_glob'], [])
+
+    def test_alias_expansion_is_not_shared(self):
+        expand_query(self.config, {'include_pattern': ['*make*'],
+                                   'pattern': ['test']})
+        kwds = expand_query(self.config, {'pattern': ['test']})
+        self.assertEqual(kwds['include_pattern'], ['*test*'])
+
+    def test_base_query(self):
+        frontend = QueryFrontend(self.config, ['--cwd', '/tmp'])
+        kwds = frontend.parse('git')
+        self.assertEqual(kwds['cwd'], ['/tmp'])
+        self.assertEqual(kwds['match_pattern'], ['*git*'])
+
+    def test_invalid_query(self):
+        self.assertRaises(ValueError, self.frontend.parse, '--limit')
+
+    def test_cached_parse_is_fast(self):
+        """
+        Per-keystroke parse cost should stay in microseconds.
+        """
+        query = 'test git st -d /tmp --exclude-pattern "*rash *"'
+        self.frontend.parse(query)
+        num = 1000
+        start = time.time()
+        for _ in range(num):
+            self.frontend.parse(query)
+        per_call = (time.time() - start) / num
+        # Usually it is a few micro seconds.  Use a large margin to
+        # avoid spurious failure in slow environments.
+        self.assertTrue(per_call < 1e-3,
+                        'parse took {0} sec per call'.format(per_call))
@@ -0,0 +1,50 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import shutil
+import tempfile
+
+from ..record import get_record_path, write_record
+from .utils import BaseTestCase
+
+
+class TestWriteRecord(BaseTestCase):
+
+    def setUp(self):
+        self.record_path = tempfile.mkdtemp(prefix='rash-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.record_path)
+
+    def test_record_paths_are_unique(self):
+        paths = [get_record_path(self.record_path, 'command', now=0)
+                 for _ in range(3)]
+        self.assertEqual(len(set(paths)), 3)
+
+    def test_write_record(self):
+        json_path = get_record_path(self.record_path, 'command')
+        write_record(json_path, dict(command='git status'))
+        with open(json_path) as f:
+            self.assertEqual(json.load(f), dict(command='git status'))
+        self.assertEqual(os.listdir(os.path.dirname(json_path)),
+                         [os.path.basename(json_path)])
+
+    def test_write_record_removes_temporary_file_on_error(self):
+        json_path = get_record_path(self.record_path, 'command')
+        self.assertRaises(TypeError, write_record, json_path, dict(x=object()))
+        self.assertEqual(os.listdir(os.path.dirname(json_path)), [])
@@ -0,0 +1,261 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import socket
+import tempfile
+import shutil
+import threading
+
+from ..config import ConfigStore, MaintenanceConfig
+from ..database import DataBase
+from ..indexer import Indexer, catch_up
+from ..maintain import IdleMaintainer
+from ..utils.lockfile import FileLock
+from ..utils.pathutils import mkdirp
+from ..server import (
+    start_server, call_daemon, call_daemon_or_db, call_daemon_or_lock)
+from .utils import BaseTestCase
+
+
+class TestQueryServer(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.cfstore = ConfigStore(self.base_path)
+        self.db = DataBase(self.cfstore.db_path)
+        self.server = start_server(self.cfstore)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.base_path)
+
+    def test_ping(self):
+        self.assertEqual(call_daemon(self.cfstore, 'ping'), 'pong')
+
+    def test_idle_client_does_not_block(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.cfstore.daemon_socket_path)
+        try:
+            self.assertEqual(
+                call_daemon(self.cfstore, 'ping', timeout=0.5), 'pong')
+        finally:
+            sock.close()
+
+    def test_unknown_method(self):
+        self.assertRaises(RuntimeError, call_daemon, self.cfstore, 'unknown')
+
+    def test_suggest(self):
+        self.db.import_dict({'command': 'git status', 'cwd': '/A'})
+        self.db.import_dict({'command': 'git stash', 'cwd': '/B'})
+        self.assertEqual(
+            call_daemon(self.cfstore, 'suggest', prefix='git st', cwd='/B'),
+            ['git stash'])
+        self.assertEqual(
+            call_daemon_or_db(self.cfstore, 'suggest',
+                              prefix='git st', cwd='/A'),
+            ['git status'])
+
+    def test_suggest_without_daemon(self):
+        self.db.import_dict({'command': 'git status'})
+        self.server.stop()
+        self.assertFalse(os.path.exists(self.cfstore.daemon_socket_path))
+        self.assertRaises(socket.error, call_daemon, self.cfstore, 'ping')
+        self.assertEqual(
+            call_daemon_or_db(self.cfstore, 'suggest', prefix='git'),
+            ['git status'])
+        self.server = start_server(self.cfstore)
+
+    def test_predict(self):
+        for (i, command) in enumerate(['make', 'make test', 'make',
+                                       'make install', 'make',
+                                       'make test']):
+            self.db.import_dict({'command': command, 'session_id': 'SID',
+                                 'start': i})
+        self.assertEqual(
+            call_daemon(self.cfstore, 'predict', after='make'),
+            ['make test', 'make install'])
+        self.assertEqual(
+            call_daemon(self.cfstore, 'predict', session_id='SID'),
+            ['make'])
+
+    def test_nav(self):
+        for command in ['a', 'b']:
+            self.db.import_dict({'command': command, 'cwd': '/A'})
+        latest = call_daemon(self.cfstore, 'nav', cwd='/A')
+        self.assertEqual(latest['command'], 'b')
+        result = call_daemon(self.cfstore, 'nav', cwd='/A',
+                             before_id=latest['command_history_id'])
+        self.assertEqual(result['command'], 'a')
+        result = call_daemon(self.cfstore, 'nav', cwd='/A',
+                             before_id=result['command_history_id'])
+        self.assertEqual(result, None)
+
+
+class TestDaemonIndexer(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.cfstore = ConfigStore(self.base_path)
+        self.indexer = Indexer(self.cfstore, False, False)
+        self.maintainer = IdleMaintainer(self.indexer, MaintenanceConfig())
+        self.maintainer.start()
+        self.server = start_server(self.cfstore, self.indexer,
+                                   self.maintainer)
+
+    def tearDown(self):
+        self.server.stop()
+        self.maintainer.stop()
+        shutil.rmtree(self.base_path)
+
+    def write_record(self, name):
+        json_path = os.path.join(self.cfstore.record_path, 'command', name)
+        mkdirp(os.path.dirname(json_path))
+        with open(json_path, 'w') as f:
+            json.dump(dict(command='git status'), f)
+        return json_path
+
+    def test_status(self):
+        paths = [self.write_record('{0}.json'.format(i)) for i in range(3)]
+        self.indexer.metrics.add('spool_backlog', 3)
+        status = call_daemon(self.cfstore, 'status')
+        self.assertEqual(status['gauges']['spool_backlog'], 3)
+
+        self.indexer.metrics.add('spool_backlog', -3)
+        self.indexer.index_records(paths[:2])
+        status = call_daemon(self.cfstore, 'status')
+        self.assertEqual(status['gauges']['spool_backlog'], 0)
+        self.assertEqual(status['counters']['records_indexed'], 2)
+        self.assertEqual(status['histograms']['batch_size']['count'], 1)
+        self.assertEqual(status['histograms']['lag_seconds']['count'], 2)
+
+    def test_status_in_prometheus_format(self):
+        self.indexer.index_records([self.write_record('0.json')])
+        text = call_daemon(self.cfstore, 'status', format='prometheus')
+        self.assertIn('rash_records_indexed_total 1\n', text)
+        self.assertIn('rash_commit_seconds_count 1\n', text)
+        self.assertIn('rash_spool_backlog 0\n', text)
+
+    def test_index(self):
+        paths = [self.write_record('{0}.json'.format(i)) for i in range(2)]
+        self.assertEqual(call_daemon(self.cfstore, 'index'), 2)
+        self.assertFalse(any(map(os.path.exists, paths)))
+        self.assertEqual(
+            call_daemon(self.cfstore, 'status')['counters']['records_indexed'],
+            2)
+
+    def test_index_in_index_thread(self):
+        self.write_record('0.json')
+        threads = []
+        index_all = Indexer.index_all
+
+        def record_thread(indexer, *args, **kwds):
+            threads.append(threading.current_thread())
+            return index_all(indexer, *args, **kwds)
+        Indexer.index_all = record_thread
+        try:
+            self.assertEqual(call_daemon(self.cfstore, 'index'), 1)
+        finally:
+            Indexer.index_all = index_all
+        self.assertEqual(threads, [self.server.api.index_jobs.thread])
+
+    def test_call_daemon_or_lock(self):
+        self.write_record('0.json')
+        with FileLock(self.cfstore.index_lock_path):
+            self.assertEqual(
+                call_daemon_or_lock(self.cfstore, 'index', self.fail), 1)
+
+    def test_maintain(self):
+        report = call_daemon(self.cfstore, 'maintain', tasks=['check'])
+        self.assertTrue(report['tasks']['check']['ok'])
+
+    def test_merge(self):
+        source = DataBase(os.path.join(self.base_path, 'source.sqlite'))
+        source.import_dict({'command': 'git status', 'start': 1})
+        report = call_daemon(self.cfstore, 'merge', source=source.dbpath)
+        self.assertEqual(report['command_history'], 1)
+
+    def test_import_history(self):
+        path = os.path.join(self.base_path, 'history')
+        with open(path, 'wb') as f:
+            f.write(b': 1373500000:0;ls\n: 1373500001:0;ls\n')
+        self.assertEqual(
+            call_daemon(self.cfstore, 'import_history', path=path,
+                        format='zsh', batch_size=1),
+            [2, 0])
+        self.assertEqual(
+            call_daemon(self.cfstore, 'import_history', path=path),
+            [0, 2])
+        self.assertEqual(self.commands(DataBase(self.cfstore.db_path)),
+                         ['ls', 'ls'])
+
+    def commands(self, db):
+        with db.connection() as connection:
+            return [command for (command,) in connection.execute(
+                'SELECT command FROM command_history '
+                'JOIN command_list ON command_id = command_list.id')]
+
+    def test_forget(self):
+        db = DataBase(self.cfstore.db_path)
+        db.import_dicts([{'command': 'git status', 'start': 1},
+                         {'command': 'secret', 'start': 2}])
+        (deleted, garbage) = call_daemon(
+            self.cfstore, 'forget', pattern=['secret'], batch_size=10)
+        self.assertEqual(deleted, 1)
+        self.assertEqual(garbage['command_list'], 1)
+        self.assertEqual(self.commands(db), ['git status'])
+
+    def test_archive(self):
+        db = DataBase(self.cfstore.db_path)
+        db.import_dicts([{'command': 'git status', 'start': 1}])
+        moved = call_daemon(
+            self.cfstore, 'archive', archive_path=self.cfstore.archive_path,
+            older_than=1, period='year')
+        self.assertEqual(moved, {'1970': 1})
+        self.assertEqual(self.commands(db), [])
+
+    def test_catch_up_leaves_records_to_daemon(self):
+        json_path = self.write_record('0.json')
+        with FileLock(self.cfstore.index_lock_path):
+            self.assertEqual(catch_up(self.cfstore), None)
+        self.assertTrue(os.path.exists(json_path))
+
+
+class TestCallDaemonOrLock(BaseTestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp(prefix='rash-test-')
+        self.cfstore = ConfigStore(self.base_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_no_daemon(self):
+        lock = FileLock(self.cfstore.index_lock_path)
+
+        def func():
+            self.assertFalse(lock.acquire(blocking=False))
+            return 'local'
+        self.assertEqual(
+            call_daemon_or_lock(self.cfstore, 'index', func), 'local')
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_locked_by_other_process(self):
+        with FileLock(self.cfstore.index_lock_path):
+            self.assertRaises(RuntimeError, call_daemon_or_lock,
+                              self.cfstore, 'index', self.fail)
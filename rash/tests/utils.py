@@ -16,6 +16,7 @@
 
 import unittest
 import functools
+import itertools
 from contextlib import contextmanager
 
 from ..utils.py3compat import zip_longest
@@ -78,3 +79,118 @@ def zip_dict(dictionary, fillvalue=None):
     (keys, lists) = zip(*dictionary.items())
     for values in zip_longest(*lists, fillvalue=fillvalue):
         yield dict(zip(keys, values))
+
+
+def dump_db(db):
+    """
+    Return contents of `db` which do not depend on row IDs.
+
+    Transitions counted down to zero are ignored, as they are deleted
+    only by set-based updates (e.g., :func:`rash.merge.merge`).
+
+    """
+    with db.connection() as connection:
+        execute = lambda sql: sorted(connection.execute(sql))
+        tables = dict(
+            usage=execute("""
+            SELECT CL.command, use_count, last_used FROM command_usage
+            JOIN command_list AS CL ON command_id = CL.id
+            """),
+            directory_usage=execute("""
+            SELECT CL.command, DL.directory, use_count, last_used
+            FROM command_directory_usage
+            JOIN command_list AS CL ON command_id = CL.id
+            JOIN directory_list AS DL ON directory_id = DL.id
+            """),
+            transition=execute("""
+            SELECT P.command, N.command, use_count
+            FROM command_transition
+            JOIN command_list AS P ON prev_command_id = P.id
+            JOIN command_list AS N ON next_command_id = N.id
+            WHERE use_count != 0
+            """),
+            directory_transition=execute("""
+            SELECT P.command, N.command, DL.directory, use_count
+            FROM command_directory_transition
+            JOIN command_list AS P ON prev_command_id = P.id
+            JOIN command_list AS N ON next_command_id = N.id
+            JOIN directory_list AS DL ON directory_id = DL.id
+            WHERE use_count != 0
+            """),
+            sessions=execute("""
+            SELECT session_long_id, start_time, stop_time
+            FROM session_history
+            """),
+            fingerprints=execute("""
+            SELECT fingerprint FROM command_history
+            WHERE fingerprint IS NOT NULL
+            """),
+        )
+        ids = [i for (i,) in connection.execute(
+            'SELECT id FROM command_history')]
+    records = []
+    for crec in db.get_full_command_records(ids):
+        dct = crec.__dict__
+        del dct['command_history_id']
+        del dct['session_history_id']
+        dct['environ'] = sorted(dct['environ'].items())
+        records.append(sorted(dct.items(), key=lambda kv: kv[0]))
+    tables['records'] = sorted(records, key=repr)
+    return tables
+
+
+def get_default_search_kwds():
+    """
+    Return default keyword arguments of ``rash search``.
+    """
+    import argparse
+    from ..search import search_add_arguments
+    from ..query import preprocess_kwds
+    parser = argparse.ArgumentParser()
+    search_add_arguments(parser)
+    return preprocess_kwds(vars(parser.parse_args([])))
+
+
+SEARCH_SUMMARY_FIELDS = [
+    'command', 'start', 'stop', 'exit_code', 'command_count', 'success_count']
+
+
+def search_summary(search, **kwds):
+    """
+    Call `search` with `kwds` and summarize found records for comparison.
+
+    Defaults of `kwds` are the ones of ``rash search``.  Order of
+    records with the same sort key is not defined, so records are
+    returned as a list of groups of the same sort key and each group
+    is sorted.  Each record is a tuple of
+    :data:`SEARCH_SUMMARY_FIELDS`.
+
+    """
+    from ..federated import SORT_KEY_ATTRS
+    kwds = dict(get_default_search_kwds(), **kwds)
+    if kwds['unique']:
+        kwds['additional_columns'] = ['command_count', 'success_count']
+    attrs = [SORT_KEY_ATTRS.get(k, k) for k in kwds['sort_by']]
+    groups = itertools.groupby(
+        search(**kwds), lambda r: [getattr(r, a, None) for a in attrs])
+    return [sorted((tuple(getattr(r, f, None) for f in SEARCH_SUMMARY_FIELDS)
+                    for r in group), key=repr)
+            for (_, group) in groups]
+
+
+def null_and_tied_records(start, cwd='/'):
+    """
+    Return command records with tied or NULL start and stop times.
+
+    Records with different `cwd` do not have the same fingerprint
+    but they are the same in :func:`search_summary`.
+
+    """
+    return [
+        {'command': 'tie a', 'cwd': cwd, 'start': start, 'stop': start + 1,
+         'exit_code': 0},
+        {'command': 'tie b', 'cwd': cwd, 'start': start, 'stop': start + 2,
+         'exit_code': 1},
+        {'command': 'no start', 'cwd': cwd, 'stop': start, 'exit_code': 0},
+        {'command': 'no time', 'cwd': cwd, 'exit_code': 1},
+    ]
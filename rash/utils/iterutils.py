@@ -38,6 +38,22 @@ def repeat(item, num):
     return itertools.islice(itertools.repeat(item), num)
 
 
+def chunks(iterative, size):
+    """
+    Yield lists of `size` elements taken from `iterative`.
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    """
+    iterative = iter(iterative)
+    while True:
+        chunk = list(itertools.islice(iterative, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def _backward_shifted_predicate(predicate, num, iterative, include_zero=True):
     queue = []
     for elem in iterative:
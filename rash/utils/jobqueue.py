@@ -0,0 +1,109 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+from .py3compat import queue
+
+
+class Job(object):
+
+    """
+    A function call submitted to :class:`JobQueue`.
+    """
+
+    def __init__(self, func, args, kwds):
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwds)
+        except Exception as err:
+            self.error = err
+        finally:
+            self.done.set()
+
+    def wait(self):
+        """
+        Wait for the job and return its result or raise its error.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class JobQueue(object):
+
+    """
+    Run submitted jobs one by one in a background thread.
+
+    If `idle` is given, it is called when no job is submitted for
+    `idle_interval` seconds.
+
+    >>> jobs = JobQueue()
+    >>> jobs.start()
+    >>> jobs.submit(sum, [1, 2]).wait()
+    3
+    >>> jobs.submit(int, 'x').wait()
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    >>> jobs.stop()
+
+    """
+
+    def __init__(self, idle=None, idle_interval=10):
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def submit(self, func, *args, **kwds):
+        """
+        Call ``func(*args, **kwds)`` in the thread and return a :class:`Job`.
+        """
+        job = Job(func, args, kwds)
+        self.queue.put(job)
+        return job
+
+    def run(self):
+        timeout = self.idle_interval if self.idle else None
+        while True:
+            try:
+                job = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.idle()
+                continue
+            if job is None:
+                break
+            job.run()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the thread after the jobs already submitted.
+        """
+        self.queue.put(None)
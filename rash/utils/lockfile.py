@@ -0,0 +1,125 @@
+# Copyright (C) 2013-  Takafumi Arakaki
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .pathutils import mkdirp
+
+
+class FileLock(object):
+
+    """
+    Inter-process lock using :func:`fcntl.flock`.
+
+    The lock is released automatically when the process dies, so there
+    is no stale lock.  Where :mod:`fcntl` is not available, acquiring
+    the lock always succeeds.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> lock = FileLock(os.path.join(tmp, 'lock'))
+    >>> lock.acquire(blocking=False)
+    True
+    >>> FileLock(lock.path).acquire(blocking=False)
+    False
+    >>> lock.release()
+    >>> with FileLock(lock.path):
+    ...     pass
+    >>> shutil.rmtree(tmp)
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock and return true if succeeded.
+
+        If `blocking` is false and the lock is held by other process,
+        return false immediately.
+
+        """
+        if self.fd is not None:
+            return True
+        mkdirp(os.path.dirname(self.path))
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if fcntl is None:
+                break
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, flags)
+            except (IOError, OSError):
+                os.close(fd)
+                return False
+            # The file may be removed by the previous holder (see
+            # `release`) while this process is waiting for it.
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    break
+            except OSError:
+                pass
+            os.close(fd)
+        self.fd = fd
+        return True
+
+    def write(self, data):
+        """
+        Replace the content of the lock file with `data` (str).
+        """
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, data.encode('utf-8'))
+
+    def read(self):
+        """
+        Read the content of the lock file (e.g., written by the holder).
+        """
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def release(self, remove=False):
+        """
+        Release the lock.  Remove the lock file if `remove` is true.
+        """
+        if self.fd is not None:
+            if remove:
+                os.remove(self.path)
+            os.close(self.fd)  # this releases flock
+            self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
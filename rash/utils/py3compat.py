@@ -47,3 +47,31 @@ try:
     from itertools import izip as zip
 except ImportError:
     zip = zip
+
+try:
+    unichr = unichr
+except NameError:
+    unichr = chr
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+try:
+    execfile = execfile
+except NameError:
+    def execfile(path, namespace):
+        with open(path) as f:
+            code = compile(f.read(), path, 'exec')
+        exec(code, namespace)
@@ -14,18 +14,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import time
 import signal
 
+from .utils.py3compat import scandir
+
 try:
-    from watchdog.events import (
-        FileSystemEventHandler, FileCreatedEvent)
+    from watchdog.events import FileSystemEventHandler
     assert FileSystemEventHandler  # fool pyflakes
 except ImportError:
     # Dummy class for making this module importable:
     FileSystemEventHandler = object
 
 
+def is_record_name(name):
+    """
+    Return true if `name` is a name of a finished record file.
+
+    Temporary files made by :func:`rash.record.write_record` start
+    with ``.`` and are renamed to a name ending with ``.json``.
+
+    >>> is_record_name('00000.json')
+    True
+    >>> is_record_name('.00000.json.tmp')
+    False
+
+    """
+    return name.endswith('.json') and not name.startswith('.')
+
+
 class RecordHandler(FileSystemEventHandler):
 
     def __init__(self, indexer, **kwds):
@@ -33,8 +51,206 @@ class RecordHandler(FileSystemEventHandler):
         super(RecordHandler, self).__init__(**kwds)
 
     def on_created(self, event):
-        if isinstance(event, FileCreatedEvent):
-            self.__indexer.index_record(event.src_path)
+        if not event.is_directory:
+            self.__index(event.src_path)
+
+    def on_moved(self, event):
+        # :func:`rash.record.write_record` renames a finished record
+        # into place.
+        if not event.is_directory:
+            self.__index(event.dest_path)
+
+    def __index(self, path):
+        if is_record_name(os.path.basename(path)):
+            self.__indexer.index_records([path])
+
+
+def list_directory(path):
+    """
+    Return a pair of lists ``(files, dirs)`` of names in `path`.
+
+    :func:`os.scandir` is used if available so that the entry types
+    are known without calling stat for each entry.
+
+    """
+    files = []
+    dirs = []
+    if scandir is None:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+    else:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    return (files, dirs)
+
+
+class RecordPoller(object):
+
+    """
+    Poll record directories without depending on file system events.
+
+    Generic polling observers stat every file in the watched tree at
+    each poll, which is slow when the tree is on NFS and huge when
+    :attr:`Indexer.keep_json` is true.  This poller only looks at
+    the spool directories (``command``, ``init`` and ``exit``) and
+    their subdirectories:
+
+    - A directory is listed only when its mtime is newer than the
+      high-water mark recorded at the previous listing.  Files in it
+      are never stat'ed.
+    - As mtime on NFS has coarse granularity (and the clocks of the
+      server and the client may not agree), a directory whose mtime
+      is within :attr:`mtime_slack` seconds from now is listed again
+      at the next scan.
+    - If :attr:`Indexer.keep_json` is true, a directory of a past
+      day (see :meth:`Indexer.is_past_dir`) is not stat'ed anymore
+      once its mtime is settled.  Otherwise, such a directory is
+      removed by the indexer when it is emptied.
+    - When nothing is found, polling interval is doubled up to
+      :attr:`max_interval`.  It is reset to :attr:`interval` as soon
+      as a new record is found.
+
+    Cost of scans is accumulated in :attr:`stats`.
+
+    """
+
+    mtime_slack = 2.0
+
+    def __init__(self, indexer, interval=1.0, max_interval=30.0):
+        """
+        :type      indexer: rash.indexer.Indexer
+        :type     interval: float
+        :arg      interval: polling interval (seconds) when active.
+        :type max_interval: float
+        :arg  max_interval: upper bound of polling interval when idle.
+
+        """
+        self.indexer = indexer
+        self.interval = interval
+        self.max_interval = max_interval
+        self.current_interval = interval
+        self.stats = dict(scans=0, checked_dirs=0, listed_dirs=0,
+                          entries=0, indexed=0, seconds=0.0)
+        self._mtimes = {}   # directory -> mtime high-water mark
+        self._seen = {}     # directory -> set of handled file names
+        self._subdirs = {}  # directory -> list of subdirectories
+        self._settled = set()  # directories not to be stat'ed anymore
+        if indexer.keep_json:
+            self._load_manifest()
+
+    def _load_manifest(self):
+        record_path = self.indexer.cfstore.record_path
+        for key in self.indexer.db.get_indexed_files():
+            (dirname, name) = os.path.split(os.path.join(record_path, key))
+            self._seen.setdefault(dirname, set()).add(name)
+
+    def scan(self):
+        """
+        Index new records and return the number of indexed files.
+
+        Records found in one scan are committed at once by
+        :meth:`rash.indexer.Indexer.index_records`.
+
+        """
+        start = time.time()
+        checked = listed = entries = 0
+        found = []
+        stack = self.indexer.get_spool_dirs()[::-1]
+        while stack:
+            path = stack.pop()
+            if path in self._settled:
+                stack.extend(self._subdirs.get(path, [])[::-1])
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # Not created yet, or removed.
+                self._forget(path)
+                continue
+            checked += 1
+            if self._mtimes.get(path) != mtime:
+                (files, dirs) = list_directory(path)
+                listed += 1
+                entries += len(files) + len(dirs)
+                subdirs = sorted(os.path.join(path, d) for d in dirs)
+                for sub in set(self._subdirs.get(path, [])) - set(subdirs):
+                    self._forget(sub)
+                self._subdirs[path] = subdirs
+                found.extend(self._new_files(path, files))
+                settled = time.time() - mtime > self.mtime_slack
+                self._mtimes[path] = mtime if settled else None
+            elif self.indexer.keep_json and self.indexer.is_past_dir(path):
+                self._settled.add(path)
+            stack.extend(self._subdirs.get(path, [])[::-1])
+
+        indexed = 0
+        if found:
+            try:
+                indexed = self.indexer.index_records(found)
+            except Exception:
+                self.indexer.logger.exception(
+                    'Failed to index records.  They will be retried.')
+                for json_path in found:
+                    (dirname, name) = os.path.split(json_path)
+                    self._seen.get(dirname, set()).discard(name)
+                    self._mtimes.pop(dirname, None)
+
+        elapsed = time.time() - start
+        self.stats['scans'] += 1
+        self.stats['checked_dirs'] += checked
+        self.stats['listed_dirs'] += listed
+        self.stats['entries'] += entries
+        self.stats['indexed'] += indexed
+        self.stats['seconds'] += elapsed
+        if listed:
+            self.indexer.logger.debug(
+                'Polled %d directories (%d entries) in %.3f sec; '
+                'indexed %d records.', listed, entries, elapsed, indexed)
+        return indexed
+
+    def _new_files(self, path, files):
+        seen = self._seen.get(path, set())
+        # Names which do not exist anymore are not needed.
+        self._seen[path] = new_seen = set(
+            name for name in files if is_record_name(name))
+        return [os.path.join(path, name)
+                for name in sorted(new_seen - seen)]
+
+    def _forget(self, path):
+        self._mtimes.pop(path, None)
+        self._settled.discard(path)
+        self._seen.pop(path, None)
+        for sub in self._subdirs.pop(path, []):
+            self._forget(sub)
+
+    def next_interval(self, indexed):
+        """
+        Update and return polling interval based on the last scan.
+        """
+        if indexed:
+            self.current_interval = self.interval
+        else:
+            self.current_interval = min(self.current_interval * 2,
+                                        self.max_interval)
+        return self.current_interval
+
+    def run(self):
+        """
+        Keep polling until KeyboardInterrupt.
+        """
+        self.indexer.logger.debug('Start polling.')
+        try:
+            while True:
+                time.sleep(self.next_interval(self.scan()))
+        except KeyboardInterrupt:
+            self.indexer.logger.debug('Got KeyboardInterrupt. Stop polling.')
+        self.indexer.logger.debug('Scan cost: %r', self.stats)
 
 
 def raise_keyboardinterrupt(_signum, _frame):
@@ -45,18 +261,30 @@ def install_sigterm_handler():
     signal.signal(signal.SIGTERM, raise_keyboardinterrupt)
 
 
-def watch_record(indexer, use_polling=False):
+def watch_record(indexer, use_polling=False, **poller_kwds):
     """
     Start watching `cfstore.record_path`.
 
     :type indexer: rash.indexer.Indexer
+    :type use_polling: bool
+    :arg  use_polling: use :class:`RecordPoller`.
+                       `poller_kwds` are passed to it.
+
+    If `use_polling` is false, :class:`rash.inotify.RecordWatcher` is
+    used when inotify is available.  Otherwise watchdog is used.
 
     """
+    from . import inotify
     if use_polling:
-        from watchdog.observers.polling import PollingObserver as Observer
-        Observer  # fool pyflakes
-    else:
-        from watchdog.observers import Observer
+        RecordPoller(indexer, **poller_kwds).run()
+        indexer.logger.debug('Finish watching record.')
+        return
+    if inotify.is_available():
+        inotify.RecordWatcher(indexer).run()
+        indexer.logger.debug('Finish watching record.')
+        return
+
+    from watchdog.observers import Observer
 
     event_handler = RecordHandler(indexer)
     observer = Observer()